@@ -43,6 +43,8 @@ def create_app(test_config=None):
         # Security: Session Cookie Configuration
         SESSION_COOKIE_HTTPONLY=True,
         SESSION_COOKIE_SAMESITE='Lax',
+        # Auto-archiver thread; set BACKGROUND_TASKS=0 for processes that only serve requests or run scripts
+        BACKGROUND_TASKS=str(os.getenv('BACKGROUND_TASKS', '1')).strip().lower() not in ('0', 'false', 'no'),
     )
     
     # Enable Secure Cookie if in production (requires HTTPS)
@@ -68,18 +70,16 @@ def create_app(test_config=None):
     # Initialize DB tables and seed data
     with app.app_context():
         database.init_db()
-        database.seed_products_from_config(app.config['CONFIG_DIR'])
-        database.backfill_product_details_from_config(app.config['CONFIG_DIR'])
-        database.backfill_product_variants_from_config(app.config['CONFIG_DIR'])
-        database.backfill_product_images_from_config(app.config['CONFIG_DIR'])
-        database.seed_admin_users_from_env(app.config['CONFIG_DIR'])
+        database.seed_from_config(app.config['CONFIG_DIR'])
 
     # Start background tasks
     from .tasks import start_background_tasks
     start_background_tasks(app)
+    from .tenant_config import start_config_listener
+    start_config_listener(app)
 
     # Register Blueprints
-    from .blueprints import auth, orders, cash, products, carousel, public, archive, tenants, system
+    from .blueprints import auth, orders, cash, products, carousel, public, archive, tenants, system, reports
     
     app.register_blueprint(auth.bp)
     app.register_blueprint(orders.bp)
@@ -89,6 +89,7 @@ def create_app(test_config=None):
     app.register_blueprint(archive.bp)
     app.register_blueprint(tenants.bp)
     app.register_blueprint(system.bp)
+    app.register_blueprint(reports.bp)
 
     # Register public last to avoid catching API routes
     app.register_blueprint(public.bp)
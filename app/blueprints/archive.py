@@ -1,12 +1,15 @@
-from flask import Blueprint, request, jsonify, session, Response
-from app.database import get_db
-from app.utils import is_authed, check_csrf
-from datetime import datetime, timedelta, timezone
+from flask import Blueprint, request, jsonify, session
+from app.database import get_db, iter_rows
+from app.utils import is_authed, check_csrf, encode_cursor, decode_cursor, csv_download
+from app.search import search_filter, relevance_order
+from app.changes import record_order_change
+from app.cold_archive import tiers, fetch_tiers, sum_tiers
+from app import rollups
+from app.reports import report_kind, request_filters, queue_report
+from datetime import datetime, timedelta
 import re
-import unicodedata
-import io
-import csv
 import json
+import heapq
 
 bp = Blueprint('archive', __name__, url_prefix='/api')
 
@@ -23,6 +26,14 @@ def get_archive():
     date_field = (request.args.get('date_field') or 'archived').strip().lower()
     if date_field not in ('archived', 'order'):
         date_field = 'archived'
+    sort = (request.args.get('sort') or '').strip().lower()
+    rank_sql, rank_params = None, []
+    after = request.args.get('after')
+    after_key = None
+    if after:
+        after_key = decode_cursor(after, int)
+        if after_key is None:
+            return jsonify({'error': 'after inválido'}), 400
     def _norm_date(s, end=False):
         try:
             if s and len(s) == 10:
@@ -34,99 +45,75 @@ def get_archive():
     to_date = _norm_date(to_date, end=True)
     conn = get_db()
     cur = conn.cursor()
-    base = """
-        SELECT o.id, o.created_at, o.order_type, o.table_number, o.address_json, o.total, o.status, o.customer_name, o.customer_phone, h.last_status, h.last_change
-        FROM archived_orders a
-        JOIN orders o ON o.id = a.order_id
-        LEFT JOIN (
-          SELECT x.order_id, x.status AS last_status, x.changed_at AS last_change
-          FROM order_status_history x
-          JOIN (
-            SELECT order_id, MAX(changed_at) AS mc FROM order_status_history GROUP BY order_id
-          ) y ON y.order_id = x.order_id AND y.mc = x.changed_at
-        ) h ON h.order_id = o.id
-        WHERE a.tenant_slug = ?
-    """
-    params = [tenant_slug]
-    if a_type:
-        base += " AND a.type = ?"
-        params.append(a_type)
-    date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
-    if from_date:
-        base += f" AND {date_col} >= ?"
-        params.append(from_date)
-    if to_date:
-        base += f" AND {date_col} <= ?"
-        params.append(to_date)
-    if order_type:
-        base += " AND o.order_type = ?"
-        params.append(order_type)
+    nq = None
     if q:
         try:
-            qid = int(q)
-            base += " AND o.id = ?"
-            params.append(qid)
+            int(q)
         except Exception:
             nq = re.sub(r"^(destino|direccion|dir)\s*:\s*", "", str(q), flags=re.IGNORECASE).strip()
-            like = f"%{nq.lower()}%"
-            base += " AND (LOWER(COALESCE(o.address_json,'')) LIKE ? OR LOWER(COALESCE(o.table_number,'')) LIKE ? OR LOWER(COALESCE(o.customer_name,'')) LIKE ?)"
-            params.extend([like, like, like])
-    base += " ORDER BY o.id DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    cur.execute(base, params)
-    rows = cur.fetchall()
+            if sort == 'relevance':
+                rank_sql, rank_params = relevance_order(nq, alias='o')
+
+    def _filtered(sfx):
+        sql = f"""
+            FROM archived_orders a
+            JOIN orders{sfx} o ON o.id = a.order_id
+            WHERE a.tenant_slug = ?
+        """
+        params = [tenant_slug]
+        if a_type:
+            sql += " AND a.type = ?"
+            params.append(a_type)
+        date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
+        if from_date:
+            sql += f" AND {date_col} >= ?"
+            params.append(from_date)
+        if to_date:
+            sql += f" AND {date_col} <= ?"
+            params.append(to_date)
+        if order_type:
+            sql += " AND o.order_type = ?"
+            params.append(order_type)
+        if q:
+            if nq is None:
+                sql += " AND o.id = ?"
+                params.append(int(q))
+            else:
+                frag, frag_params = search_filter(nq, alias='o', cold=bool(sfx))
+                sql += frag
+                params.extend(frag_params)
+        return sql, params
+
+    # Live archived orders, then the cold tier (orders_archive) when it may hold matches
+    parts = []
+    for sfx in tiers():
+        sql, params = _filtered(sfx)
+        sql = "SELECT o.id, o.created_at, o.order_type, o.table_number, o.address_json, o.total, o.status, o.customer_name, o.customer_phone, o.status AS last_status, o.last_status_at AS last_change" + sql
+        if rank_sql:
+            tier_rank, tier_rank_params = (rank_sql, rank_params) if not sfx else relevance_order(nq, alias='o', cold=True)
+            sql += f" ORDER BY {tier_rank or 'o.id DESC'}"
+            params.extend(tier_rank_params)
+        elif after_key is not None:
+            sql += " AND o.id < ? ORDER BY o.id DESC"
+            params.append(after_key[0])
+        else:
+            sql += " ORDER BY o.id DESC"
+        parts.append((sql, params))
+    if rank_sql:
+        rows = fetch_tiers(cur, parts, limit=limit, offset=offset, ranked=True)
+    elif after_key is not None:
+        rows = fetch_tiers(cur, parts, limit=limit)
+    else:
+        rows = fetch_tiers(cur, parts, limit=limit, offset=offset)
+    next_after = encode_cursor(rows[-1][0]) if rows and len(rows) >= limit and not rank_sql else None
     # total_count
-    count_sql = """
-        SELECT COUNT(*)
-        FROM archived_orders a
-        JOIN orders o ON o.id = a.order_id
-        LEFT JOIN (
-          SELECT x.order_id, x.status AS last_status, x.changed_at AS last_change
-          FROM order_status_history x
-          JOIN (
-            SELECT order_id, MAX(changed_at) AS mc FROM order_status_history GROUP BY order_id
-          ) y ON y.order_id = x.order_id AND y.mc = x.changed_at
-        ) h ON h.order_id = o.id
-        WHERE a.tenant_slug = ?
-    """
-    count_params = [tenant_slug]
-    if a_type:
-        count_sql += " AND a.type = ?"
-        count_params.append(a_type)
-    date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
-    if from_date:
-        count_sql += f" AND {date_col} >= ?"
-        count_params.append(from_date)
-    if to_date:
-        count_sql += f" AND {date_col} <= ?"
-        count_params.append(to_date)
-    if order_type:
-        count_sql += " AND o.order_type = ?"
-        count_params.append(order_type)
-    if q:
-        try:
-            qid = int(q)
-            count_sql += " AND o.id = ?"
-            count_params.append(qid)
-        except Exception:
-            nq = re.sub(r"^(destino|direccion|dir)\s*:\s*", "", str(q), flags=re.IGNORECASE).strip()
-            like = f"%{nq.lower()}%"
-            count_sql += " AND (LOWER(COALESCE(o.address_json,'')) LIKE ? OR LOWER(COALESCE(o.table_number,'')) LIKE ? OR LOWER(COALESCE(o.customer_name,'')) LIKE ?)"
-            count_params.extend([like, like, like])
-    cur.execute(count_sql, count_params)
-    total_count = int(cur.fetchone()[0])
+    count_parts = []
+    for sfx in tiers():
+        sql, params = _filtered(sfx)
+        count_parts.append(("SELECT COUNT(*)" + sql, params))
+    total_count = sum_tiers(cur, count_parts)
     data = [dict(r) for r in rows]
-    if q:
-        try:
-            int(q)
-        except Exception:
-            def _norm(s):
-                s = str(s or '').lower()
-                return ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
-            nq = re.sub(r"^(destino|direccion|dir)\s*:\s*", "", str(q), flags=re.IGNORECASE).strip()
-            nq = _norm(nq)
-            data = [r for r in data if (nq in _norm(r.get('address_json')) or nq in _norm(r.get('table_number')) or nq in _norm(r.get('customer_name')))]
-    return jsonify({'archives': data, 'count': len(data), 'limit': limit, 'offset': offset, 'total_count': total_count})
+    return jsonify({'archives': data, 'count': len(data), 'limit': limit, 'offset': offset, 'total_count': total_count, 'next_after': next_after})
 
 @bp.route('/archive/eligible_count', methods=['GET'])
 def archive_eligible_count():
@@ -140,16 +127,14 @@ def archive_eligible_count():
     conn = get_db()
     cur = conn.cursor()
     base_status = 'entregado' if a_type == 'delivered' else 'cancelado'
-    sql = """
+    ts_col = 'o.delivered_at' if a_type == 'delivered' else 'o.canceled_at'
+    sql = f"""
         SELECT COUNT(*)
         FROM orders o
-        JOIN (
-          SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = ? GROUP BY order_id
-        ) h ON h.order_id = o.id
         LEFT JOIN archived_orders a ON a.order_id = o.id AND a.type = ?
-        WHERE a.order_id IS NULL AND h.last_change <= ?
+        WHERE a.order_id IS NULL AND o.status = ? AND {ts_col} <= ?
     """
-    params = [base_status, a_type, cutoff]
+    params = [a_type, base_status, cutoff]
     if tenant_slug:
         sql += " AND o.tenant_slug = ?"
         params.append(tenant_slug)
@@ -157,16 +142,16 @@ def archive_eligible_count():
     n = cur.fetchone()[0]
     return jsonify({'count': int(n), 'type': a_type, 'tenant_slug': tenant_slug or None, 'hours': hours})
 
-@bp.route('/archive/export.csv', methods=['GET'])
-@bp.route('/archive/export', methods=['GET'])
-def archive_export():
-    tenant_slug = request.args.get('tenant_slug') or request.args.get('slug') or 'gastronomia-local1'
-    a_type = request.args.get('type')
-    q = request.args.get('q')
-    from_date = request.args.get('from')
-    to_date = request.args.get('to')
-    order_type = request.args.get('order_type')
-    date_field = (request.args.get('date_field') or 'archived').strip().lower()
+@report_kind('archive')
+def archive_export_rows(filters):
+    """(file_name, header, rows) of the archive CSV; filters as reports.request_filters."""
+    tenant_slug = filters.get('tenant_slug') or 'gastronomia-local1'
+    a_type = filters.get('type')
+    q = filters.get('q')
+    from_date = filters.get('from')
+    to_date = filters.get('to')
+    order_type = filters.get('order_type')
+    date_field = (filters.get('date_field') or 'archived').strip().lower()
     if date_field not in ('archived', 'order'):
         date_field = 'archived'
     def _norm_date(s, end=False):
@@ -178,58 +163,62 @@ def archive_export():
         return s
     from_date = _norm_date(from_date, end=False)
     to_date = _norm_date(to_date, end=True)
-    conn = get_db()
-    cur = conn.cursor()
-    base = """
-        SELECT o.id, o.created_at, o.order_type, o.table_number, o.address_json, o.total, o.status, a.archived_at, o.customer_name, o.customer_phone, h.last_status, h.last_change
-        FROM archived_orders a
-        JOIN orders o ON o.id = a.order_id
-        LEFT JOIN (
-          SELECT x.order_id, x.status AS last_status, x.changed_at AS last_change
-          FROM order_status_history x
-          JOIN (
-            SELECT order_id, MAX(changed_at) AS mc FROM order_status_history GROUP BY order_id
-          ) y ON y.order_id = x.order_id AND y.mc = x.changed_at
-        ) h ON h.order_id = o.id
-        WHERE a.tenant_slug = ?
-    """
-    params = [tenant_slug]
-    if a_type:
-        base += " AND a.type = ?"
-        params.append(a_type)
-    date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
-    if from_date:
-        base += f" AND {date_col} >= ?"
-        params.append(from_date)
-    if to_date:
-        base += f" AND {date_col} <= ?"
-        params.append(to_date)
-    if order_type:
-        base += " AND o.order_type = ?"
-        params.append(order_type)
-    if q:
-        try:
-            qid = int(q)
-            base += " AND o.id = ?"
-            params.append(qid)
-        except Exception:
-            nq = re.sub(r"^(destino|direccion|dir)\s*:\s*", "", str(q), flags=re.IGNORECASE).strip()
-            like = f"%{nq.lower()}%"
-            base += " AND (LOWER(COALESCE(o.address_json,'')) LIKE ? OR LOWER(COALESCE(o.table_number,'')) LIKE ? OR LOWER(COALESCE(o.customer_name,'')) LIKE ?)"
-            params.extend([like, like, like])
-    base += " ORDER BY o.id DESC"
-    cur.execute(base, params)
-    rows = cur.fetchall()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["id", "created_at", "order_type", "destination", "customer_phone", "total", "status", "archived_at", "customer_name", "last_status", "last_change", "payment_status"])
-    for r in rows:
-        dest = r[3] if r[2] == 'mesa' else (r[4] or '')
-        total = int(r[5] or 0)
-        writer.writerow([r[0], r[1], r[2], dest, r[9] or '', total, r[6], r[7], r[8], r[10] or '', r[11] or '', r[12] or ''])
-    resp_val = output.getvalue()
-    
+    items = filters.get('detail') == 'items'
+    parts = []
+    item_cols = ", i.product_id, i.name AS item_name, i.qty, i.unit_price, i.notes AS item_notes" if items else ""
+    for sfx in tiers():
+        item_join = f" LEFT JOIN order_items{sfx} i ON i.order_id = o.id" if items else ""
+        base = f"""
+            SELECT o.id, o.created_at, o.order_type, o.table_number, o.address_json, o.total, o.status, a.archived_at, o.customer_name, o.customer_phone, o.status AS last_status, o.last_status_at AS last_change, o.payment_status{item_cols}
+            FROM archived_orders a
+            JOIN orders{sfx} o ON o.id = a.order_id{item_join}
+            WHERE a.tenant_slug = ?
+        """
+        params = [tenant_slug]
+        if a_type:
+            base += " AND a.type = ?"
+            params.append(a_type)
+        date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
+        if from_date:
+            base += f" AND {date_col} >= ?"
+            params.append(from_date)
+        if to_date:
+            base += f" AND {date_col} <= ?"
+            params.append(to_date)
+        if order_type:
+            base += " AND o.order_type = ?"
+            params.append(order_type)
+        if q:
+            try:
+                qid = int(q)
+                base += " AND o.id = ?"
+                params.append(qid)
+            except Exception:
+                nq = re.sub(r"^(destino|direccion|dir)\s*:\s*", "", str(q), flags=re.IGNORECASE).strip()
+                frag, frag_params = search_filter(nq, alias='o', cold=bool(sfx))
+                base += frag
+                params.extend(frag_params)
+        base += " ORDER BY o.id DESC, i.id" if items else " ORDER BY o.id DESC"
+        parts.append((base, params))
+    header = ["id", "created_at", "order_type", "destination", "customer_phone", "total", "status", "archived_at", "customer_name", "last_status", "last_change", "payment_status"]
+    if items:
+        header += ["product_id", "item_name", "qty", "unit_price", "line_total", "item_notes"]
+
+    def lines():
+        # Each tier streams in id order; merging them keeps only one batch per tier in memory
+        streams = [iter_rows(sql, params) for sql, params in parts]
+        rows = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda r: r[0], reverse=True)
+        for r in rows:
+            dest = r[3] if r[2] == 'mesa' else (r[4] or '')
+            total = int(r[5] or 0)
+            row = [r[0], r[1], r[2], dest, r[9] or '', total, r[6], r[7], r[8], r[10] or '', r[11] or '', r[12] or '']
+            if items and r[13] is not None:
+                qty, unit = int(r[15] or 0), int(r[16] or 0)
+                row += [r[13], r[14] or '', qty, unit, qty * unit, r[17] or '']
+            elif items:
+                row += [''] * 6
+            yield row
+
     def _safe(s):
         return ''.join(c for c in str(s or '') if c.isalnum() or c in ('-', '_'))
     df = 'arch' if date_field == 'archived' else 'order'
@@ -238,8 +227,22 @@ def archive_export():
             return str(d or 'all')[:10].replace('T','').replace(':','')
         except Exception:
             return 'all'
-    fname = f"archives_{_safe(tenant_slug or 'tenant')}_{df}_{_dpart(from_date)}_{_dpart(to_date)}_{_safe(a_type or 'all')}.csv"
-    return Response(resp_val, mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename="{fname}"'})
+    kind = 'archive_items' if items else 'archives'
+    fname = f"{kind}_{_safe(tenant_slug or 'tenant')}_{df}_{_dpart(from_date)}_{_dpart(to_date)}_{_safe(a_type or 'all')}.csv"
+    return fname, header, lines()
+
+@bp.route('/archive/export.csv', methods=['GET', 'POST'])
+@bp.route('/archive/export', methods=['GET', 'POST'])
+def archive_export():
+    filters = request_filters('type', 'q', 'from', 'to', 'order_type', 'date_field', 'detail')
+    if request.method == 'POST':
+        # Generated by the report workers; poll /api/reports/<id>
+        if not is_authed():
+            return jsonify({'error': 'no autorizado'}), 401
+        if not check_csrf():
+            return jsonify({'error': 'csrf inválido'}), 403
+        return queue_report('archive', filters)
+    return csv_download(*archive_export_rows(filters))
 
 @bp.route('/archive/metrics', methods=['GET'])
 def archive_metrics():
@@ -263,27 +266,25 @@ def archive_metrics():
     cur = conn.cursor()
     date_col = 'a.archived_at' if date_field == 'archived' else 'o.created_at'
     base = f"""
-        SELECT o.total
-        FROM archived_orders a JOIN orders o ON o.id = a.order_id
+        SELECT {{agg}}
+        FROM archived_orders a JOIN orders{{sfx}} o ON o.id = a.order_id
         WHERE a.tenant_slug = ? AND a.type = ?
         {" AND " + date_col + " >= ?" if from_date else ''}
         {" AND " + date_col + " <= ?" if to_date else ''}
         {" AND o.order_type = ?" if order_type else ''}
     """
+    def _totals(params):
+        count = sum_tiers(cur, [(base.format(agg='COUNT(*)', sfx=sfx), params) for sfx in tiers()])
+        total = sum_tiers(cur, [(base.format(agg='COALESCE(SUM(o.total), 0)', sfx=sfx), params) for sfx in tiers()])
+        return count, total
     # Delivered metrics
     params_del = [tenant_slug, 'delivered'] + ([from_date] if from_date else []) + ([to_date] if to_date else []) + ([order_type] if order_type else [])
-    cur.execute(base, params_del)
-    rows_del = cur.fetchall()
-    delivered_count = len(rows_del)
-    delivered_total = int(sum(int(r[0] or 0) for r in rows_del))
+    delivered_count, delivered_total = _totals(params_del)
     tip = (delivered_total + 5) // 10
     delivered_total_with_tip = delivered_total + tip
     # Canceled metrics
     params_can = [tenant_slug, 'canceled'] + ([from_date] if from_date else []) + ([to_date] if to_date else []) + ([order_type] if order_type else [])
-    cur.execute(base, params_can)
-    rows_can = cur.fetchall()
-    canceled_count = len(rows_can)
-    canceled_total = int(sum(int(r[0] or 0) for r in rows_can))
+    canceled_count, canceled_total = _totals(params_can)
     return jsonify({
         'delivered_count': delivered_count,
         'delivered_total': delivered_total,
@@ -320,6 +321,7 @@ def post_archive():
         "INSERT OR IGNORE INTO archived_orders (order_id, tenant_slug, type, archived_at) VALUES (?, ?, ?, ?)",
         (order_id, tenant_slug, a_type, datetime.utcnow().isoformat())
     )
+    record_order_change(cur, tenant_slug, order_id, 'archived')
     conn.commit()
     return jsonify({'ok': True, 'order_id': order_id, 'type': a_type})
 
@@ -356,151 +358,73 @@ def reset_active_orders():
             (order_id, tenant_slug, now_iso)
         )
         count += 1
+    if count:
+        # One bulk change; followers reload the whole list
+        record_order_change(cur, tenant_slug, None, 'archived')
         
     conn.commit()
     return jsonify({'ok': True, 'count': count})
 
-@bp.route('/metrics', methods=['GET'])
+@report_kind('metrics', fmt='json')
+def metrics_report(filters):
+    """(file_name, payload) of the owner metrics; filters as reports.request_filters."""
+    tenant_slug = filters.get('tenant_slug') or 'gastronomia-local1'
+    def _norm_date(s, end=False):
+        try:
+            if s and len(s) == 10:
+                return s + ('T23:59:59' if end else 'T00:00:00')
+        except Exception:
+            pass
+        return s
+    from_date = _norm_date(filters.get('from'), end=False)
+    to_date = _norm_date(filters.get('to'), end=True)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM orders WHERE tenant_slug = ? AND status NOT IN ('entregado','cancelado') AND id NOT IN (SELECT order_id FROM archived_orders)", (tenant_slug,))
+    active_count = cur.fetchone()[0]
+    # Whole days and hours come from order_rollups; only partial hours at the edges read orders
+    totals = rollups.totals(cur, tenant_slug, from_date, to_date)
+    delivered_count = totals['delivered_count']
+    canceled_count = totals['canceled_count']
+    delivered_total = totals['delivered_total']
+    tip = (delivered_total + 5) // 10
+    delivered_total_with_tip = delivered_total + tip
+    avg_prep = totals['prep_minutes'] // max(1, totals['prep_count'])
+    avg_listo = totals['ready_minutes'] // max(1, totals['ready_count'])
+    avg_entregado = totals['deliver_minutes'] // max(1, totals['deliver_count'])
+    return f"metrics_{tenant_slug}.json", {
+        'active_count': active_count,
+        'delivered_count': delivered_count,
+        'canceled_count': canceled_count,
+        'delivered_total': delivered_total,
+        'delivered_tip_10': tip,
+        'delivered_total_with_tip': delivered_total_with_tip,
+        'avg_to_preparacion_min': avg_prep,
+        'avg_to_listo_min': avg_listo,
+        'avg_to_entregado_min': avg_entregado,
+        'entregado_min_histogram': {c[4:]: totals[c] for c in rollups.HISTOGRAM_COLUMNS}
+    }
+
+@bp.route('/metrics', methods=['GET', 'POST'])
 def metrics():
     try:
         if not is_authed():
             return jsonify({'error': 'no autorizado'}), 401
-        tenant_slug = request.args.get('tenant_slug') or request.args.get('slug') or 'gastronomia-local1'
+        filters = request_filters('from', 'to')
+        tenant_slug = filters['tenant_slug']
         session_tenant = str(session.get('tenant_slug') or '').strip()
         is_owner = bool(session.get('admin_owner'))
         if session_tenant and tenant_slug and session_tenant != tenant_slug:
             return jsonify({'error': 'acceso denegado al tenant'}), 403
         if not is_owner:
             return jsonify({'error': 'solo owner'}), 403
-        from_date = request.args.get('from')
-        to_date = request.args.get('to')
-        def _norm_date(s, end=False):
-            try:
-                if s and len(s) == 10:
-                    return s + ('T23:59:59' if end else 'T00:00:00')
-            except Exception:
-                pass
-            return s
-        from_date = _norm_date(from_date, end=False)
-        to_date = _norm_date(to_date, end=True)
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM orders WHERE tenant_slug = ? AND status NOT IN ('entregado','cancelado') AND id NOT IN (SELECT order_id FROM archived_orders)", (tenant_slug,))
-        active_count = cur.fetchone()[0]
-        base_join_del = (
-            "SELECT COUNT(*) FROM orders o "
-            "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-            "WHERE o.tenant_slug = ? AND o.status = 'entregado'"
-        )
-        base_join_can = (
-            "SELECT COUNT(*) FROM orders o "
-            "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'cancelado' GROUP BY order_id) h ON h.order_id = o.id "
-            "WHERE o.tenant_slug = ? AND o.status = 'cancelado'"
-        )
-        params_del = [tenant_slug]
-        params_can = [tenant_slug]
-        if from_date:
-            base_join_del += " AND h.last_change >= ?"
-            base_join_can += " AND h.last_change >= ?"
-            params_del.append(from_date)
-            params_can.append(from_date)
-        if to_date:
-            base_join_del += " AND h.last_change <= ?"
-            base_join_can += " AND h.last_change <= ?"
-            params_del.append(to_date)
-            params_can.append(to_date)
-        cur.execute(base_join_del, params_del)
-        delivered_count = cur.fetchone()[0]
-        cur.execute(base_join_can, params_can)
-        canceled_count = cur.fetchone()[0]
-        cur.execute(
-            base_join_del.replace("SELECT COUNT(*)", "SELECT COALESCE(SUM(o.total),0)"),
-            params_del
-        )
-        delivered_total = int(cur.fetchone()[0] or 0)
-        tip = (delivered_total + 5) // 10
-        delivered_total_with_tip = delivered_total + tip
-        avg_prep = 0
-        avg_listo = 0
-        avg_entregado = 0
-        try:
-            where_exists = "EXISTS(SELECT 1 FROM order_status_history h WHERE h.order_id = o.id AND h.status = 'entregado'"
-            p2 = [tenant_slug]
-            if from_date:
-                where_exists += " AND h.changed_at >= ?"
-                p2.append(from_date)
-            if to_date:
-                where_exists += " AND h.changed_at <= ?"
-                p2.append(to_date)
-            where_exists += ")"
-            cur.execute(
-                f"""
-                SELECT o.id, o.created_at,
-                       (SELECT h.changed_at FROM order_status_history h WHERE h.order_id = o.id AND h.status = 'preparacion' ORDER BY h.id ASC LIMIT 1) AS prep_at,
-                       (SELECT h.changed_at FROM order_status_history h WHERE h.order_id = o.id AND h.status = 'listo' ORDER BY h.id ASC LIMIT 1) AS listo_at,
-                       (SELECT h.changed_at FROM order_status_history h WHERE h.order_id = o.id AND h.status = 'entregado' ORDER BY h.id ASC LIMIT 1) AS entregado_at
-                FROM orders o
-                WHERE o.tenant_slug = ? AND {where_exists}
-                """,
-                p2
-            )
-            rows = cur.fetchall()
-            def _p(s):
-                try:
-                    if not s: return None
-                    dt = None
-                    if isinstance(s, str):
-                        dt = datetime.fromisoformat(s)
-                    elif isinstance(s, datetime):
-                        dt = s
-                    
-                    if dt:
-                        # Normalize to naive UTC
-                        if dt.tzinfo is not None:
-                            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
-                        return dt
-                    return None
-                except Exception:
-                    return None
-            ps = []
-            ls = []
-            es = []
-            for r in rows:
-                created = _p(r[1])
-                prep_at = _p(r[2])
-                listo_at = _p(r[3])
-                entregado_at = _p(r[4])
-                if created and prep_at:
-                    ps.append(max(0, int((prep_at - created).total_seconds() // 60)))
-                if created and listo_at:
-                    ls.append(max(0, int((listo_at - created).total_seconds() // 60)))
-                if created and entregado_at:
-                    es.append(max(0, int((entregado_at - created).total_seconds() // 60)))
-            def _avg(a):
-                try:
-                    return int(sum(a) // max(1, len(a)))
-                except Exception:
-                    return 0
-            avg_prep = _avg(ps)
-            avg_listo = _avg(ls)
-            avg_entregado = _avg(es)
-        except Exception as e:
-            print(f"Error calculating average metrics: {e}")
-            avg_prep = 0
-            avg_listo = 0
-            avg_entregado = 0
-
-        resp = jsonify({
-            'active_count': active_count,
-            'delivered_count': delivered_count,
-            'canceled_count': canceled_count,
-            'delivered_total': delivered_total,
-            'delivered_tip_10': tip,
-            'delivered_total_with_tip': delivered_total_with_tip,
-            'avg_to_preparacion_min': avg_prep,
-            'avg_to_listo_min': avg_listo,
-            'avg_to_entregado_min': avg_entregado
-        })
+        if request.method == 'POST':
+            # Generated by the report workers; poll /api/reports/<id>
+            if not check_csrf():
+                return jsonify({'error': 'csrf inválido'}), 403
+            return queue_report('metrics', filters)
+        _, payload = metrics_report(filters)
+        resp = jsonify(payload)
         resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
         resp.headers['Pragma'] = 'no-cache'
         resp.headers['Expires'] = '0'
@@ -3,6 +3,8 @@ import os
 from flask import Blueprint, request, jsonify, session
 from werkzeug.security import check_password_hash, generate_password_hash
 from app.database import get_db, is_postgres
+from app.migrations import schema_is_current
+from app.writer import run_write
 from app.utils import is_authed, check_csrf, get_csrf_token
 from datetime import datetime, timezone, timedelta
 import time
@@ -16,6 +18,8 @@ def _norm_user(v):
     return str(v or '').strip()
 
 def ensure_master_users_table(db, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         cur.execute(
             """
@@ -41,6 +45,8 @@ def ensure_master_users_table(db, cur):
     db.commit()
 
 def ensure_admin_users_last_seen_column(db, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE admin_users ADD COLUMN IF NOT EXISTS last_seen_at TEXT")
@@ -58,6 +64,8 @@ def ensure_admin_users_last_seen_column(db, cur):
         return
 
 def ensure_tenants_status_message_column(db, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE tenants ADD COLUMN IF NOT EXISTS status_message TEXT DEFAULT ''")
@@ -81,6 +89,8 @@ def ensure_tenants_status_message_column(db, cur):
             pass
 
 def ensure_tenants_plan_columns(db, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE tenants ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'standard'")
@@ -118,6 +128,8 @@ def ensure_tenants_plan_columns(db, cur):
             pass
 
 def ensure_admin_users_rbac_columns(db, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE admin_users ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'admin'")
@@ -300,16 +312,12 @@ def touch_admin_user_last_seen(db, cur, tenant_slug, username):
         return
     try:
         now = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z')
-        cur.execute(
+        run_write(lambda c: c.execute(
             "UPDATE admin_users SET last_seen_at = ? WHERE tenant_slug = ? AND username = ?",
             (now, tenant_slug, username)
-        )
-        db.commit()
+        ))
     except Exception:
-        try:
-            db.rollback()
-        except Exception:
-            pass
+        pass
 
 @bp.before_app_request
 def touch_last_seen_on_activity():
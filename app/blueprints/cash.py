@@ -1,10 +1,12 @@
 import json
-import csv
-import io
 from datetime import datetime
-from flask import Blueprint, request, jsonify, session, make_response
+from flask import Blueprint, request, jsonify, session
 from app.database import get_db
-from app.utils import is_authed, check_csrf
+from app.utils import is_authed, check_csrf, encode_cursor, decode_cursor, csv_download
+from app.changes import record_order_change
+from app.cold_archive import tiers, fetch_tiers
+from app.cash_totals import SESSION_BATCH, page_totals, session_totals, summary, record_movement
+from app.reports import report_kind, request_filters, queue_report
 
 bp = Blueprint('cash', __name__, url_prefix='/api/cash')
 
@@ -59,49 +61,6 @@ def _session_where(tenant_slug, scope, actor=None):
         params.append(actor or '')
     return q, params
 
-def _aggregate_sales_by_payments(cur, tenant_slug, actor, start_at, end_at):
-    base_total = 0
-    tip_total = 0
-    shipping_total = 0
-    order_ids = set()
-    cur.execute(
-        "SELECT e.order_id, e.payload_json, COALESCE(o.shipping_cost, 0) "
-        "FROM order_events e JOIN orders o ON e.order_id = o.id "
-        "WHERE o.tenant_slug = ? AND e.event_type = 'payment' AND lower(e.actor) = lower(?) AND e.created_at >= ? AND e.created_at <= ? "
-        "ORDER BY e.id ASC",
-        (tenant_slug, actor or '', start_at, end_at),
-    )
-    for r in cur.fetchall() or []:
-        try:
-            oid = int(r[0])
-        except Exception:
-            continue
-        payload_json = r[1] or ''
-        try:
-            meta = json.loads(payload_json) if payload_json else {}
-        except Exception:
-            meta = {}
-        try:
-            base_total += int(meta.get('amount') or 0)
-        except Exception:
-            pass
-        try:
-            tip_total += int(meta.get('tip') or 0)
-        except Exception:
-            pass
-        try:
-            shipping_total += int(r[2] or 0)
-        except Exception:
-            pass
-        order_ids.add(oid)
-    return {
-        'delivered_count': len(order_ids),
-        'base_delivered_total': int(base_total),
-        'tip_total': int(tip_total),
-        'shipping_total': int(shipping_total),
-        'delivered_total': int(base_total) + int(tip_total),
-    }
-
 @bp.route('/session', methods=['GET'])
 def cash_session_get():
     if not is_authed():
@@ -125,98 +84,12 @@ def cash_session_get():
     if not row:
         return jsonify({'active': False})
     sess = dict(row)
-    opened_at = sess['opened_at']
-    now = datetime.utcnow().isoformat()
-    if scope == 'user':
-        sales = _aggregate_sales_by_payments(cur, tenant_slug, actor, opened_at, now)
-        base_delivered_total = int(sales['base_delivered_total'])
-        tip_total = int(sales['tip_total'])
-        delivered_total = int(sales['delivered_total'])
-        delivered_count = int(sales['delivered_count'])
-        shipping_total = int(sales['shipping_total'])
-    else:
-        cur.execute(
-            "SELECT COALESCE(SUM(o.total),0), COALESCE(SUM(COALESCE(o.tip_amount, 0)),0), COALESCE(COUNT(*),0), COALESCE(SUM(COALESCE(o.shipping_cost, 0)),0) FROM orders o "
-            "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-            "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND h.last_change >= ?",
-            (tenant_slug, opened_at)
-        )
-        agg = cur.fetchone() or (0, 0, 0, 0)
-        base_delivered_total = int(agg[0] or 0)
-        tip_total = int(agg[1] or 0)
-        delivered_total = base_delivered_total + tip_total
-        delivered_count = int(agg[2] or 0)
-        shipping_total = int(agg[3] or 0)
-    
-    cur.execute("SELECT type, payment_method, SUM(amount), COUNT(*) FROM cash_movements WHERE session_id = ? GROUP BY type, payment_method", (sess['id'],))
-    rows_mov = cur.fetchall()
-    
-    breakdown = {
-        'efectivo': int(sess['opening_amount']), 
-        'pos': 0, 
-        'transferencia': 0, 
-        'otros': 0
-    }
-    breakdown_counts = {
-        'efectivo': 0, 
-        'pos': 0, 
-        'transferencia': 0, 
-        'otros': 0
-    }
-    entradas = 0
-    salidas = 0
-    
-    for r in rows_mov:
-        mtype = r[0] 
-        pm = (r[1] or '').strip().lower() 
-        amt = int(r[2] or 0)
-        cnt = int(r[3] or 0)
-        
-        if mtype == 'entrada':
-            entradas += amt
-            if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                breakdown['pos'] += amt
-                breakdown_counts['pos'] += cnt
-            elif 'transferencia' in pm:
-                breakdown['transferencia'] += amt
-                breakdown_counts['transferencia'] += cnt
-            elif 'otros' in pm:
-                breakdown['otros'] += amt
-                breakdown_counts['otros'] += cnt
-            else:
-                breakdown['efectivo'] += amt
-                breakdown_counts['efectivo'] += cnt
-        elif mtype == 'salida':
-            salidas += amt
-            if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                breakdown['pos'] -= amt
-                breakdown_counts['pos'] += cnt
-            elif 'transferencia' in pm:
-                breakdown['transferencia'] -= amt
-                breakdown_counts['transferencia'] += cnt
-            elif 'otros' in pm:
-                breakdown['otros'] -= amt
-                breakdown_counts['otros'] += cnt
-            else:
-                breakdown['efectivo'] -= amt
-                breakdown_counts['efectivo'] += cnt
-
-    theoretical_cash = int(sess['opening_amount']) + entradas - salidas
+    # Running totals maintained by the order and cash writes (app/cash_totals.py)
+    totals = session_totals(cur, sess)
     return jsonify({
         'active': True, 
         'session': sess, 
-        'summary': {
-            'delivered_count': delivered_count, 
-            'delivered_total': delivered_total, 
-            'base_delivered_total': base_delivered_total, 
-            'tip_total': tip_total, 
-            'shipping_total': shipping_total, 
-            'entradas': entradas, 
-            'salidas': salidas, 
-            'theoretical_cash': theoretical_cash,
-            'theoretical_breakdown': breakdown,
-            'theoretical_breakdown_counts': breakdown_counts
-        }
+        'summary': summary(totals, sess['opening_amount'])
     })
 
 @bp.route('/open', methods=['POST'])
@@ -246,8 +119,9 @@ def cash_open():
         "INSERT INTO cash_sessions (tenant_slug, scope, opened_at, opened_by, opening_amount, notes_open) VALUES (?, ?, ?, ?, ?, ?)",
         (tenant_slug, scope, now, actor, opening_amount, notes_open),
     )
-    conn.commit()
     sid = cur.lastrowid
+    record_order_change(cur, tenant_slug, None, 'cash')
+    conn.commit()
     return jsonify({'session_id': sid, 'tenant_slug': tenant_slug, 'scope': scope, 'opened_at': now, 'opening_amount': opening_amount})
 
 @bp.route('/close', methods=['POST'])
@@ -282,67 +156,16 @@ def cash_close():
     opened_at = str(row[1])
     opening_amount = int(row[2] or 0)
     
-    if scope == 'user':
-        sales = _aggregate_sales_by_payments(cur, tenant_slug, actor, opened_at, now)
-        base_delivered_total = int(sales['base_delivered_total'])
-        tip_total = int(sales['tip_total'])
-        shipping_total = int(sales['shipping_total'])
-        delivered_total = int(sales['delivered_total'])
-    else:
-        cur.execute(
-            "SELECT COALESCE(SUM(o.total),0), COALESCE(SUM(COALESCE(o.tip_amount, 0)),0), COALESCE(SUM(COALESCE(o.shipping_cost, 0)),0) FROM orders o "
-            "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-            "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND h.last_change >= ? AND h.last_change <= ?",
-            (tenant_slug, opened_at, now)
-        )
-        row_totals = cur.fetchone() or (0, 0, 0)
-        base_delivered_total = int(row_totals[0] or 0)
-        tip_total = int(row_totals[1] or 0)
-        shipping_total = int(row_totals[2] or 0)
-        delivered_total = base_delivered_total + tip_total
-    
-    cur.execute("SELECT type, payment_method, SUM(amount), COUNT(*) FROM cash_movements WHERE session_id = ? GROUP BY type, payment_method", (sid,))
-    rows_mov = cur.fetchall()
-    
-    breakdown = {'efectivo': opening_amount, 'pos': 0, 'transferencia': 0, 'otros': 0}
-    breakdown_counts = {'efectivo': 0, 'pos': 0, 'transferencia': 0, 'otros': 0}
-    entradas = 0
-    salidas = 0
-    
-    for r in rows_mov:
-        mtype = r[0]
-        pm = (r[1] or '').strip().lower()
-        amt = int(r[2] or 0)
-        cnt = int(r[3] or 0)
-        
-        if mtype == 'entrada':
-            entradas += amt
-            if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                breakdown['pos'] += amt
-                breakdown_counts['pos'] += cnt
-            elif 'transferencia' in pm:
-                breakdown['transferencia'] += amt
-                breakdown_counts['transferencia'] += cnt
-            elif 'otros' in pm:
-                breakdown['otros'] += amt
-                breakdown_counts['otros'] += cnt
-            else:
-                breakdown['efectivo'] += amt
-                breakdown_counts['efectivo'] += cnt
-        elif mtype == 'salida':
-            salidas += amt
-            if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                breakdown['pos'] -= amt
-                breakdown_counts['pos'] += cnt
-            elif 'transferencia' in pm:
-                breakdown['transferencia'] -= amt
-                breakdown_counts['transferencia'] += cnt
-            elif 'otros' in pm:
-                breakdown['otros'] -= amt
-                breakdown_counts['otros'] += cnt
-            else:
-                breakdown['efectivo'] -= amt
-                breakdown_counts['efectivo'] += cnt
+    totals = session_totals(cur, {'id': sid, 'tenant_slug': tenant_slug, 'scope': scope, 'opened_at': opened_at, 'opened_by': actor, 'closed_at': now})
+    current = summary(totals, opening_amount)
+    entradas = current['entradas']
+    salidas = current['salidas']
+    delivered_total = current['delivered_total']
+    base_delivered_total = current['base_delivered_total']
+    tip_total = current['tip_total']
+    shipping_total = current['shipping_total']
+    breakdown = current['theoretical_breakdown']
+    breakdown_counts = current['theoretical_breakdown_counts']
 
     theoretical_cash = opening_amount + entradas - salidas
     closing_diff = closing_amount - theoretical_cash
@@ -351,6 +174,7 @@ def cash_close():
     closing_metadata = json.dumps({'declared_breakdown': declared_breakdown})
     
     cur.execute("UPDATE cash_sessions SET closed_at = ?, closed_by = ?, closing_amount = ?, notes_close = ?, closing_diff = ?, closing_metadata = ? WHERE id = ?", (now, actor, closing_amount, notes_close, closing_diff, closing_metadata, sid))
+    record_order_change(cur, tenant_slug, None, 'cash')
     conn.commit()
     
     return jsonify({
@@ -455,7 +279,10 @@ def cash_movement():
     row = cur.fetchone()
     if not row: return jsonify({'error': 'no hay sesión de caja abierta'}), 400
     sid = int(row[0])
-    cur.execute("INSERT INTO cash_movements (session_id, type, amount, note, actor, created_at, payment_method) VALUES (?, ?, ?, ?, ?, ?, ?)", (sid, mtype, amount, note, actor, now, (payload.get('payment_method') or '').strip()))
+    payment_method = (payload.get('payment_method') or '').strip()
+    cur.execute("INSERT INTO cash_movements (session_id, type, amount, note, actor, created_at, payment_method) VALUES (?, ?, ?, ?, ?, ?, ?)", (sid, mtype, amount, note, actor, now, payment_method))
+    record_movement(cur, sid, mtype, amount, payment_method)
+    record_order_change(cur, tenant_slug, None, 'cash')
     conn.commit()
     return jsonify({'session_id': sid, 'type': mtype, 'amount': amount, 'note': note, 'created_at': now})
 
@@ -515,15 +342,15 @@ def cash_session_orders():
         
     end_at = to_date if to_date else (closed_at or datetime.utcnow().isoformat())
     if scope == 'user':
-        cur.execute(
+        base = (
             "SELECT o.id, o.created_at, e.payload_json "
-            "FROM order_events e JOIN orders o ON e.order_id = o.id "
+            "FROM order_events{sfx} e JOIN orders{sfx} o ON e.order_id = o.id "
             "WHERE o.tenant_slug = ? AND e.event_type = 'payment' AND lower(e.actor) = lower(?) AND e.created_at >= ? AND e.created_at <= ? "
-            "ORDER BY o.id DESC",
-            (tenant_slug, actor or '', opened_at, end_at),
+            "ORDER BY o.id DESC"
         )
+        rows = fetch_tiers(cur, [(base.format(sfx=sfx), (tenant_slug, actor or '', opened_at, end_at)) for sfx in tiers(opened_at)])
         out = []
-        for r in cur.fetchall() or []:
+        for r in rows:
             try:
                 oid = int(r[0])
             except Exception:
@@ -543,13 +370,11 @@ def cash_session_orders():
         return jsonify({'orders': out, 'session_id': sid, 'from': opened_at, 'to': end_at})
     else:
         base = (
-            "SELECT o.id, o.created_at, o.total, o.payment_method FROM orders o "
-            "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-            "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND h.last_change >= ? AND h.last_change <= ? "
+            "SELECT o.id, o.created_at, o.total, o.payment_method FROM orders{sfx} o "
+            "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND o.delivered_at >= ? AND o.delivered_at <= ? "
             "ORDER BY o.id DESC"
         )
-        cur.execute(base, (tenant_slug, opened_at, end_at))
-        rows = cur.fetchall()
+        rows = fetch_tiers(cur, [(base.format(sfx=sfx), (tenant_slug, opened_at, end_at)) for sfx in tiers(opened_at)])
         return jsonify({'orders': [ {'id': int(r[0]), 'created_at': r[1], 'total': int(r[2] or 0), 'payment_method': r[3] } for r in rows ], 'session_id': sid, 'from': opened_at, 'to': end_at})
 
 @bp.route('/sessions', methods=['GET'])
@@ -569,6 +394,12 @@ def cash_sessions_list():
     if date_field not in ('closed', 'opened'): date_field = 'closed'
     from_date = request.args.get('from')
     to_date = request.args.get('to')
+    after = request.args.get('after')
+    after_key = None
+    if after:
+        after_key = decode_cursor(after, str, int)
+        if after_key is None:
+            return jsonify({'error': 'after inválido'}), 400
     
     def _norm_date(s, end=False):
         try:
@@ -593,82 +424,24 @@ def cash_sessions_list():
     if to_date:
         base += f" AND {col} <= ?"
         params.append(to_date)
-    base += " ORDER BY closed_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+    if after_key is not None:
+        base += " AND (closed_at < ? OR (closed_at = ? AND id < ?)) ORDER BY closed_at DESC, id DESC LIMIT ?"
+        params.extend([after_key[0], after_key[0], after_key[1], limit])
+    else:
+        base += " ORDER BY closed_at DESC, id DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
     
     cur.execute(base, params)
     rows = cur.fetchall()
     sessions = []
+    next_after = encode_cursor(rows[-1]['closed_at'], int(rows[-1]['id'])) if rows and len(rows) >= limit else None
     
+    # Sales and movements of the whole page at once
+    totals_by_id = page_totals(cur, [dict(r) for r in rows])
     for r in rows:
         s = dict(r)
         sid = int(s['id'])
-        opened_at = s.get('opened_at')
-        closed_at = s.get('closed_at')
-        sess_scope = str(s.get('scope') or scope)
-        sess_opened_by = str(s.get('opened_by') or '')
-        if sess_scope == 'user':
-            sales = _aggregate_sales_by_payments(cur, tenant_slug, sess_opened_by, opened_at, closed_at)
-            base_delivered_total = int(sales['base_delivered_total'])
-            tip_total = int(sales['tip_total'])
-            delivered_total = int(sales['delivered_total'])
-            delivered_count = int(sales['delivered_count'])
-            shipping_total = int(sales['shipping_total'])
-        else:
-            cur.execute(
-                "SELECT COALESCE(SUM(o.total),0), COALESCE(SUM(COALESCE(o.tip_amount, 0)),0), COALESCE(COUNT(*),0), COALESCE(SUM(COALESCE(o.shipping_cost, 0)),0) FROM orders o "
-                "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-                "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND h.last_change >= ? AND h.last_change <= ?",
-                (tenant_slug, opened_at, closed_at)
-            )
-            trow = cur.fetchone() or (0,0,0,0)
-            base_delivered_total = int(trow[0] or 0)
-            tip_total = int(trow[1] or 0)
-            delivered_total = base_delivered_total + tip_total
-            delivered_count = int(trow[2] or 0)
-            shipping_total = int(trow[3] or 0)
-        
-        cur.execute("SELECT COALESCE(SUM(CASE WHEN type='entrada' THEN amount ELSE 0 END),0), COALESCE(SUM(CASE WHEN type='salida' THEN amount ELSE 0 END),0) FROM cash_movements WHERE session_id = ?", (sid,))
-        mrow = cur.fetchone() or (0,0)
-        entradas = int(mrow[0] or 0)
-        salidas = int(mrow[1] or 0)
-        theoretical_cash = int(s.get('opening_amount') or 0) + entradas - salidas
-        
-        cur.execute("SELECT type, payment_method, SUM(amount), COUNT(*) FROM cash_movements WHERE session_id = ? GROUP BY type, payment_method", (sid,))
-        rows_mov = cur.fetchall()
-        breakdown = {'efectivo': int(s.get('opening_amount') or 0), 'pos': 0, 'transferencia': 0, 'otros': 0}
-        breakdown_counts = {'efectivo': 0, 'pos': 0, 'transferencia': 0, 'otros': 0}
-        for rm in rows_mov:
-            mtype = rm[0]
-            pm = (rm[1] or '').strip().lower()
-            amt = int(rm[2] or 0)
-            cnt = int(rm[3] or 0)
-            if mtype == 'entrada':
-                if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                    breakdown['pos'] += amt
-                    breakdown_counts['pos'] += cnt
-                elif 'transferencia' in pm:
-                    breakdown['transferencia'] += amt
-                    breakdown_counts['transferencia'] += cnt
-                elif 'otros' in pm:
-                    breakdown['otros'] += amt
-                    breakdown_counts['otros'] += cnt
-                else:
-                    breakdown['efectivo'] += amt
-                    breakdown_counts['efectivo'] += cnt
-            elif mtype == 'salida':
-                if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
-                    breakdown['pos'] -= amt
-                    breakdown_counts['pos'] += cnt
-                elif 'transferencia' in pm:
-                    breakdown['transferencia'] -= amt
-                    breakdown_counts['transferencia'] += cnt
-                elif 'otros' in pm:
-                    breakdown['otros'] -= amt
-                    breakdown_counts['otros'] += cnt
-                else:
-                    breakdown['efectivo'] -= amt
-                    breakdown_counts['efectivo'] += cnt
+        current = summary(totals_by_id[sid], s.get('opening_amount'))
 
         declared_breakdown = {}
         try:
@@ -680,38 +453,35 @@ def cash_sessions_list():
             pass
 
         s['summary'] = {
-            'delivered_total': delivered_total,
-            'delivered_count': delivered_count,
-            'entradas': entradas,
-            'salidas': salidas,
-            'theoretical_cash': theoretical_cash,
-            'theoretical_breakdown': breakdown,
-            'theoretical_breakdown_counts': breakdown_counts,
+            'delivered_total': current['delivered_total'],
+            'delivered_count': current['delivered_count'],
+            'entradas': current['entradas'],
+            'salidas': current['salidas'],
+            'theoretical_cash': current['theoretical_cash'],
+            'theoretical_breakdown': current['theoretical_breakdown'],
+            'theoretical_breakdown_counts': current['theoretical_breakdown_counts'],
             'declared_breakdown': declared_breakdown,
-            'base_delivered_total': base_delivered_total,
-            'tip_total': tip_total,
-            'shipping_total': shipping_total,
+            'base_delivered_total': current['base_delivered_total'],
+            'tip_total': current['tip_total'],
+            'shipping_total': current['shipping_total'],
             'closing_diff': int(s.get('closing_diff') or 0)
         }
         sessions.append(s)
         
-    return jsonify({'sessions': sessions, 'limit': limit, 'offset': offset, 'count': len(sessions)})
+    return jsonify({'sessions': sessions, 'limit': limit, 'offset': offset, 'count': len(sessions), 'next_after': next_after})
 
-@bp.route('/sessions/export.csv', methods=['GET'])
-def cash_sessions_export_csv():
-    if not is_authed():
-        return jsonify({'error': 'no autorizado'}), 401
-    tenant_slug = request.args.get('tenant_slug') or request.args.get('slug') or 'gastronomia-local1'
-    session_tenant, actor, role, perms, owner = _ctx()
-    if not _enforce_tenant(tenant_slug, session_tenant):
-        return jsonify({'error': 'acceso denegado al tenant'}), 403
-    if not (_has_perm(perms, owner, role, 'cash_view') or _has_perm(perms, owner, role, 'cash_manage')):
-        return jsonify({'error': 'sin permisos'}), 403
-    scope = _scope_for(role, owner=owner)
-    date_field = (request.args.get('date_field') or 'closed').strip().lower()
+@report_kind('cash_sessions')
+def cash_sessions_export(filters):
+    """(file_name, header, rows) of the closed sessions CSV.
+
+    filters as reports.request_filters plus scope and actor, which the route
+    derives from the session.
+    """
+    tenant_slug = filters.get('tenant_slug') or 'gastronomia-local1'
+    scope = filters.get('scope') or 'tenant'
+    actor = filters.get('actor')
+    date_field = (filters.get('date_field') or 'closed').strip().lower()
     if date_field not in ('closed', 'opened'): date_field = 'closed'
-    from_date = request.args.get('from')
-    to_date = request.args.get('to')
     
     def _norm_date(s, end=False):
         try:
@@ -719,11 +489,9 @@ def cash_sessions_export_csv():
         except: pass
         return s
         
-    from_date = _norm_date(from_date, end=False)
-    to_date = _norm_date(to_date, end=True)
+    from_date = _norm_date(filters.get('from'), end=False)
+    to_date = _norm_date(filters.get('to'), end=True)
     
-    conn = get_db()
-    cur = conn.cursor()
     base = "SELECT id, tenant_slug, scope, opened_at, opened_by, opening_amount, notes_open, closed_at, closed_by, closing_amount, notes_close, closing_diff FROM cash_sessions WHERE tenant_slug = ? AND scope = ? AND closed_at IS NOT NULL"
     params = [tenant_slug, scope]
     if scope == 'user':
@@ -736,51 +504,49 @@ def cash_sessions_export_csv():
     if to_date:
         base += f" AND {col} <= ?"
         params.append(to_date)
-    base += " ORDER BY closed_at DESC"
-    cur.execute(base, params)
-    rows = cur.fetchall()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['tenant_slug', 'opened_at', 'opened_by', 'opening_amount', 'notes_open', 'closed_at', 'closed_by', 'closing_amount', 'notes_close', 'base_delivered_total', 'tip_total', 'shipping_total', 'delivered_total', 'entradas', 'salidas', 'theoretical_cash', 'closing_diff'])
-    
-    for r in rows:
-        s = dict(r)
-        sid = int(s['id'])
-        opened_at = s.get('opened_at')
-        closed_at = s.get('closed_at')
-        sess_scope = str(s.get('scope') or scope)
-        sess_opened_by = str(s.get('opened_by') or '')
-        if sess_scope == 'user':
-            sales = _aggregate_sales_by_payments(cur, tenant_slug, sess_opened_by, opened_at, closed_at)
-            base_delivered_total = int(sales['base_delivered_total'])
-            tip_total = int(sales['tip_total'])
-            shipping_total = int(sales['shipping_total'])
-            delivered_total = int(sales['delivered_total'])
-        else:
-            cur.execute(
-                "SELECT COALESCE(SUM(o.total),0), COALESCE(SUM(COALESCE(o.tip_amount, 0)),0), COALESCE(SUM(COALESCE(o.shipping_cost, 0)),0) FROM orders o "
-                "JOIN (SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id) h ON h.order_id = o.id "
-                "WHERE o.tenant_slug = ? AND o.status = 'entregado' AND h.last_change >= ? AND h.last_change <= ?",
-                (tenant_slug, opened_at, closed_at)
-            )
-            trow = cur.fetchone() or (0,0,0)
-            base_delivered_total = int(trow[0] or 0)
-            tip_total = int(trow[1] or 0)
-            shipping_total = int(trow[2] or 0)
-            delivered_total = base_delivered_total + tip_total
-        
-        cur.execute("SELECT COALESCE(SUM(CASE WHEN type='entrada' THEN amount ELSE 0 END),0), COALESCE(SUM(CASE WHEN type='salida' THEN amount ELSE 0 END),0) FROM cash_movements WHERE session_id = ?", (sid,))
-        mrow = cur.fetchone() or (0,0)
-        entradas = int(mrow[0] or 0)
-        salidas = int(mrow[1] or 0)
-        theoretical_cash = int(s.get('opening_amount') or 0) + entradas - salidas
-        
-        writer.writerow([
-            s.get('tenant_slug'), s.get('opened_at'), s.get('opened_by'), int(s.get('opening_amount') or 0), s.get('notes_open'), s.get('closed_at'), s.get('closed_by'), int(s.get('closing_amount') or 0), s.get('notes_close'), base_delivered_total, tip_total, shipping_total, delivered_total, entradas, salidas, theoretical_cash, int(s.get('closing_diff') or 0)
-        ])
-        
-    resp = make_response(output.getvalue())
-    resp.headers['Content-Type'] = 'text/csv'
-    resp.headers['Content-Disposition'] = 'attachment; filename="cash_sessions.csv"'
-    return resp
+
+    header = ['tenant_slug', 'opened_at', 'opened_by', 'opening_amount', 'notes_open', 'closed_at', 'closed_by', 'closing_amount', 'notes_close', 'base_delivered_total', 'tip_total', 'shipping_total', 'delivered_total', 'entradas', 'salidas', 'theoretical_cash', 'closing_diff']
+
+    def lines():
+        cur = get_db().cursor()
+        after_key = None
+        while True:
+            # Keyset chunks: memory and per-chunk queries stay constant however many sessions match
+            q, p = base, list(params)
+            if after_key is not None:
+                q += " AND (closed_at < ? OR (closed_at = ? AND id < ?))"
+                p.extend([after_key[0], after_key[0], after_key[1]])
+            cur.execute(q + " ORDER BY closed_at DESC, id DESC LIMIT ?", p + [SESSION_BATCH])
+            rows = [dict(r) for r in cur.fetchall()]
+            if not rows:
+                break
+            totals_by_id = page_totals(cur, rows)
+            for s in rows:
+                current = summary(totals_by_id[int(s['id'])], s.get('opening_amount'))
+                yield [
+                    s.get('tenant_slug'), s.get('opened_at'), s.get('opened_by'), int(s.get('opening_amount') or 0), s.get('notes_open'), s.get('closed_at'), s.get('closed_by'), int(s.get('closing_amount') or 0), s.get('notes_close'), current['base_delivered_total'], current['tip_total'], current['shipping_total'], current['delivered_total'], current['entradas'], current['salidas'], current['theoretical_cash'], int(s.get('closing_diff') or 0)
+                ]
+            if len(rows) < SESSION_BATCH:
+                break
+            after_key = (rows[-1]['closed_at'], int(rows[-1]['id']))
+
+    return 'cash_sessions.csv', header, lines()
+
+@bp.route('/sessions/export.csv', methods=['GET', 'POST'])
+def cash_sessions_export_csv():
+    if not is_authed():
+        return jsonify({'error': 'no autorizado'}), 401
+    filters = request_filters('date_field', 'from', 'to')
+    session_tenant, actor, role, perms, owner = _ctx()
+    if not _enforce_tenant(filters['tenant_slug'], session_tenant):
+        return jsonify({'error': 'acceso denegado al tenant'}), 403
+    if not (_has_perm(perms, owner, role, 'cash_view') or _has_perm(perms, owner, role, 'cash_manage')):
+        return jsonify({'error': 'sin permisos'}), 403
+    filters['scope'] = _scope_for(role, owner=owner)
+    if filters['scope'] == 'user':
+        filters['actor'] = actor
+    if request.method == 'POST':
+        # Generated by the report workers; poll /api/reports/<id>
+        if not check_csrf(): return jsonify({'error': 'csrf inválido'}), 403
+        return queue_report('cash_sessions', filters)
+    return csv_download(*cash_sessions_export(filters))
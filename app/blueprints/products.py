@@ -5,6 +5,7 @@ from werkzeug.utils import secure_filename
 from flask import Blueprint, request, jsonify, session, current_app
 from app.database import get_db
 from app.utils import is_authed, check_csrf
+from app import catalog
 import cloudinary
 import cloudinary.uploader
 
@@ -16,38 +17,43 @@ def list_products():
     include_inactive = request.args.get('include_inactive') == 'true'
     conn = get_db()
     cur = conn.cursor()
-    
-    query = "SELECT product_id, name, price, stock, active, COALESCE(details,'') as details, COALESCE(variants_json,'') as variants_json, COALESCE(last_modified, '') as last_modified, COALESCE(image_url, '') as image_url FROM products WHERE tenant_slug = ?"
-    params = [tenant_slug]
-    
-    if not include_inactive:
-        query += " AND active = 1"
-        
-    query += " ORDER BY name ASC"
-    
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    
-    # Deduplicate by product_id
-    seen_ids = set()
-    items = []
-    for r in rows:
-        pid = r[0]
-        if pid not in seen_ids:
-            seen_ids.add(pid)
-            items.append({
-                'id': pid, 
-                'name': r[1], 
-                'price': int(r[2] or 0), 
-                'stock': int(r[3] or 0), 
-                'active': bool(r[4]), 
-                'details': r[5] or '', 
-                'variants': r[6] or '', 
-                'last_modified': r[7] or '', 
-                'image_url': r[8] or ''
-            })
-            
-    return jsonify({'products': items, 'tenant_slug': tenant_slug})
+
+    if not catalog.catalog_ready():
+        return jsonify({'products': catalog.load_products(cur, tenant_slug, include_inactive), 'tenant_slug': tenant_slug})
+
+    # Editor delta: every product (active or not) changed after the version the client holds
+    since = request.args.get('since')
+    if since not in (None, ''):
+        try:
+            since = int(since)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'since inválido'}), 400
+        version, items, reset = catalog.changes_since(cur, tenant_slug, since)
+        resp = jsonify({'products': items, 'tenant_slug': tenant_slug, 'version': version, 'since': since, 'reset': reset})
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+    snap = catalog.snapshot(cur, tenant_slug, include_inactive)
+    return _snapshot_response(snap)
+
+def _snapshot_response(snap):
+    """Cached catalog bytes in the best encoding the client accepts, revalidated by ETag/Last-Modified."""
+    encoding = None
+    if snap['br'] is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif snap['gzip'] is not None and request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    resp = current_app.response_class(snap[encoding] if encoding else snap['body'], mimetype='application/json')
+    # Each encoding is a different representation, so it gets its own strong tag
+    resp.set_etag(f"{snap['etag']}-{encoding}" if encoding else snap['etag'])
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept-Encoding')
+    if snap['last_modified'] is not None:
+        resp.last_modified = snap['last_modified']
+    # Stock moves with every order: clients keep the body but always revalidate (a 304 is one lookup)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
 
 @bp.route('/products', methods=['POST'])
 def create_product():
@@ -134,6 +140,7 @@ def create_product():
                 SET name=?, price=?, stock=?, active=1, details=?, variants_json=?, image_url=?, last_modified=?
                 WHERE tenant_slug=? AND product_id=?
             """, (name, price, stock, details, variants_json, image_url, datetime.utcnow().isoformat(), tenant_slug, product_id))
+            catalog.bump(cur, tenant_slug, [product_id])
             conn.commit()
             return jsonify({'ok': True, 'id': product_id, 'updated': True})
         
@@ -141,6 +148,7 @@ def create_product():
             INSERT INTO products (tenant_slug, product_id, name, price, stock, active, details, variants_json, image_url, last_modified)
             VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?)
         """, (tenant_slug, product_id, name, price, stock, details, variants_json, image_url, datetime.utcnow().isoformat()))
+        catalog.bump(cur, tenant_slug, [product_id])
         conn.commit()
         return jsonify({'ok': True, 'id': product_id, 'created': True})
     except Exception as e:
@@ -207,6 +215,8 @@ def update_product(product_id):
     conn = get_db()
     cur = conn.cursor()
     cur.execute(f"UPDATE products SET {', '.join(fields)} WHERE tenant_slug = ? AND product_id = ?", params)
+    if cur.rowcount:
+        catalog.bump(cur, tenant_slug, [product_id])
     conn.commit()
     return jsonify({'ok': True, 'product_id': product_id, 'last_modified': params[len(fields)-1]})
 
@@ -224,6 +234,7 @@ def delete_product(product_id):
             WHERE tenant_slug = ? AND product_id = ?
         """, (datetime.utcnow().isoformat(), tenant_slug, product_id))
         if cur.rowcount == 0: return jsonify({'error': 'Producto no encontrado'}), 404
+        catalog.bump(cur, tenant_slug, [product_id])
         conn.commit()
         return jsonify({'ok': True})
     except Exception as e:
@@ -0,0 +1,55 @@
+import os
+from flask import Blueprint, jsonify, session, send_file
+from app.utils import is_authed
+from app.reports import reports_ready, reports_dir, get_job, list_jobs, job_payload
+
+bp = Blueprint('reports', __name__, url_prefix='/api/reports')
+
+def _requester():
+    return str(session.get('tenant_slug') or '').strip(), str(session.get('admin_user') or '').strip()
+
+def _own_job(job_id):
+    """(job, None) for a job the session requested, else (None, error response)."""
+    if not is_authed():
+        return None, (jsonify({'error': 'no autorizado'}), 401)
+    if not reports_ready():
+        return None, (jsonify({'error': 'reportes no disponibles'}), 503)
+    job = get_job(job_id)
+    session_tenant, actor = _requester()
+    # Jobs are de-duplicated per requester, so only the requester sees them
+    if not job or (session_tenant and job['tenant_slug'] != session_tenant) or job['created_by'].lower() != actor.lower():
+        return None, (jsonify({'error': 'reporte no encontrado'}), 404)
+    return job, None
+
+@bp.route('', methods=['GET'])
+def reports_list():
+    if not is_authed():
+        return jsonify({'error': 'no autorizado'}), 401
+    if not reports_ready():
+        return jsonify({'reports': []})
+    session_tenant, actor = _requester()
+    jobs = list_jobs(session_tenant, actor) if session_tenant else []
+    return jsonify({'reports': [job_payload(j) for j in jobs]})
+
+@bp.route('/<int:job_id>', methods=['GET'])
+def report_status(job_id):
+    job, err = _own_job(job_id)
+    if err:
+        return err
+    resp = jsonify(job_payload(job))
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+@bp.route('/<int:job_id>/download', methods=['GET'])
+def report_download(job_id):
+    job, err = _own_job(job_id)
+    if err:
+        return err
+    if job['status'] != 'done':
+        return jsonify({'error': 'reporte no terminado', 'status': job['status']}), 409
+    path = os.path.join(reports_dir(), os.path.basename(job.get('file_path') or ''))
+    if not job.get('file_path') or not os.path.isfile(path):
+        return jsonify({'error': 'reporte expirado'}), 410
+    name = job.get('file_name') or os.path.basename(path)
+    mimetype = 'application/gzip' if name.endswith('.gz') else ('application/json' if name.endswith('.json') else 'text/csv')
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=name)
@@ -151,6 +151,16 @@ def db_check():
         
     return jsonify(status)
 
+@bp.route('/api/write_stats')
+def write_stats():
+    from app.writer import WRITE_COORDINATOR, write_stats as coordinator_stats
+    resp = jsonify({
+        'enabled': WRITE_COORDINATOR and not current_app.config.get('IS_POSTGRES', False),
+        'coordinators': coordinator_stats(),
+    })
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
 @bp.route('/api/init_db_force')
 def init_db_force():
     """Forza la inicialización de la base de datos y creación de tablas."""
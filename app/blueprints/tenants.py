@@ -1,6 +1,9 @@
 from flask import Blueprint, request, jsonify, session, current_app
 from app.database import get_db, is_postgres
-from app.utils import is_authed, check_csrf, get_cached_tenant_config, invalidate_tenant_config
+from app.migrations import schema_is_current
+from app import estimator
+from app.utils import is_authed, check_csrf
+from app.tenant_config import get_cached_tenant_config, invalidate_tenant_config, save_tenant_config, touch_tenant_config, compiled_payload
 import os
 import json
 from datetime import datetime, timedelta
@@ -9,6 +12,10 @@ from werkzeug.security import generate_password_hash
 # Force reload check
 bp = Blueprint('tenants', __name__, url_prefix='/api')
 
+# Public storefront payloads (header, checkout): browsers and CDNs reuse them this long
+PUBLIC_MAX_AGE = int(os.environ.get('TENANT_PUBLIC_MAX_AGE', '60') or '60')
+PUBLIC_STALE_WHILE_REVALIDATE = int(os.environ.get('TENANT_PUBLIC_STALE_WHILE_REVALIDATE', '600') or '600')
+
 def _parse_perms_json(s):
     if not s:
         return {}
@@ -28,6 +35,8 @@ def _parse_perms_json(s):
     return {}
 
 def ensure_tenants_status_message_column(conn, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE tenants ADD COLUMN IF NOT EXISTS status_message TEXT DEFAULT ''")
@@ -51,6 +60,8 @@ def ensure_tenants_status_message_column(conn, cur):
             pass
 
 def ensure_tenants_plan_columns(conn, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE tenants ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'standard'")
@@ -88,6 +99,8 @@ def ensure_tenants_plan_columns(conn, cur):
             pass
 
 def ensure_admin_users_rbac_columns(conn, cur):
+    if schema_is_current():
+        return
     if is_postgres():
         try:
             cur.execute("ALTER TABLE admin_users ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'admin'")
@@ -135,57 +148,6 @@ def ensure_admin_users_rbac_columns(conn, cur):
         except Exception:
             pass
 
-def calculate_average_times(conn, slug):
-    """Calcula tiempos promedio de entrega/servicio basados en historial reciente (últimos 7 días)."""
-    avgs = {}
-    try:
-        cur = conn.cursor()
-        # Mapeo config key -> (order_type, target_status)
-        metrics = [
-            ('time_mesa', 'mesa', 'listo'),
-            ('time_espera', 'espera', 'listo'),
-            ('time_delivery', 'direccion', 'entregado')
-        ]
-        
-        limit_date = (datetime.utcnow() - timedelta(days=7)).isoformat()
-        
-        for cfg_key, otype, target_status in metrics:
-            # Buscamos pedidos completados recientemente
-            cur.execute(f"""
-                SELECT o.created_at, h.changed_at 
-                FROM orders o
-                JOIN order_status_history h ON o.id = h.order_id
-                WHERE o.tenant_slug = ? 
-                  AND o.order_type = ? 
-                  AND h.status = ?
-                  AND o.created_at >= ?
-            """, (slug, otype, target_status, limit_date))
-            
-            rows = cur.fetchall()
-            if not rows:
-                continue
-                
-            total_minutes = 0
-            count = 0
-            for r in rows:
-                try:
-                    start = datetime.fromisoformat(r[0])
-                    end = datetime.fromisoformat(r[1])
-                    diff = (end - start).total_seconds() / 60
-                    if 0 < diff < 180: # Filtrar anomalías (>3h)
-                        total_minutes += diff
-                        count += 1
-                except:
-                    pass
-            
-            if count > 0:
-                avgs[cfg_key] = round(total_minutes / count)
-                
-    except Exception as e:
-        print(f"Error calculating metrics: {e}")
-        
-    return avgs
-
 @bp.route('/tenant_header', methods=['GET', 'PATCH'])
 def get_tenant_header():
     slug = request.args.get('tenant_slug') or request.args.get('slug') or 'gastronomia-local1'
@@ -220,8 +182,7 @@ def get_tenant_header():
             current_cfg['location'] = payload['location_label']
             
         try:
-            cur.execute("INSERT OR REPLACE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)", 
-                       (slug, json.dumps(current_cfg, ensure_ascii=False)))
+            save_tenant_config(cur, slug, current_cfg)
             conn.commit()
             invalidate_tenant_config(slug)
             return jsonify({'ok': True})
@@ -229,8 +190,17 @@ def get_tenant_header():
             print(f"Error saving header: {e}")
             return jsonify({'error': 'error al guardar'}), 500
 
-    cfg = get_cached_tenant_config(slug)
-    
+    return _public_json('header', slug, _build_header)
+
+def _public_json(kind, slug, build):
+    """Storefront payload compiled once per config version, served with a strong ETag."""
+    body, etag = compiled_payload(kind, slug, lambda cfg: build(slug, cfg))
+    resp = current_app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = f'public, max-age={PUBLIC_MAX_AGE}, stale-while-revalidate={PUBLIC_STALE_WHILE_REVALIDATE}'
+    return resp.make_conditional(request)
+
+def _build_header(slug, cfg):
     # Fallback for nested config (legacy format support)
     meta_branding = cfg.get('meta', {}).get('branding', {})
     meta_contact = meta_branding.get('contact', {})
@@ -294,7 +264,7 @@ def get_tenant_header():
     timezone = str(cfg.get('timezone') or meta_contact.get('timezone') or 'America/Argentina/Mendoza').strip()
     currency_code = str(cfg.get('currency_code') or meta_contact.get('currency_code') or 'ARS').strip().upper()
     currency_locale = str(cfg.get('currency_locale') or meta_contact.get('currency_locale') or 'es-AR').strip()
-    return jsonify({
+    return {
         'name': cfg.get('name') or tenant_name or meta_branding.get('name', ''),
         'whatsapp': cfg.get('whatsapp') or meta_contact.get('whatsapp', ''),
         'instagram': cfg.get('instagram') or meta_contact.get('instagram', ''),
@@ -319,7 +289,7 @@ def get_tenant_header():
         'featured_bg_color': cfg.get('featured_bg_color', '#0c0c0c'),
         'menu_bg_color': cfg.get('menu_bg_color', '#0f0f0f'),
         'interest_bg_color': cfg.get('interest_bg_color', '#121212')
-    })
+    }
 
 @bp.route('/tenant_checkout', methods=['GET', 'PATCH'])
 def tenant_checkout():
@@ -362,10 +332,7 @@ def tenant_checkout():
         current_cfg['checkout'] = checkout
 
         try:
-            cur.execute(
-                "INSERT OR REPLACE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)",
-                (slug, json.dumps(current_cfg, ensure_ascii=False))
-            )
+            save_tenant_config(cur, slug, current_cfg)
             conn.commit()
             invalidate_tenant_config(slug)
             return jsonify({'ok': True, 'checkout': checkout})
@@ -377,15 +344,17 @@ def tenant_checkout():
                 pass
             return jsonify({'error': 'error al guardar'}), 500
 
-    cfg = get_cached_tenant_config(slug)
+    return _public_json('checkout', slug, _build_checkout)
+
+def _build_checkout(slug, cfg):
     checkout = cfg.get('checkout')
     if not isinstance(checkout, dict):
         checkout = {}
-    return jsonify({
+    return {
         'whatsappEnabled': bool(checkout.get('whatsappEnabled', True)),
         'whatsappNumber': str(checkout.get('whatsappNumber', '') or ''),
         'whatsappTemplate': str(checkout.get('whatsappTemplate', '') or '')
-    })
+    }
 
 @bp.route('/tenants', methods=['GET'])
 def get_tenants():
@@ -463,6 +432,8 @@ def master_get_tenants():
                     "INSERT INTO tenants (tenant_slug, name, contact_email, contact_phone, status, status_message, plan, max_users, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
                     (slug, name, None, None, status, status_message, plan or 'standard', int(max_users) if max_users is not None else 3, now)
                 )
+                # The storefront header falls back to tenants.name
+                touch_tenant_config(cur, slug)
             else:
                 if plan:
                     cur.execute("UPDATE tenants SET plan = ? WHERE tenant_slug = ?", (plan, slug))
@@ -476,6 +447,7 @@ def master_get_tenants():
             except Exception:
                 pass
             return jsonify({'error': 'no se pudo actualizar el comercio'}), 500
+        invalidate_tenant_config(slug)
         return jsonify({'ok': True, 'tenant_slug': slug, 'status': status, 'status_message': status_message, 'plan': plan or None, 'max_users': max_users})
 
     tenants_list = []
@@ -572,6 +544,8 @@ def create_demo_tenant():
         "INSERT OR IGNORE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)",
         (slug, json.dumps(default_cfg, ensure_ascii=False))
     )
+    # An existing config row keeps its JSON, but the header now has a tenants.name to fall back to
+    touch_tenant_config(cur, slug)
 
     ph = generate_password_hash(admin_password)
     try:
@@ -670,7 +644,7 @@ def update_tenant_tables():
     current_cfg['tables'] = payload
     
     try:
-        cur.execute("INSERT OR REPLACE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)", (slug, json.dumps(current_cfg, ensure_ascii=False)))
+        save_tenant_config(cur, slug, current_cfg)
         conn.commit()
         invalidate_tenant_config(slug)
     except Exception as e:
@@ -689,13 +663,14 @@ def get_tenant_sla():
     if j:
         sla_config = j.get('sla') or {}
         
-    # 2. Calculate Actual Averages (Metrics)
+    # 2. Current estimates (maintained on each status change)
     conn = get_db()
-    metrics = calculate_average_times(conn, slug)
+    stats = estimator.get_stats(conn.cursor(), slug)
     
     return jsonify({
         'config': sla_config,
-        'metrics': metrics
+        'metrics': {k: v['avg'] for k, v in stats.items() if v.get('avg')},
+        'estimates': stats
     })
 
 @bp.route('/tenant_prefs', methods=['GET'])
@@ -743,7 +718,7 @@ def update_tenant_prefs():
     current_cfg[section] = data
     
     try:
-        cur.execute("INSERT OR REPLACE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)", (slug, json.dumps(current_cfg, ensure_ascii=False)))
+        save_tenant_config(cur, slug, current_cfg)
         conn.commit()
         invalidate_tenant_config(slug)
     except Exception as e:
@@ -0,0 +1,321 @@
+"""Running sales and movement totals on cash_sessions.
+
+The cash widget polls the open session constantly; instead of re-aggregating
+orders, payment events and cash_movements on every read, each session row
+carries its totals and the writes keep them current in their own
+transaction:
+
+- cash movements (manual or from pay_order) bump entradas/salidas and the
+  per-method net amounts and counts of their session;
+- a payment bumps the sales of the payer's open user-scope session
+  (user sessions count what that user charged);
+- tenant-scope sessions count the orders delivered inside their window;
+  apply_order re-counts an order after any change to its status, total, tip
+  or delivered_at, remembering in orders.cash_session_id/cash_state what it
+  currently adds so only the difference is applied.
+
+compute() derives the same totals from the source tables; reconcile() (and
+reconcile_cash_sessions.py) rewrites sessions whose stored totals drifted.
+"""
+import json
+from datetime import datetime
+from flask import current_app
+from app.database import is_postgres
+from app.cold_archive import tiers
+
+# Migration that added the running totals
+CASH_TOTALS_SCHEMA_VERSION = 13
+
+METHOD_BUCKETS = ('efectivo', 'pos', 'transferencia', 'otros')
+SALES_COLUMNS = ('delivered_count', 'base_delivered_total', 'tip_total', 'shipping_total')
+# Sessions per compute_many call (reconcile, CSV export)
+SESSION_BATCH = 200
+TOTAL_COLUMNS = SALES_COLUMNS + ('entradas', 'salidas') + tuple(f"net_{b}" for b in METHOD_BUCKETS) + tuple(f"count_{b}" for b in METHOD_BUCKETS)
+
+
+def cash_totals_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= CASH_TOTALS_SCHEMA_VERSION
+
+
+def method_bucket(payment_method):
+    pm = str(payment_method or '').strip().lower()
+    if 'pos' in pm or 'qr' in pm or 'tarjeta' in pm:
+        return 'pos'
+    if 'transferencia' in pm:
+        return 'transferencia'
+    if 'otros' in pm:
+        return 'otros'
+    return 'efectivo'
+
+
+def _payment_amounts(payload_json):
+    try:
+        meta = json.loads(payload_json) if payload_json else {}
+        return int(meta.get('amount') or 0), int(meta.get('tip') or 0)
+    except Exception:
+        return 0, 0
+
+
+def compute_many(cur, sessions):
+    """{session id: totals} from the source tables, in a constant number of queries.
+
+    sessions are dicts with id, scope and opened_at; open sessions run until now.
+    Sales come from range joins of cash_sessions against orders (tenant scope,
+    by delivered_at) or payment events (user scope, by payer and created_at).
+    """
+    out = {int(s['id']): {c: 0 for c in TOTAL_COLUMNS} for s in sessions}
+    if not out:
+        return out
+    now = datetime.utcnow().isoformat()
+    since = min(str(s['opened_at']) for s in sessions)
+    placeholders = ", ".join(['?'] * len(out))
+    ids = list(out)
+
+    cur.execute(
+        "SELECT session_id, type, payment_method, SUM(amount), COUNT(*) FROM cash_movements "
+        f"WHERE session_id IN ({placeholders}) GROUP BY session_id, type, payment_method",
+        ids,
+    )
+    for r in cur.fetchall() or []:
+        if r[1] not in ('entrada', 'salida'):
+            continue
+        totals = out[int(r[0])]
+        bucket = method_bucket(r[2])
+        amt = int(r[3] or 0)
+        totals['entradas' if r[1] == 'entrada' else 'salidas'] += amt
+        totals[f"net_{bucket}"] += amt if r[1] == 'entrada' else -amt
+        totals[f"count_{bucket}"] += int(r[4] or 0)
+
+    tenant_ids = [int(s['id']) for s in sessions if str(s.get('scope') or 'tenant') != 'user']
+    user_ids = [int(s['id']) for s in sessions if str(s.get('scope') or 'tenant') == 'user']
+    for sfx in tiers(since):
+        if tenant_ids:
+            cur.execute(
+                "SELECT s.id, COUNT(*), COALESCE(SUM(o.total),0), COALESCE(SUM(COALESCE(o.tip_amount, 0)),0), COALESCE(SUM(COALESCE(o.shipping_cost, 0)),0) "
+                f"FROM cash_sessions s JOIN orders{sfx} o ON o.tenant_slug = s.tenant_slug AND o.status = 'entregado' "
+                "AND o.delivered_at >= s.opened_at AND o.delivered_at <= COALESCE(s.closed_at, ?) "
+                f"WHERE s.id IN ({', '.join(['?'] * len(tenant_ids))}) GROUP BY s.id",
+                [now] + tenant_ids,
+            )
+            for r in cur.fetchall() or []:
+                totals = out[int(r[0])]
+                for i, c in enumerate(SALES_COLUMNS):
+                    totals[c] += int(r[i + 1] or 0)
+        if user_ids:
+            cur.execute(
+                "SELECT s.id, e.order_id, e.payload_json, COALESCE(o.shipping_cost, 0) "
+                f"FROM cash_sessions s JOIN order_events{sfx} e ON e.event_type = 'payment' AND lower(e.actor) = lower(COALESCE(s.opened_by, '')) "
+                "AND e.created_at >= s.opened_at AND e.created_at <= COALESCE(s.closed_at, ?) "
+                f"JOIN orders{sfx} o ON o.id = e.order_id AND o.tenant_slug = s.tenant_slug "
+                f"WHERE s.id IN ({', '.join(['?'] * len(user_ids))})",
+                [now] + user_ids,
+            )
+            seen = set()
+            for r in cur.fetchall() or []:
+                totals = out[int(r[0])]
+                amount, tip = _payment_amounts(r[2])
+                totals['base_delivered_total'] += amount
+                totals['tip_total'] += tip
+                totals['shipping_total'] += int(r[3] or 0)
+                if (int(r[0]), r[1]) not in seen:
+                    seen.add((int(r[0]), r[1]))
+                    totals['delivered_count'] += 1
+    return out
+
+
+def compute(cur, sess):
+    """Totals of one session from the source tables."""
+    return compute_many(cur, [sess])[int(sess['id'])]
+
+
+def stored_many(cur, session_ids):
+    if not session_ids:
+        return {}
+    cur.execute(
+        f"SELECT id, {', '.join(TOTAL_COLUMNS)} FROM cash_sessions WHERE id IN ({', '.join(['?'] * len(session_ids))})",
+        list(session_ids),
+    )
+    return {int(r[0]): {c: int(r[i + 1] or 0) for i, c in enumerate(TOTAL_COLUMNS)} for r in (cur.fetchall() or [])}
+
+
+def page_totals(cur, sessions):
+    """{session id: totals} for a page of sessions: the maintained columns, or computed before migration 13."""
+    if cash_totals_ready():
+        return stored_many(cur, [int(s['id']) for s in sessions])
+    return compute_many(cur, sessions)
+
+
+def session_totals(cur, sess):
+    return page_totals(cur, [sess]).get(int(sess['id'])) or {c: 0 for c in TOTAL_COLUMNS}
+
+
+def summary(totals, opening_amount):
+    """The 'summary' fields the cash endpoints return, from a totals dict."""
+    opening_amount = int(opening_amount or 0)
+    breakdown = {b: totals[f"net_{b}"] for b in METHOD_BUCKETS}
+    breakdown['efectivo'] += opening_amount
+    return {
+        'delivered_count': totals['delivered_count'],
+        'delivered_total': totals['base_delivered_total'] + totals['tip_total'],
+        'base_delivered_total': totals['base_delivered_total'],
+        'tip_total': totals['tip_total'],
+        'shipping_total': totals['shipping_total'],
+        'entradas': totals['entradas'],
+        'salidas': totals['salidas'],
+        'theoretical_cash': opening_amount + totals['entradas'] - totals['salidas'],
+        'theoretical_breakdown': breakdown,
+        'theoretical_breakdown_counts': {b: totals[f"count_{b}"] for b in METHOD_BUCKETS},
+    }
+
+
+def _bump(cur, session_id, deltas, sign=1):
+    cols = [c for c in TOTAL_COLUMNS if deltas.get(c)]
+    if not cols or not session_id:
+        return
+    cur.execute(
+        f"UPDATE cash_sessions SET {', '.join(f'{c} = {c} + ?' for c in cols)} WHERE id = ?",
+        [sign * int(deltas[c]) for c in cols] + [session_id],
+    )
+
+
+def record_movement(cur, session_id, mtype, amount, payment_method):
+    """Count a cash_movements row just inserted for session_id."""
+    if not cash_totals_ready() or mtype not in ('entrada', 'salida'):
+        return
+    amount = int(amount or 0)
+    bucket = method_bucket(payment_method)
+    _bump(cur, session_id, {
+        'entradas' if mtype == 'entrada' else 'salidas': amount,
+        f"net_{bucket}": amount if mtype == 'entrada' else -amount,
+        f"count_{bucket}": 1,
+    })
+
+
+def record_payment(cur, order_id, tenant_slug, actor, amount, tip, created_at):
+    """Count a payment event in the payer's user-scope session whose window holds created_at."""
+    if not cash_totals_ready():
+        return
+    cur.execute(
+        "SELECT id FROM cash_sessions WHERE tenant_slug = ? AND scope = 'user' AND lower(opened_by) = lower(?) "
+        "AND opened_at <= ? AND (closed_at IS NULL OR closed_at >= ?) ORDER BY opened_at DESC LIMIT 1",
+        (tenant_slug, actor or '', created_at, created_at),
+    )
+    row = cur.fetchone()
+    if not row:
+        return
+    cur.execute("SELECT COALESCE(shipping_cost, 0) FROM orders WHERE id = ?", (order_id,))
+    ship = cur.fetchone()
+    _bump(cur, row[0], {
+        'delivered_count': 1,
+        'base_delivered_total': int(amount or 0),
+        'tip_total': int(tip or 0),
+        'shipping_total': int((ship[0] if ship else 0) or 0),
+    })
+
+
+def _tenant_session_at(cur, tenant_slug, ts):
+    cur.execute(
+        "SELECT id FROM cash_sessions WHERE tenant_slug = ? AND scope = 'tenant' "
+        "AND opened_at <= ? AND (closed_at IS NULL OR closed_at >= ?) ORDER BY opened_at DESC LIMIT 1",
+        (tenant_slug, ts, ts),
+    )
+    row = cur.fetchone()
+    return int(row[0]) if row else None
+
+
+def apply_order(cur, order_id):
+    """Re-count a (hot) order in the tenant-scope session its delivery falls in. The caller commits."""
+    if not cash_totals_ready():
+        return
+    # Hold the row so a concurrent reconcile() can't re-point cash_state between this read and the update
+    lock = " FOR UPDATE" if is_postgres() else ""
+    cur.execute(
+        f"SELECT tenant_slug, status, total, tip_amount, shipping_cost, delivered_at, cash_session_id, cash_state FROM orders WHERE id = ?{lock}",
+        (order_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return
+    sid, state = None, None
+    if row[1] == 'entregado' and row[5]:
+        sid = _tenant_session_at(cur, row[0], row[5])
+        if sid:
+            state = json.dumps([int(row[2] or 0), int(row[3] or 0), int(row[4] or 0)])
+    old_sid = int(row[6]) if row[6] else None
+    if (sid, state) == (old_sid, row[7] or None):
+        return
+    if old_sid and row[7]:
+        try:
+            _bump(cur, old_sid, _sales_deltas(json.loads(row[7])), -1)
+        except Exception as e:
+            print(f"Cash state of order {order_id} ignored: {e}")
+    if sid:
+        _bump(cur, sid, _sales_deltas(json.loads(state)))
+    cur.execute("UPDATE orders SET cash_session_id = ?, cash_state = ? WHERE id = ?", (sid, state, order_id))
+
+
+def _sales_deltas(values):
+    total, tip, shipping = values
+    return {'delivered_count': 1, 'base_delivered_total': total, 'tip_total': tip, 'shipping_total': shipping}
+
+
+def reconcile(cur, session_id=None, tenant_slug=None, dry_run=False):
+    """Recompute sessions from source and rewrite the ones that drifted.
+
+    Returns [(session id, {column: (stored, computed)})] for the drifted
+    sessions. For tenant-scope sessions the orders' cash_session_id/cash_state
+    are re-pointed too, so later apply_order calls stay exact.
+
+    On PostgreSQL the sessions are locked FOR UPDATE before anything is
+    computed: payments, movements and order re-counts already in flight commit
+    first, later ones wait on _bump until this transaction commits, so none
+    is overwritten by the absolute UPDATE below.
+    """
+    sql = "SELECT id, tenant_slug, scope, opened_at, opened_by, closed_at FROM cash_sessions WHERE 1 = 1"
+    params = []
+    if session_id:
+        sql += " AND id = ?"
+        params.append(session_id)
+    if tenant_slug:
+        sql += " AND tenant_slug = ?"
+        params.append(tenant_slug)
+    sql += " ORDER BY id"
+    if is_postgres() and not dry_run:
+        sql += " FOR UPDATE"
+    cur.execute(sql, params)
+    sessions = [dict(zip(('id', 'tenant_slug', 'scope', 'opened_at', 'opened_by', 'closed_at'), r)) for r in (cur.fetchall() or [])]
+    drifted = []
+    for i in range(0, len(sessions), SESSION_BATCH):
+        chunk = sessions[i:i + SESSION_BATCH]
+        computed_by_id = compute_many(cur, chunk)
+        stored_by_id = stored_many(cur, [s['id'] for s in chunk])
+        for sess in chunk:
+            computed = computed_by_id[int(sess['id'])]
+            have = stored_by_id.get(int(sess['id'])) or {}
+            diff = {c: (have.get(c, 0), computed[c]) for c in TOTAL_COLUMNS if have.get(c, 0) != computed[c]}
+            if diff:
+                drifted.append((sess['id'], diff))
+            if dry_run:
+                continue
+            if diff:
+                cur.execute(
+                    f"UPDATE cash_sessions SET {', '.join(f'{c} = ?' for c in TOTAL_COLUMNS)} WHERE id = ?",
+                    [computed[c] for c in TOTAL_COLUMNS] + [sess['id']],
+                )
+            if str(sess['scope'] or 'tenant') != 'user':
+                _repoint_orders(cur, sess)
+    return drifted
+
+
+def _repoint_orders(cur, sess):
+    end_at = sess.get('closed_at') or datetime.utcnow().isoformat()
+    cur.execute("UPDATE orders SET cash_session_id = NULL, cash_state = NULL WHERE cash_session_id = ?", (sess['id'],))
+    cur.execute(
+        "SELECT id, total, tip_amount, shipping_cost FROM orders "
+        "WHERE tenant_slug = ? AND status = 'entregado' AND delivered_at >= ? AND delivered_at <= ?",
+        (sess['tenant_slug'], sess['opened_at'], end_at),
+    )
+    cur.executemany(
+        "UPDATE orders SET cash_session_id = ?, cash_state = ? WHERE id = ?",
+        [(sess['id'], json.dumps([int(r[1] or 0), int(r[2] or 0), int(r[3] or 0)]), r[0]) for r in (cur.fetchall() or [])],
+    )
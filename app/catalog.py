@@ -0,0 +1,192 @@
+"""Per-tenant product catalog snapshots, serialised once per catalog version.
+
+Every write that changes what /api/products returns (product create, update
+and delete, stock reserved by an order, config seeding) calls bump() in its
+own transaction. bump advances catalog_versions.version for the tenant and
+stamps the touched products with it, so readers can tell both whether their
+copy is current and which rows moved since a given version.
+
+A read costs one primary-key lookup of the version; while it matches, the
+response is the cached JSON bytes (plus gzip, and brotli when the module is
+importable) with a strong ETag and Last-Modified, and a matching conditional
+request gets a 304 without touching the products table. Only the first reader
+after a bump rebuilds the snapshot; the others wait for it.
+"""
+import os
+import gzip
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from flask import current_app
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    brotli = None
+    HAS_BROTLI = False
+
+# Migration that created catalog_versions and products.catalog_version
+CATALOG_SCHEMA_VERSION = 16
+
+CATALOG_CACHE_MAX = int(os.environ.get('CATALOG_CACHE_MAX', '512') or '512')
+# Bodies smaller than this are sent as-is; compressing them saves nothing
+CATALOG_COMPRESS_MIN_BYTES = int(os.environ.get('CATALOG_COMPRESS_MIN_BYTES', '1024') or '1024')
+
+PRODUCT_COLUMNS = "product_id, name, price, stock, active, COALESCE(details,'') as details, COALESCE(variants_json,'') as variants_json, COALESCE(last_modified, '') as last_modified, COALESCE(image_url, '') as image_url"
+
+# (tenant_slug, include_inactive) -> snapshot dict, least recently used first
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+# Same keys; held by the thread rebuilding that snapshot
+_build_locks = {}
+
+
+def catalog_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= CATALOG_SCHEMA_VERSION
+
+
+def create_catalog_tables(cur, pg):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            tenant_slug TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_catalog_version ON products(tenant_slug, catalog_version)")
+
+
+def bump(cur, tenant_slug, product_ids=None):
+    """Advance the tenant's catalog version and stamp product_ids with it (all its products when None).
+
+    Returns the new version, or None before the migration. The caller commits;
+    like record_order_change, the UPDATE row-locks the counter until then.
+    """
+    tenant_slug = str(tenant_slug or '')
+    if not tenant_slug or not catalog_ready():
+        return None
+    now = datetime.utcnow().isoformat()
+    cur.execute("INSERT OR IGNORE INTO catalog_versions (tenant_slug, version, updated_at) VALUES (?, 0, ?)", (tenant_slug, now))
+    cur.execute("UPDATE catalog_versions SET version = version + 1, updated_at = ? WHERE tenant_slug = ?", (now, tenant_slug))
+    cur.execute("SELECT version FROM catalog_versions WHERE tenant_slug = ?", (tenant_slug,))
+    row = cur.fetchone()
+    version = int(row[0] or 0) if row else 0
+    if product_ids is None:
+        cur.execute("UPDATE products SET catalog_version = ? WHERE tenant_slug = ?", (version, tenant_slug))
+    elif product_ids:
+        ids = list(product_ids)
+        cur.execute(
+            f"UPDATE products SET catalog_version = ? WHERE tenant_slug = ? AND product_id IN ({', '.join(['?'] * len(ids))})",
+            [version, tenant_slug] + ids,
+        )
+    return version
+
+
+def current_version(cur, tenant_slug):
+    """(version, updated_at) of the tenant's catalog; (0, None) before its first bump."""
+    cur.execute("SELECT version, updated_at FROM catalog_versions WHERE tenant_slug = ?", (tenant_slug,))
+    row = cur.fetchone()
+    return (int(row[0] or 0), row[1]) if row else (0, None)
+
+
+def product_items(rows):
+    # Deduplicate by product_id
+    seen_ids = set()
+    items = []
+    for r in rows:
+        pid = r[0]
+        if pid not in seen_ids:
+            seen_ids.add(pid)
+            items.append({
+                'id': pid,
+                'name': r[1],
+                'price': int(r[2] or 0),
+                'stock': int(r[3] or 0),
+                'active': bool(r[4]),
+                'details': r[5] or '',
+                'variants': r[6] or '',
+                'last_modified': r[7] or '',
+                'image_url': r[8] or ''
+            })
+    return items
+
+
+def load_products(cur, tenant_slug, include_inactive=False):
+    query = f"SELECT {PRODUCT_COLUMNS} FROM products WHERE tenant_slug = ?"
+    if not include_inactive:
+        query += " AND active = 1"
+    # product_id breaks name ties so a rebuild of the same rows yields the same bytes (and ETag)
+    query += " ORDER BY name ASC, product_id ASC"
+    cur.execute(query, (tenant_slug,))
+    return product_items(cur.fetchall() or [])
+
+
+def snapshot(cur, tenant_slug, include_inactive=False):
+    """The tenant's catalog as a dict: version, body (JSON bytes), gzip, br (or None), etag, last_modified.
+
+    The version is read before the products, so a write landing in between
+    only makes the snapshot newer than its version, and the next read rebuilds it.
+    """
+    key = (tenant_slug, bool(include_inactive))
+    version, updated_at = current_version(cur, tenant_slug)
+    with _snapshots_lock:
+        snap = _snapshots.get(key)
+        if snap is not None and snap['version'] == version:
+            _snapshots.move_to_end(key)
+            return snap
+        lock = _build_locks.setdefault(key, threading.Lock())
+    with lock:
+        with _snapshots_lock:
+            snap = _snapshots.get(key)
+        # Rebuilt by the thread we waited for
+        if snap is not None and snap['version'] == version:
+            return snap
+        snap = _build(cur, tenant_slug, include_inactive, version, updated_at)
+        with _snapshots_lock:
+            _snapshots[key] = snap
+            _snapshots.move_to_end(key)
+            while len(_snapshots) > CATALOG_CACHE_MAX:
+                old, _ = _snapshots.popitem(last=False)
+                _build_locks.pop(old, None)
+        return snap
+
+
+def _build(cur, tenant_slug, include_inactive, version, updated_at):
+    payload = {'products': load_products(cur, tenant_slug, include_inactive), 'tenant_slug': tenant_slug, 'version': version}
+    body = current_app.json.response(payload).get_data()
+    large = len(body) >= CATALOG_COMPRESS_MIN_BYTES
+    last_modified = None
+    if updated_at:
+        try:
+            last_modified = datetime.fromisoformat(str(updated_at))
+        except ValueError:
+            last_modified = None
+    return {
+        'version': version,
+        'body': body,
+        'gzip': gzip.compress(body, 6, mtime=0) if large else None,
+        'br': brotli.compress(body) if large and HAS_BROTLI else None,
+        'etag': hashlib.sha1(body).hexdigest(),
+        'last_modified': last_modified,
+    }
+
+
+def changes_since(cur, tenant_slug, since):
+    """Return (version, products, reset): every product, active or not, stamped after since.
+
+    reset means since is ahead of the tenant's version (the database was
+    restored or the client is confused) and the client should reload in full.
+    """
+    version = current_version(cur, tenant_slug)[0]
+    if since >= version:
+        return version, [], since > version
+    cur.execute(
+        f"SELECT {PRODUCT_COLUMNS} FROM products WHERE tenant_slug = ? AND catalog_version > ? ORDER BY name ASC, product_id ASC",
+        (tenant_slug, since),
+    )
+    return version, product_items(cur.fetchall() or []), False
+
@@ -0,0 +1,148 @@
+"""Per-tenant order change feed.
+
+Every order write bumps tenant_versions.orders_version inside its own
+transaction and appends (version, order_id, event) to order_changes. Clients
+keep the last version they saw and ask for the changes after it, either as a
+long-poll (/api/orders/changes) or as Server-Sent Events (/api/orders/stream),
+and only refetch orders when something actually changed.
+"""
+import os
+import json
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import after_this_request, current_app, has_request_context
+
+# Migration that created tenant_versions / order_changes
+FEED_SCHEMA_VERSION = 6
+
+# Waiters re-read the version at least this often, so writes committed by other
+# processes (or by background tasks without a request) are still picked up
+FEED_POLL_SECONDS = float(os.environ.get('ORDER_FEED_POLL_SECONDS', '1') or '1')
+FEED_MAX_CHANGES = 200
+ORDER_CHANGES_KEEP_HOURS = int(os.environ.get('ORDER_CHANGES_KEEP_HOURS', '48') or '48')
+
+# Long-polls and streams each hold a Waitress thread, of which there are few
+FEED_MAX_WAITERS = int(os.environ.get('ORDER_FEED_MAX_WAITERS') or max(1, int(os.environ.get('WAITRESS_THREADS', '6') or '6') // 3))
+_waiters = threading.BoundedSemaphore(FEED_MAX_WAITERS)
+
+_changed = threading.Condition()
+
+
+def record_order_change(cur, tenant_slug, order_id, event):
+    """Bump the tenant's orders_version and log the change. The caller commits.
+
+    The UPDATE row-locks the tenant's counter until commit, so versions become
+    visible in the same order they were handed out.
+    """
+    tenant_slug = str(tenant_slug or '')
+    if not tenant_slug or int(current_app.config.get('SCHEMA_VERSION') or 0) < FEED_SCHEMA_VERSION:
+        # Order writes must not fail because the feed tables are missing
+        return None
+    cur.execute("INSERT OR IGNORE INTO tenant_versions (tenant_slug, orders_version) VALUES (?, 0)", (tenant_slug,))
+    cur.execute("UPDATE tenant_versions SET orders_version = orders_version + 1 WHERE tenant_slug = ?", (tenant_slug,))
+    cur.execute("SELECT orders_version FROM tenant_versions WHERE tenant_slug = ?", (tenant_slug,))
+    row = cur.fetchone()
+    version = int(row[0] or 0) if row else 0
+    cur.execute(
+        "INSERT INTO order_changes (tenant_slug, version, order_id, event, created_at) VALUES (?, ?, ?, ?, ?)",
+        (tenant_slug, version, order_id, event, datetime.utcnow().isoformat()),
+    )
+    if has_request_context():
+        @after_this_request
+        def _wake(response):
+            notify()
+            return response
+    return version
+
+
+def notify():
+    with _changed:
+        _changed.notify_all()
+
+
+def current_version(cur, tenant_slug):
+    cur.execute("SELECT orders_version FROM tenant_versions WHERE tenant_slug = ?", (tenant_slug,))
+    row = cur.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def orders_etag(cur, tenant_slug, *parts):
+    """Validator for a tenant-scoped order read, or None when the feed tables are missing.
+
+    Read the version before the data: a write landing in between only makes the
+    tag older than the body, never newer.
+    """
+    if int(current_app.config.get('SCHEMA_VERSION') or 0) < FEED_SCHEMA_VERSION:
+        return None
+    key = json.dumps([tenant_slug, current_version(cur, tenant_slug)] + [str(p) for p in parts])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def changes_since(cur, tenant_slug, since, order_id=None, limit=FEED_MAX_CHANGES):
+    """Return (version, changes, reset). reset means the log no longer reaches back to since."""
+    version = current_version(cur, tenant_slug)
+    if since >= version:
+        return version, [], since > version
+    sql = "SELECT version, order_id, event, created_at FROM order_changes WHERE tenant_slug = ? AND version > ?"
+    params = [tenant_slug, since]
+    if order_id is not None:
+        sql += " AND order_id = ?"
+        params.append(order_id)
+    sql += " ORDER BY version ASC LIMIT ?"
+    params.append(limit + 1)
+    cur.execute(sql, params)
+    rows = cur.fetchall() or []
+    reset = len(rows) > limit
+    if order_id is None and not reset:
+        # Pruned log: the oldest retained entry must directly follow since
+        first = int(rows[0][0]) if rows else version + 1
+        reset = first > since + 1
+    changes = [
+        {'version': int(r[0]), 'order_id': r[1], 'event': r[2], 'created_at': r[3]}
+        for r in rows[:limit]
+    ]
+    return version, changes, reset
+
+
+def wait_for_version(conn, tenant_slug, since, timeout):
+    """Block until the tenant's version passes since or timeout expires; returns the version."""
+    cur = conn.cursor()
+    deadline = time.time() + max(0.0, timeout)
+    while True:
+        version = current_version(cur, tenant_slug)
+        # Don't sit idle inside a transaction (Postgres) between checks
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        remaining = deadline - time.time()
+        if version != since or remaining <= 0:
+            return version
+        with _changed:
+            _changed.wait(min(FEED_POLL_SECONDS, remaining))
+
+
+def acquire_waiter():
+    return _waiters.acquire(blocking=False)
+
+
+def release_waiter():
+    try:
+        _waiters.release()
+    except ValueError:
+        pass
+
+
+def prune_order_changes(conn):
+    cutoff = (datetime.utcnow() - timedelta(hours=ORDER_CHANGES_KEEP_HOURS)).isoformat()
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM order_changes WHERE created_at < ?", (cutoff,))
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
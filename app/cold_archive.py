@@ -0,0 +1,159 @@
+"""Cold tier for archived orders.
+
+Orders archived more than ARCHIVE_COLD_AFTER_DAYS ago (0 disables the move)
+are moved, together with their items, status history and events, from the
+live tables into the *_archive tables (same columns, no triggers, fewer
+indexes). The live tables then only hold recent orders, which keeps the
+boards, the cash views and the metrics working on a set that fits in cache.
+
+Readers that can reach old data ask tiers(since) for the table suffixes to
+read ('' for the live tables, '_archive' for the cold ones) and combine the
+per-tier results; a time range that starts inside the hot window never
+touches the cold tier.
+"""
+import os
+import heapq
+from datetime import datetime, timedelta
+from flask import current_app
+from app.database import is_postgres
+
+# Migration that created the *_archive tables
+COLD_SCHEMA_VERSION = 11
+
+ARCHIVE_COLD_AFTER_DAYS = int(os.environ.get('ARCHIVE_COLD_AFTER_DAYS', '180') or '180')
+ARCHIVE_COLD_BATCH = int(os.environ.get('ARCHIVE_COLD_BATCH', '500') or '500')
+
+COLD_SUFFIX = '_archive'
+# (live table, column holding the order id); orders goes last so children move first
+COLD_TABLES = (
+    ('order_items', 'order_id'),
+    ('order_status_history', 'order_id'),
+    ('order_events', 'order_id'),
+    ('orders', 'id'),
+)
+
+
+def cold_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= COLD_SCHEMA_VERSION
+
+
+def hot_horizon():
+    """Every order in the cold tier was archived before this instant."""
+    return (datetime.utcnow() - timedelta(days=max(0, ARCHIVE_COLD_AFTER_DAYS))).isoformat()
+
+
+def tiers(since=None):
+    """Table suffixes a query starting at since (None: all time) has to read."""
+    if not cold_ready():
+        return ('',)
+    if since and ARCHIVE_COLD_AFTER_DAYS > 0 and str(since) >= hot_horizon():
+        return ('',)
+    return ('', COLD_SUFFIX)
+
+
+def fetch_tiers(cur, parts, limit=None, offset=0, ranked=False):
+    """Run one (sql, params) per tier and merge the rows.
+
+    Each part must already be ordered by its first column (the order id)
+    descending; ranked parts are concatenated in tier order instead. With a
+    limit each tier only returns what the merged page can use.
+    """
+    if len(parts) == 1:
+        sql, params = parts[0]
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params = list(params) + [limit, offset]
+        cur.execute(sql, params)
+        return cur.fetchall() or []
+    results = []
+    for sql, params in parts:
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = list(params) + [limit + offset]
+        cur.execute(sql, params)
+        results.append(cur.fetchall() or [])
+    if ranked:
+        rows = [r for tier in results for r in tier]
+    else:
+        rows = list(heapq.merge(*results, key=lambda r: r[0], reverse=True))
+    if limit is None:
+        return rows[offset:]
+    return rows[offset:offset + limit]
+
+
+def sum_tiers(cur, parts):
+    """Add up the single value (a COUNT or SUM) each tier's query returns."""
+    total = 0
+    for sql, params in parts:
+        cur.execute(sql, params)
+        row = cur.fetchone()
+        total += int((row[0] if row else 0) or 0)
+    return total
+
+
+def _columns(cur, pg, table):
+    """[(name, declared type)] in table order."""
+    if pg:
+        cur.execute(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position",
+            (table,),
+        )
+        return [(r[0], r[1]) for r in (cur.fetchall() or [])]
+    cur.execute(f"PRAGMA table_info({table})")
+    return [(r[1], r[2] or '') for r in (cur.fetchall() or [])]
+
+
+def create_cold_tables(cur, pg):
+    for table, key in COLD_TABLES:
+        cold = table + COLD_SUFFIX
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {cold} AS SELECT * FROM {table} WHERE 1 = 0")
+        if key == 'id':
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{cold}_id ON {cold}(id)")
+        else:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{cold}_order ON {cold}(order_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_tenant_id ON orders_archive(tenant_slug, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_tenant_delivered ON orders_archive(tenant_slug, delivered_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_tenant_canceled ON orders_archive(tenant_slug, canceled_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_events_archive_created ON order_events_archive(created_at)")
+    if pg:
+        # archived_orders keeps pointing at orders once they leave the live table
+        cur.execute("ALTER TABLE archived_orders DROP CONSTRAINT IF EXISTS archived_orders_order_id_fkey")
+        try:
+            cur.execute("SAVEPOINT cold_trgm")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_search_trgm ON orders_archive USING gin (search_text gin_trgm_ops)")
+            cur.execute("RELEASE SAVEPOINT cold_trgm")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT cold_trgm")
+            print(f"pg_trgm not available for orders_archive: {e}")
+
+
+def sync_cold_columns(cur, pg):
+    """Add columns the live tables gained after the cold tables were created."""
+    for table, _ in COLD_TABLES:
+        cold = table + COLD_SUFFIX
+        have = {name for name, _ in _columns(cur, pg, cold)}
+        for name, ddl in _columns(cur, pg, table):
+            if name not in have:
+                cur.execute(f"ALTER TABLE {cold} ADD COLUMN {name} {ddl or 'TEXT'}")
+
+
+def move_batch(cur, cutoff, batch=ARCHIVE_COLD_BATCH):
+    """Move up to batch orders archived before cutoff into the cold tier; returns how many."""
+    pg = is_postgres()
+    cur.execute(
+        "SELECT DISTINCT a.order_id FROM archived_orders a JOIN orders o ON o.id = a.order_id "
+        "WHERE a.archived_at <= ? ORDER BY a.order_id LIMIT ?",
+        (cutoff, batch),
+    )
+    ids = [int(r[0]) for r in (cur.fetchall() or [])]
+    if not ids:
+        return 0
+    placeholders = ", ".join(['?'] * len(ids))
+    for table, key in COLD_TABLES:
+        cols = ", ".join(name for name, _ in _columns(cur, pg, table))
+        cur.execute(
+            f"INSERT INTO {table}{COLD_SUFFIX} ({cols}) SELECT {cols} FROM {table} WHERE {key} IN ({placeholders})",
+            ids,
+        )
+        cur.execute(f"DELETE FROM {table} WHERE {key} IN ({placeholders})", ids)
+    return len(ids)
@@ -1,6 +1,14 @@
 import os
+import re
 import sqlite3
 import json
+import functools
+import itertools
+import hashlib
+import threading
+from types import MappingProxyType
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from flask import g, current_app
 from werkzeug.security import generate_password_hash
 
@@ -16,6 +24,49 @@ except ImportError:
 # Global connection pool
 pg_pool = None
 
+SQL_TRANSLATION_CACHE_SIZE = 512
+
+# Tables without a serial id column: INSERTs into them get no RETURNING id
+NO_ID_TABLES = {'tenant_config', 'tenant_counters', 'schema_migrations', 'config_seed_state', 'tenant_versions', 'prep_time_stats', 'task_leases', 'order_rollups', 'catalog_versions'}
+_INSERT_TARGET_RE = re.compile(r"\s*INSERT\s+(?:OR\s+\w+\s+)?INTO\s+(\w+)", re.IGNORECASE)
+
+# Opt-in: PREPARE hot statements server-side on each pooled connection
+PG_PREPARE_HOT = str(os.environ.get('PG_PREPARE_HOT') or '').strip().lower() in ('1', 'true', 'yes')
+PG_PREPARE_THRESHOLD = int(os.environ.get('PG_PREPARE_THRESHOLD') or 3)
+PG_PREPARE_MAX_PER_CONN = int(os.environ.get('PG_PREPARE_MAX_PER_CONN') or 64)
+_PREPARABLE_PREFIXES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+_STATEMENT_HITS_MAX = 2048
+_statement_hits = {}
+_unpreparable = set()
+
+# Rows per round trip when exports stream a result (iter_rows)
+EXPORT_FETCH_ROWS = int(os.environ.get('EXPORT_FETCH_ROWS') or 500)
+_export_cursor_ids = itertools.count(1)
+
+# SQLite: per-thread connections, capped at the Waitress thread count (+ background tasks)
+# plus the report worker threads (app.reports), which keep theirs between jobs
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or (
+    int(os.environ.get('WAITRESS_THREADS', '6') or '6') + 2 + int(os.environ.get('REPORT_WORKERS', '2') or '2')
+))
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA temp_store=MEMORY",
+)
+_sqlite_local = threading.local()
+_sqlite_lock = threading.Lock()
+_sqlite_open = [0]
+
+if HAS_PSYCOPG2:
+    class PreparingConnection(psycopg2.extensions.connection):
+        """Connection that remembers the statements it has PREPAREd (sql -> name)."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = {}
+
 def init_pool(database_url=None):
     global pg_pool
     if pg_pool is None and HAS_PSYCOPG2:
@@ -23,18 +74,29 @@ def init_pool(database_url=None):
             database_url = os.environ.get('DATABASE_URL')
         if database_url and (database_url.startswith('postgres://') or database_url.startswith('postgresql://')):
             try:
-                pg_pool = psycopg2.pool.ThreadedConnectionPool(1, 20, database_url)
-                print("PostgreSQL Connection Pool initialized.")
+                kwargs = {'connection_factory': PreparingConnection} if PG_PREPARE_HOT else {}
+                pg_pool = psycopg2.pool.ThreadedConnectionPool(1, 20, database_url, **kwargs)
+                print(f"PostgreSQL Connection Pool initialized (prepared hot statements: {'on' if PG_PREPARE_HOT else 'off'}).")
             except Exception as e:
                 print(f"Error initializing connection pool: {e}")
 
+@functools.lru_cache(maxsize=256)
+def _column_map(names):
+    # One read-only {name: index} map per distinct result shape, shared by every row
+    return MappingProxyType({n: i for i, n in enumerate(names)})
+
+def column_map_for(description):
+    return _column_map(tuple(d[0] for d in description or ()))
+
 class PostgresRow:
-    def __init__(self, cursor, row):
+    __slots__ = ('_row', '_col_map')
+
+    def __init__(self, col_map, row):
         self._row = row
-        self._col_map = {d[0]: i for i, d in enumerate(cursor.description)}
+        self._col_map = col_map
 
     def __getitem__(self, item):
-        if isinstance(item, int):
+        if isinstance(item, (int, slice)):
             return self._row[item]
         return self._row[self._col_map[item]]
     
@@ -47,43 +109,107 @@ class PostgresRow:
     def keys(self):
         return self._col_map.keys()
 
+    def __iter__(self):
+        return iter(self._row)
+
+    def __len__(self):
+        return len(self._row)
+
+@functools.lru_cache(maxsize=SQL_TRANSLATION_CACHE_SIZE)
+def translate_query(query):
+    """Translate a SQLite-flavoured query to PostgreSQL.
+
+    Returns (sql, wants_lastrowid, preparable). Memoized on the original text,
+    so the string rewriting only happens once per distinct statement.
+    """
+    # 1. Handle Placeholders
+    q = query.replace('?', '%s')
+
+    # 2. Handle INSERT OR IGNORE
+    if 'INSERT OR IGNORE' in q:
+        q = q.replace('INSERT OR IGNORE', 'INSERT')
+        q += ' ON CONFLICT DO NOTHING'
+
+    # 3. Handle INSERT OR REPLACE (Specific to tenant_config)
+    if 'INSERT OR REPLACE INTO tenant_config' in q:
+        q = q.replace('INSERT OR REPLACE INTO', 'INSERT INTO')
+        q += ' ON CONFLICT (tenant_slug) DO UPDATE SET config_json = EXCLUDED.config_json'
+
+    # 4. Handle lastrowid via RETURNING id
+    # Only for INSERTs that don't already have RETURNING
+    # Special case: tables keyed by something other than an id column are skipped
+    head = q.lstrip().upper()
+    target = _INSERT_TARGET_RE.match(query)
+    wants_id = head.startswith('INSERT') and 'RETURNING' not in q.upper() and not (target and target.group(1).lower() in NO_ID_TABLES)
+    if wants_id:
+        q += ' RETURNING id'
+
+    # Only plain DML can be PREPAREd, and only when every % is one of our placeholders
+    preparable = head.startswith(_PREPARABLE_PREFIXES) and '%' not in q.replace('%s', '')
+    return q, wants_id, preparable
+
 class PostgresCursorWrapper:
     def __init__(self, cursor):
         self.cursor = cursor
         self._lastrowid = None
 
     def execute(self, query, params=None):
-        # 1. Handle Placeholders
-        q = query.replace('?', '%s')
-        
-        # 2. Handle INSERT OR IGNORE
-        if 'INSERT OR IGNORE' in q:
-            q = q.replace('INSERT OR IGNORE', 'INSERT')
-            q += ' ON CONFLICT DO NOTHING'
-            
-        # 3. Handle INSERT OR REPLACE (Specific to tenant_config)
-        if 'INSERT OR REPLACE INTO tenant_config' in q:
-            q = q.replace('INSERT OR REPLACE INTO', 'INSERT INTO')
-            q += ' ON CONFLICT (tenant_slug) DO UPDATE SET config_json = EXCLUDED.config_json'
-            
-        # 4. Handle lastrowid via RETURNING id
-        # Only for INSERTs that don't already have RETURNING
-        is_insert = q.strip().upper().startswith('INSERT')
-        if is_insert and 'RETURNING' not in q.upper():
-            # Special case: tenant_config has no ID column, skip it
-            if 'tenant_config' not in q:
-                q += ' RETURNING id'
+        q, wants_id, preparable = translate_query(query)
+        name = None
+        if PG_PREPARE_HOT and preparable and not isinstance(params, dict):
+            name = self._hot_statement(q)
+        if name:
+            args = tuple(params or ())
+            stmt = f"EXECUTE {name}"
+            if args:
+                stmt += " (" + ", ".join(['%s'] * len(args)) + ")"
+            self.cursor.execute(stmt, args or None)
+        else:
+            self.cursor.execute(q, params)
+        if wants_id:
+            res = self.cursor.fetchone()
+            self._lastrowid = res[0] if res else None
+
+    def executemany(self, query, params_seq):
+        q, wants_id, _ = translate_query(query)
+        if wants_id:
+            # Batched inserts never read lastrowid
+            q = q[:-len(' RETURNING id')]
+        psycopg2.extras.execute_batch(self.cursor, q, list(params_seq))
+
+    def _hot_statement(self, q):
+        # Server-side PREPARE for statements that keep coming back on this connection
+        prepared = getattr(self.cursor.connection, 'prepared', None)
+        if prepared is None or q in _unpreparable:
+            return None
+        name = prepared.get(q)
+        if name:
+            return name
+        if len(_statement_hits) < _STATEMENT_HITS_MAX or q in _statement_hits:
+            _statement_hits[q] = _statement_hits.get(q, 0) + 1
+        if _statement_hits.get(q, 0) < PG_PREPARE_THRESHOLD or len(prepared) >= PG_PREPARE_MAX_PER_CONN:
+            return None
+        parts = q.split('%s')
+        sql_pg = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+        name = 'hot_' + hashlib.sha1(q.encode('utf-8')).hexdigest()[:16]
+        in_tx = not self.cursor.connection.autocommit
+        try:
+            if in_tx:
+                self.cursor.execute("SAVEPOINT hot_prepare")
+            self.cursor.execute(f"PREPARE {name} AS {sql_pg}")
+            if in_tx:
+                self.cursor.execute("RELEASE SAVEPOINT hot_prepare")
+        except Exception as e:
+            if in_tx:
                 try:
-                    self.cursor.execute(q, params)
-                    res = self.cursor.fetchone()
-                    self._lastrowid = res[0] if res else None
-                    return
-                except Exception as e:
-                    # If table has no id column, it might fail?
-                    # But we assume other tables have id.
-                    raise e
-            
-        self.cursor.execute(q, params)
+                    self.cursor.execute("ROLLBACK TO SAVEPOINT hot_prepare")
+                except Exception:
+                    pass
+            _unpreparable.add(q)
+            print(f"PREPARE skipped for hot statement: {e}")
+            return None
+        prepared[q] = name
+        return name
 
     @property
     def lastrowid(self):
@@ -92,11 +218,19 @@ class PostgresCursorWrapper:
     def fetchone(self):
         row = self.cursor.fetchone()
         if row is None: return None
-        return PostgresRow(self.cursor, row)
+        return PostgresRow(column_map_for(self.cursor.description), row)
 
     def fetchall(self):
         rows = self.cursor.fetchall()
-        return [PostgresRow(self.cursor, row) for row in rows]
+        if not rows: return []
+        col_map = column_map_for(self.cursor.description)
+        return [PostgresRow(col_map, row) for row in rows]
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(size) if size else self.cursor.fetchmany()
+        if not rows: return []
+        col_map = column_map_for(self.cursor.description)
+        return [PostgresRow(col_map, row) for row in rows]
     
     def __getattr__(self, name):
         return getattr(self.cursor, name)
@@ -128,6 +262,106 @@ class PostgresConnectionWrapper:
     def __getattr__(self, name):
         return getattr(self.conn, name)
 
+def iter_rows(query, params=(), batch=None):
+    """Yield the rows of a SELECT a batch at a time instead of fetchall().
+
+    PostgreSQL reads through a named (server-side) cursor, so the result set
+    stays on the server; SQLite steps its cursor with fetchmany. Meant for
+    exports: the caller must not run other statements on the same cursor
+    while iterating.
+    """
+    batch = batch or EXPORT_FETCH_ROWS
+    db = get_db()
+    if is_postgres():
+        q, _, _ = translate_query(query)
+        cur = db.conn.cursor(name=f"export_{next(_export_cursor_ids)}")
+        cur.itersize = batch
+        try:
+            cur.execute(q, tuple(params or ()))
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                col_map = column_map_for(cur.description)
+                for row in rows:
+                    yield PostgresRow(col_map, row)
+        finally:
+            cur.close()
+        return
+    cur = db.cursor()
+    cur.execute(query, params or ())
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        yield from rows
+
+def _open_sqlite(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except Exception as e:
+            print(f"SQLite pragma skipped ({pragma}): {e}")
+    return conn
+
+def _checkout_sqlite(db_path):
+    # One long-lived connection per (thread, db file); Waitress threads are reused across requests
+    conns = getattr(_sqlite_local, 'conns', None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    conn = conns.get(db_path)
+    if conn is not None:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            return conn
+        except Exception as e:
+            print(f"SQLite pooled connection reset: {e}")
+            _discard_sqlite(db_path, conn)
+    with _sqlite_lock:
+        pooled = _sqlite_open[0] < SQLITE_POOL_SIZE
+        if pooled:
+            _sqlite_open[0] += 1
+    try:
+        conn = _open_sqlite(db_path)
+    except Exception:
+        if pooled:
+            with _sqlite_lock:
+                _sqlite_open[0] -= 1
+        raise
+    if pooled:
+        conns[db_path] = conn
+    return conn
+
+def _discard_sqlite(db_path, conn):
+    conns = getattr(_sqlite_local, 'conns', None) or {}
+    if conns.get(db_path) is conn:
+        conns.pop(db_path, None)
+        with _sqlite_lock:
+            _sqlite_open[0] -= 1
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _release_sqlite(db, error=None):
+    conns = getattr(_sqlite_local, 'conns', None) or {}
+    db_path = next((p for p, c in conns.items() if c is db), None)
+    if db_path is None:
+        # Over the pool size: plain per-request connection
+        db.close()
+        return
+    try:
+        if db.in_transaction:
+            db.rollback()
+        if error is not None:
+            db.execute("SELECT 1").fetchone()
+    except Exception as e:
+        print(f"SQLite pooled connection dropped: {e}")
+        _discard_sqlite(db_path, db)
+
 def is_postgres():
     return current_app.config.get('IS_POSTGRES', False)
 
@@ -163,16 +397,14 @@ def get_db():
             # SQLite path may be read-only in some PaaS. Try configured path first, then fallback to /tmp.
             db_path = current_app.config['DATABASE']
             try:
-                g.db = sqlite3.connect(db_path)
-                g.db.row_factory = sqlite3.Row
+                g.db = _checkout_sqlite(db_path)
                 current_app.config['IS_POSTGRES'] = False
             except Exception as e:
                 try:
                     tmp_path = os.environ.get('DATABASE_PATH') or os.path.join('/tmp', 'orders.db')
                     # Ensure directory exists for tmp_path
                     os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-                    g.db = sqlite3.connect(tmp_path)
-                    g.db.row_factory = sqlite3.Row
+                    g.db = _checkout_sqlite(tmp_path)
                     current_app.config['DATABASE'] = tmp_path
                     current_app.config['IS_POSTGRES'] = False
                     print(f"SQLite fallback: using {tmp_path} due to error opening {db_path}: {e}")
@@ -189,7 +421,7 @@ def close_db(e=None):
             # Return to pool
             pg_pool.putconn(db.conn)
         else:
-            db.close()
+            _release_sqlite(db, e)
 
 def fix_postgres_sequences(cur):
     try:
@@ -938,46 +1170,230 @@ def init_db_sqlite(cur):
 
 def init_db():
     try:
+        from app.migrations import apply_migrations
         db = get_db()
-        cur = db.cursor()
-        
-        if is_postgres():
-            init_db_postgres(cur)
-        else:
-            init_db_sqlite(cur)
-        
-        db.commit()
+        apply_migrations(db)
     except Exception as e:
         print(f"WARNING: Database initialization failed: {e}")
         # Don't crash the app, just log the error.
         # This allows the app to start even if DB is temporarily unreachable.
         pass
 
-def seed_products_from_config(config_dir):
+# Bump when the seeding logic changes so every config file is re-applied once
+SEED_PIPELINE_VERSION = 1
+
+def _iter_config_files(config_dir):
+    """Yield (file_name, raw_bytes, parsed_json, slug) for every tenant config, parsing each once."""
+    for name in sorted(os.listdir(config_dir)):
+        if not name.endswith('.json'):
+            continue
+        p = os.path.join(config_dir, name)
+        try:
+            with open(p, 'rb') as f:
+                raw = f.read()
+            j = json.loads(raw.decode('utf-8'))
+            meta = j.get('meta') or {}
+            slug = meta.get('slug') or name.replace('.json','')
+        except Exception:
+            continue
+        yield name, raw, j, slug
+
+def _catalog_variants(it):
+    # Build variants object
+    variants = {}
+    
+    # 1. Food Categories
+    cats = it.get('categories')
+    if cats:
+        if isinstance(cats, list):
+            variants['food_categories'] = cats
+        else:
+            variants['food_categories'] = [str(cats)]
+    
+    # 2. Section / Interest Tag
+    tags = it.get('tags') or []
+    if tags:
+        # Logic for tags
+        if "Destacados" in tags:
+             variants['section'] = 'featured'
+        elif "Liquidaciones" in tags:
+             variants['section'] = 'interest'
+             variants['interest_tag'] = 'oferta' # Default for Liquidaciones
+        elif "Promociones" in tags:
+             variants['section'] = 'interest'
+             variants['interest_tag'] = 'promocion'
+        elif "2x1" in tags:
+             variants['section'] = 'interest'
+             variants['interest_tag'] = '2x1'
+    return variants
+
+def _catalog_seed_params(slug, catalog):
+    """Parameter lists for the product insert and the detail/variant/image backfills."""
+    products, details, variants, images = [], [], [], []
+    for it in catalog:
+        try:
+            pid = str(it.get('id') or '').strip()
+            if not pid:
+                continue
+            nm = str(it.get('name') or '').strip()
+            img = str(it.get('image') or '').strip()
+            desc = str(it.get('description') or '').strip()
+            if nm:
+                products.append((slug, pid, nm, int(it.get('price') or 0), 50, img))
+            if desc:
+                details.append((desc, slug, pid))
+            v = _catalog_variants(it)
+            if v:
+                variants.append((json.dumps(v), slug, pid))
+            if img:
+                images.append((img, slug, pid))
+        except Exception:
+            continue
+    return products, details, variants, images
+
+SQL_SEED_PRODUCT = "INSERT OR IGNORE INTO products (tenant_slug, product_id, name, price, stock, active, image_url) VALUES (?, ?, ?, ?, ?, 1, ?)"
+SQL_BACKFILL_DETAILS = "UPDATE products SET details = ? WHERE tenant_slug = ? AND product_id = ? AND (details IS NULL OR TRIM(details) = '')"
+SQL_BACKFILL_VARIANTS = "UPDATE products SET variants_json = ? WHERE tenant_slug = ? AND product_id = ?"
+SQL_BACKFILL_IMAGES = "UPDATE products SET image_url = ? WHERE tenant_slug = ? AND product_id = ? AND (image_url IS NULL OR TRIM(image_url) = '')"
+
+def _admin_seed_accounts(j, slug, admin_user, admin_pass, admin_legacy_pass):
+    """(tenant_slug, username, password) tuples a config provisions, in insert order."""
+    meta = j.get('meta') or {}
+    accounts = [(slug, admin_user, admin_pass)]
+    # Inserta también admin con contraseña legacy si corresponde
+    if admin_legacy_pass:
+        accounts.append((slug, 'admin', admin_legacy_pass))
+    admins = j.get('admins') or meta.get('admins') or []
+    for adm in admins:
+        try:
+            un = str(adm.get('username') or '').strip()
+            pw = str(adm.get('password') or '')
+            if not un or not pw:
+                continue
+            accounts.append((slug, un, pw))
+        except: continue
+    return accounts
+
+# Hash in parallel once at least this many admins are new (e.g. onboarding a batch of tenants)
+ADMIN_HASH_PARALLEL_MIN = int(os.environ.get('ADMIN_HASH_PARALLEL_MIN') or 4)
+
+def _hash_passwords(passwords):
+    if len(passwords) < ADMIN_HASH_PARALLEL_MIN:
+        return [generate_password_hash(pw) for pw in passwords]
+    # hashlib's scrypt/pbkdf2 release the GIL, so threads spread the KDF over all cores
+    # without re-importing the app in child processes or forking open DB sockets.
+    workers = int(os.environ.get('ADMIN_HASH_WORKERS') or 0) or min(len(passwords), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        return list(ex.map(generate_password_hash, passwords))
+
+def _insert_admin_accounts(cur, accounts):
+    # First account per (tenant, username) wins, as with the row-by-row INSERT OR IGNORE
+    pending = {}
+    for slug, un, pw in accounts:
+        pending.setdefault((slug, un), pw)
+    if not pending:
+        return 0
+    slugs = sorted({k[0] for k in pending})
+    placeholders = ", ".join(['?'] * len(slugs))
+    cur.execute(f"SELECT tenant_slug, username FROM admin_users WHERE tenant_slug IN ({placeholders})", slugs)
+    for r in cur.fetchall() or []:
+        pending.pop((r[0], r[1]), None)
+    if not pending:
+        return 0
+    keys = list(pending.keys())
+    hashes = _hash_passwords([pending[k] for k in keys])
+    cur.executemany(
+        "INSERT OR IGNORE INTO admin_users (tenant_slug, username, password_hash) VALUES (?, ?, ?)",
+        [(k[0], k[1], ph) for k, ph in zip(keys, hashes)]
+    )
+    return len(keys)
+
+def _admin_env():
+    admin_user = os.environ.get('ADMIN_USERNAME') or 'admin'
+    admin_pass = os.environ.get('ADMIN_PASSWORD') or 'admin123'
+    admin_legacy_pass = os.environ.get('ADMIN_LEGACY_PASSWORD') or 'GastroPanel!123'
+    return admin_user, admin_pass, admin_legacy_pass
+
+def seed_from_config(config_dir, force=False):
+    """Single-pass startup seeding: products, catalog backfills and admin users.
+
+    Each config is read and parsed once. Its content hash (plus the admin env that
+    feeds the seed) is stored in config_seed_state, and unchanged files are skipped
+    on the next boot unless force=True or CONFIG_SEED_FORCE is set.
+    """
+    from app import catalog
+    force = force or str(os.environ.get('CONFIG_SEED_FORCE') or '').strip().lower() in ('1', 'true', 'yes')
+    admin_user, admin_pass, admin_legacy_pass = _admin_env()
+    # Only what decides which rows get inserted; passwords never reach the stored digest
+    env_key = json.dumps([SEED_PIPELINE_VERSION, admin_user, bool(admin_legacy_pass)]).encode('utf-8')
     try:
         db = get_db()
         cur = db.cursor()
-        for name in os.listdir(config_dir):
-            if not name.endswith('.json'):
+        seen = {}
+        try:
+            cur.execute("SELECT file_name, content_hash FROM config_seed_state")
+            seen = {r[0]: r[1] for r in cur.fetchall()}
+        except Exception:
+            # Table missing (migrations not applied): seed without hash gating
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            seen = None
+        skipped = 0
+        changed = []
+        accounts = []
+        for name, raw, j, slug in _iter_config_files(config_dir):
+            digest = hashlib.sha256(env_key + b'\0' + raw).hexdigest()
+            if not force and seen is not None and seen.get(name) == digest:
+                skipped += 1
                 continue
-            p = os.path.join(config_dir, name)
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                meta = j.get('meta') or {}
-                slug = meta.get('slug') or name.replace('.json','')
-                catalog = j.get('catalog') or []
-                for it in catalog:
-                    pid = str(it.get('id') or '').strip()
-                    nm = str(it.get('name') or '').strip()
-                    price = int(it.get('price') or 0)
-                    img = str(it.get('image') or '').strip()
-                    if not pid or not nm:
-                        continue
-                    cur.execute(
-                        "INSERT OR IGNORE INTO products (tenant_slug, product_id, name, price, stock, active, image_url) VALUES (?, ?, ?, ?, ?, 1, ?)",
-                        (slug, pid, nm, price, 50, img)
-                    )
+                products, details, variants, images = _catalog_seed_params(slug, j.get('catalog') or [])
+                if products: cur.executemany(SQL_SEED_PRODUCT, products)
+                if details: cur.executemany(SQL_BACKFILL_DETAILS, details)
+                if variants: cur.executemany(SQL_BACKFILL_VARIANTS, variants)
+                if images: cur.executemany(SQL_BACKFILL_IMAGES, images)
+                if products or details or variants or images:
+                    catalog.bump(cur, slug)
+                db.commit()
+                accounts.extend(_admin_seed_accounts(j, slug, admin_user, admin_pass, admin_legacy_pass))
+                changed.append((name, digest))
+            except Exception as e:
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+                print(f"Config seed failed for {name}: {e}")
+        # Admins for every changed tenant in one batch, so a bulk onboarding hashes in parallel
+        created = _insert_admin_accounts(cur, accounts)
+        if seen is not None:
+            now = datetime.utcnow().isoformat()
+            for name, digest in changed:
+                if name in seen:
+                    cur.execute("UPDATE config_seed_state SET content_hash = ?, seeded_at = ? WHERE file_name = ?", (digest, now, name))
+                else:
+                    cur.execute("INSERT INTO config_seed_state (file_name, content_hash, seeded_at) VALUES (?, ?, ?)", (name, digest, now))
+        db.commit()
+        print(f"Config seed: {len(changed)} applied, {skipped} unchanged, {created} admin users created.")
+    except Exception as e:
+        try:
+            db.rollback()
+        except Exception:
+            pass
+        print(f"WARNING: Config seeding failed: {e}")
+
+def seed_products_from_config(config_dir):
+    from app import catalog
+    try:
+        db = get_db()
+        cur = db.cursor()
+        for name, raw, j, slug in _iter_config_files(config_dir):
+            try:
+                products = _catalog_seed_params(slug, j.get('catalog') or [])[0]
+                if products:
+                    cur.executemany(SQL_SEED_PRODUCT, products)
+                    catalog.bump(cur, slug)
             except Exception:
                 continue
         db.commit()
@@ -985,28 +1401,16 @@ def seed_products_from_config(config_dir):
         pass
 
 def backfill_product_details_from_config(config_dir):
+    from app import catalog
     try:
         db = get_db()
         cur = db.cursor()
-        for name in os.listdir(config_dir):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(config_dir, name)
+        for name, raw, j, slug in _iter_config_files(config_dir):
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                meta = j.get('meta') or {}
-                slug = meta.get('slug') or name.replace('.json','')
-                catalog = j.get('catalog') or []
-                for it in catalog:
-                    pid = str(it.get('id') or '').strip()
-                    desc = str(it.get('description') or '').strip()
-                    if not pid or not desc:
-                        continue
-                    cur.execute(
-                        "UPDATE products SET details = ? WHERE tenant_slug = ? AND product_id = ? AND (details IS NULL OR TRIM(details) = '')",
-                        (desc, slug, pid)
-                    )
+                details = _catalog_seed_params(slug, j.get('catalog') or [])[1]
+                if details:
+                    cur.executemany(SQL_BACKFILL_DETAILS, details)
+                    catalog.bump(cur, slug)
             except Exception:
                 continue
         db.commit()
@@ -1014,59 +1418,16 @@ def backfill_product_details_from_config(config_dir):
         pass
 
 def backfill_product_variants_from_config(config_dir):
+    from app import catalog
     try:
         db = get_db()
         cur = db.cursor()
-        for name in os.listdir(config_dir):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(config_dir, name)
+        for name, raw, j, slug in _iter_config_files(config_dir):
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                meta = j.get('meta') or {}
-                slug = meta.get('slug') or name.replace('.json','')
-                catalog = j.get('catalog') or []
-                for it in catalog:
-                    pid = str(it.get('id') or '').strip()
-                    if not pid: continue
-                    
-                    # Build variants object
-                    variants = {}
-                    
-                    # 1. Food Categories
-                    cats = it.get('categories')
-                    if cats:
-                        if isinstance(cats, list):
-                            variants['food_categories'] = cats
-                        else:
-                            variants['food_categories'] = [str(cats)]
-                    
-                    # 2. Section / Interest Tag
-                    tags = it.get('tags') or []
-                    if tags:
-                        # Logic for tags
-                        if "Destacados" in tags:
-                             variants['section'] = 'featured'
-                        elif "Liquidaciones" in tags:
-                             variants['section'] = 'interest'
-                             variants['interest_tag'] = 'oferta' # Default for Liquidaciones
-                        elif "Promociones" in tags:
-                             variants['section'] = 'interest'
-                             variants['interest_tag'] = 'promocion'
-                        elif "2x1" in tags:
-                             variants['section'] = 'interest'
-                             variants['interest_tag'] = '2x1'
-                    
-                    if not variants:
-                        continue
-                        
-                    v_json = json.dumps(variants)
-                    
-                    cur.execute(
-                        "UPDATE products SET variants_json = ? WHERE tenant_slug = ? AND product_id = ?",
-                        (v_json, slug, pid)
-                    )
+                variants = _catalog_seed_params(slug, j.get('catalog') or [])[2]
+                if variants:
+                    cur.executemany(SQL_BACKFILL_VARIANTS, variants)
+                    catalog.bump(cur, slug)
             except Exception:
                 continue
         db.commit()
@@ -1074,28 +1435,16 @@ def backfill_product_variants_from_config(config_dir):
         pass
 
 def backfill_product_images_from_config(config_dir):
+    from app import catalog
     try:
         db = get_db()
         cur = db.cursor()
-        for name in os.listdir(config_dir):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(config_dir, name)
+        for name, raw, j, slug in _iter_config_files(config_dir):
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                meta = j.get('meta') or {}
-                slug = meta.get('slug') or name.replace('.json','')
-                catalog = j.get('catalog') or []
-                for it in catalog:
-                    pid = str(it.get('id') or '').strip()
-                    img = str(it.get('image') or '').strip()
-                    if not pid or not img:
-                        continue
-                    cur.execute(
-                        "UPDATE products SET image_url = ? WHERE tenant_slug = ? AND product_id = ? AND (image_url IS NULL OR TRIM(image_url) = '')",
-                        (img, slug, pid)
-                    )
+                images = _catalog_seed_params(slug, j.get('catalog') or [])[3]
+                if images:
+                    cur.executemany(SQL_BACKFILL_IMAGES, images)
+                    catalog.bump(cur, slug)
             except Exception:
                 continue
         db.commit()
@@ -1104,48 +1453,16 @@ def backfill_product_images_from_config(config_dir):
 
 def seed_admin_users_from_env(config_dir):
     try:
-        admin_user = os.environ.get('ADMIN_USERNAME') or 'admin'
-        admin_pass = os.environ.get('ADMIN_PASSWORD') or 'admin123'
-        admin_legacy_pass = os.environ.get('ADMIN_LEGACY_PASSWORD') or 'GastroPanel!123'
-        
+        admin_user, admin_pass, admin_legacy_pass = _admin_env()
         db = get_db()
         cur = db.cursor()
-        for name in os.listdir(config_dir):
-            if not name.endswith('.json'):
-                continue
-            p = os.path.join(config_dir, name)
+        accounts = []
+        for name, raw, j, slug in _iter_config_files(config_dir):
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                meta = j.get('meta') or {}
-                slug = meta.get('slug') or name.replace('.json','')
-                ph = generate_password_hash(admin_pass)
-                cur.execute(
-                    "INSERT OR IGNORE INTO admin_users (tenant_slug, username, password_hash) VALUES (?, ?, ?)",
-                    (slug, admin_user, ph)
-                )
-                # Inserta también admin con contraseña legacy si corresponde
-                if admin_legacy_pass:
-                    ph_legacy = generate_password_hash(admin_legacy_pass)
-                    cur.execute(
-                        "INSERT OR IGNORE INTO admin_users (tenant_slug, username, password_hash) VALUES (?, ?, ?)",
-                        (slug, 'admin', ph_legacy)
-                    )
-                admins = j.get('admins') or meta.get('admins') or []
-                for adm in admins:
-                    try:
-                        un = str(adm.get('username') or '').strip()
-                        pw = str(adm.get('password') or '')
-                        if not un or not pw:
-                            continue
-                        ph_adm = generate_password_hash(pw)
-                        cur.execute(
-                            "INSERT OR IGNORE INTO admin_users (tenant_slug, username, password_hash) VALUES (?, ?, ?)",
-                            (slug, un, ph_adm)
-                        )
-                    except: continue
+                accounts.extend(_admin_seed_accounts(j, slug, admin_user, admin_pass, admin_legacy_pass))
             except Exception:
                 continue
+        _insert_admin_accounts(cur, accounts)
         db.commit()
     except Exception:
         pass
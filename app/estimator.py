@@ -0,0 +1,244 @@
+"""Streaming prep-time estimates per tenant and order type.
+
+Each time an order reaches its target status (listo for mesa/espera, entregado
+for delivery) the minutes since creation are folded into an EWMA and two P²
+quantile sketches (median and p90). The state lives in prep_time_stats and is
+updated inside the status-change transaction, so /api/config only reads a few
+numbers instead of re-scanning a week of status history.
+"""
+import os
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask import after_this_request, current_app, has_request_context
+from app.database import is_postgres
+
+# Migration that created prep_time_stats
+ESTIMATOR_SCHEMA_VERSION = 9
+
+# config key -> (order_type, target status)
+METRICS = (
+    ('time_mesa', 'mesa', 'listo'),
+    ('time_espera', 'espera', 'listo'),
+    ('time_delivery', 'direccion', 'entregado'),
+)
+TARGETS = {(otype, status): key for key, otype, status in METRICS}
+
+EWMA_ALPHA = float(os.environ.get('PREP_EWMA_ALPHA', '0.1') or '0.1')
+# Same anomaly filter the per-request average used
+MIN_MINUTES = 2
+MAX_MINUTES = 180
+CACHE_TTL = int(os.environ.get('PREP_ESTIMATE_CACHE_TTL', '60') or '60')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class P2Quantile:
+    """P² single-quantile estimator (Jain & Chlamtac): five markers, O(1) per sample."""
+
+    def __init__(self, p, state=None):
+        self.p = p
+        state = state or {}
+        self.q = list(state.get('q') or [])
+        self.n = list(state.get('n') or [])
+        self.np = list(state.get('np') or [])
+        self.dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def to_dict(self):
+        return {'q': self.q, 'n': self.n, 'np': self.np}
+
+    def add(self, x):
+        if len(self.n) < 5:
+            # Warm-up: keep the raw samples until there are five markers
+            self.q.append(x)
+            self.q.sort()
+            if len(self.q) == 5:
+                p = self.p
+                self.n = [1, 2, 3, 4, 5]
+                self.np = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+            return
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while k < 3 and x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not (q[i - 1] < qp < q[i + 1]):
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if not self.q:
+            return None
+        if len(self.n) < 5:
+            return self.q[min(len(self.q) - 1, int(round(self.p * (len(self.q) - 1))))]
+        return self.q[2]
+
+
+def _parse(ts):
+    if not ts:
+        return None
+    if isinstance(ts, datetime):
+        dt = ts
+    else:
+        s = str(ts).strip()
+        if s.endswith('Z'):
+            s = s[:-1] + '+00:00'
+        dt = datetime.fromisoformat(s)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _minutes(created_at, changed_at):
+    try:
+        start = _parse(created_at)
+        end = _parse(changed_at)
+        if not start or not end:
+            return None
+        diff = (end - start).total_seconds() / 60
+    except Exception:
+        return None
+    return diff if MIN_MINUTES < diff < MAX_MINUTES else None
+
+
+def _fold(row, minutes):
+    """New (samples, ewma, p50, p90, state_json) after adding one observation."""
+    samples, ewma, state_json = (row or (0, None, None))
+    try:
+        state = json.loads(state_json) if state_json else {}
+    except Exception:
+        state = {}
+    p50 = P2Quantile(0.5, state.get('p50'))
+    p90 = P2Quantile(0.9, state.get('p90'))
+    p50.add(minutes)
+    p90.add(minutes)
+    ewma = minutes if ewma is None else EWMA_ALPHA * minutes + (1 - EWMA_ALPHA) * float(ewma)
+    state = {'p50': p50.to_dict(), 'p90': p90.to_dict()}
+    return int(samples or 0) + 1, ewma, p50.value(), p90.value(), json.dumps(state)
+
+
+def observe(cur, tenant_slug, order_type, status, created_at, changed_at):
+    """Fold one status transition into the tenant's estimate. The caller commits."""
+    if (str(order_type or '').strip().lower(), status) not in TARGETS:
+        return
+    if int(current_app.config.get('SCHEMA_VERSION') or 0) < ESTIMATOR_SCHEMA_VERSION:
+        return
+    minutes = _minutes(created_at, changed_at)
+    if minutes is None:
+        return
+    tenant_slug = str(tenant_slug or '')
+    order_type = str(order_type).strip().lower()
+    _update(cur, tenant_slug, order_type, minutes, changed_at)
+    if has_request_context():
+        @after_this_request
+        def _invalidate(response):
+            invalidate(tenant_slug)
+            return response
+    else:
+        invalidate(tenant_slug)
+
+
+def _update(cur, tenant_slug, order_type, minutes, updated_at):
+    cur.execute(
+        "INSERT OR IGNORE INTO prep_time_stats (tenant_slug, order_type, samples, updated_at) VALUES (?, ?, 0, ?)",
+        (tenant_slug, order_type, updated_at),
+    )
+    lock = " FOR UPDATE" if is_postgres() else ""
+    cur.execute(
+        f"SELECT samples, ewma, state_json FROM prep_time_stats WHERE tenant_slug = ? AND order_type = ?{lock}",
+        (tenant_slug, order_type),
+    )
+    samples, ewma, p50, p90, state_json = _fold(cur.fetchone(), minutes)
+    cur.execute(
+        "UPDATE prep_time_stats SET samples = ?, ewma = ?, p50 = ?, p90 = ?, state_json = ?, updated_at = ? "
+        "WHERE tenant_slug = ? AND order_type = ?",
+        (samples, ewma, p50, p90, state_json, updated_at, tenant_slug, order_type),
+    )
+
+
+def invalidate(tenant_slug):
+    with _cache_lock:
+        _cache.pop(tenant_slug, None)
+
+
+def get_stats(cur, tenant_slug):
+    """{config_key: {'avg', 'p50', 'p90', 'samples'}} for the tenant, cached for CACHE_TTL seconds."""
+    now = time.time()
+    with _cache_lock:
+        hit = _cache.get(tenant_slug)
+    if hit and now - hit[0] < CACHE_TTL:
+        return hit[1]
+    stats = {}
+    try:
+        cur.execute("SELECT order_type, samples, ewma, p50, p90 FROM prep_time_stats WHERE tenant_slug = ?", (tenant_slug,))
+        for r in cur.fetchall() or []:
+            key = next((k for k, otype, _ in METRICS if otype == r[0]), None)
+            if key and r[2] is not None:
+                stats[key] = {
+                    'avg': int(round(float(r[2]))),
+                    'p50': int(round(float(r[3]))) if r[3] is not None else None,
+                    'p90': int(round(float(r[4]))) if r[4] is not None else None,
+                    'samples': int(r[1] or 0),
+                }
+    except Exception as e:
+        print(f"Error reading prep time estimates: {e}")
+        return {}
+    with _cache_lock:
+        _cache[tenant_slug] = (now, stats)
+    return stats
+
+
+def get_estimates(cur, tenant_slug):
+    """{config_key: minutes} as the old calculate_average_times returned."""
+    return {k: v['avg'] for k, v in get_stats(cur, tenant_slug).items() if v.get('avg')}
+
+
+def backfill(cur, days=7):
+    """Seed prep_time_stats by replaying the last days of status history in order."""
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    for key, otype, status in METRICS:
+        cur.execute(
+            """
+            SELECT o.tenant_slug, o.created_at, h.changed_at
+            FROM orders o
+            JOIN order_status_history h ON o.id = h.order_id
+            WHERE o.order_type = ? AND h.status = ? AND o.created_at >= ?
+            ORDER BY h.changed_at ASC
+            """,
+            (otype, status, since),
+        )
+        folded = {}
+        for tenant_slug, created_at, changed_at in cur.fetchall() or []:
+            minutes = _minutes(created_at, changed_at)
+            if minutes is None:
+                continue
+            prev = folded.get(tenant_slug)
+            row = (prev[0], prev[1], prev[4]) if prev else None
+            folded[tenant_slug] = _fold(row, minutes) + (changed_at,)
+        for tenant_slug, (samples, ewma, p50, p90, state_json, updated_at) in folded.items():
+            cur.execute(
+                "INSERT OR IGNORE INTO prep_time_stats (tenant_slug, order_type, samples, ewma, p50, p90, state_json, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (tenant_slug, otype, samples, ewma, p50, p90, state_json, updated_at),
+            )
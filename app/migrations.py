@@ -0,0 +1,327 @@
+"""Versioned schema migrations shared by the SQLite and PostgreSQL paths.
+
+Each entry in MIGRATIONS is (version, name, fn(cur, pg)). Migrations must be
+idempotent: the baseline re-runs the historical CREATE/ALTER script, and a
+partially applied step may be retried on the next boot.
+"""
+from datetime import datetime
+from flask import current_app
+from app.database import get_db, is_postgres, init_db_postgres, init_db_sqlite
+from app import search, estimator, cold_archive, rollups, cash_totals, reports, catalog
+
+# Arbitrary constant; serializes concurrent workers migrating the same Postgres DB
+MIGRATION_LOCK_KEY = 7265040101
+
+
+def column_names(cur, pg, table):
+    if pg:
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = ?", (table,))
+        return [r[0] for r in (cur.fetchall() or [])]
+    cur.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in (cur.fetchall() or [])]
+
+
+def add_column(cur, pg, table, column, ddl):
+    if pg:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}")
+        return
+    if column not in column_names(cur, pg, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _m001_baseline(cur, pg):
+    if pg:
+        init_db_postgres(cur)
+    else:
+        init_db_sqlite(cur)
+
+
+def _m002_rbac_and_plan_columns(cur, pg):
+    # Columns that used to be probed per request by the ensure_* helpers
+    add_column(cur, pg, 'admin_users', 'role', "TEXT NOT NULL DEFAULT 'admin'")
+    add_column(cur, pg, 'admin_users', 'permissions_json', "TEXT DEFAULT ''")
+    add_column(cur, pg, 'admin_users', 'is_owner', "INTEGER NOT NULL DEFAULT 0")
+    add_column(cur, pg, 'admin_users', 'last_seen_at', "TEXT")
+    add_column(cur, pg, 'tenants', 'status_message', "TEXT DEFAULT ''")
+    add_column(cur, pg, 'tenants', 'plan', "TEXT NOT NULL DEFAULT 'standard'")
+    add_column(cur, pg, 'tenants', 'max_users', "INTEGER NOT NULL DEFAULT 3")
+
+
+def _m003_config_seed_state(cur, pg):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS config_seed_state (
+            file_name TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            seeded_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _m004_keyset_indexes(cur, pg):
+    # Keyset pagination: WHERE tenant_slug = ? [AND status = ?] AND id < ? ORDER BY id DESC
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_tenant_id ON orders(tenant_slug, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_tenant_status_id ON orders(tenant_slug, status, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_archived_tenant_order ON archived_orders(tenant_slug, order_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cash_sessions_tenant_closed ON cash_sessions(tenant_slug, scope, closed_at, id)")
+
+
+def _m005_order_search(cur, pg):
+    add_column(cur, pg, 'orders', 'search_text', "TEXT")
+    search.create_search_index(cur, pg)
+    search.backfill_search_text(cur)
+
+
+def _m006_order_change_feed(cur, pg):
+    pk = "SERIAL PRIMARY KEY" if pg else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tenant_versions (
+            tenant_slug TEXT PRIMARY KEY,
+            orders_version INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS order_changes (
+            id {pk},
+            tenant_slug TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            order_id INTEGER,
+            event TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_changes_tenant_version ON order_changes(tenant_slug, version)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_changes_created ON order_changes(created_at)")
+
+
+def _m007_status_timestamps(cur, pg):
+    # Maintained by record_status_change in orders.py; replaces MAX(changed_at) joins
+    add_column(cur, pg, 'orders', 'last_status_at', "TEXT")
+    add_column(cur, pg, 'orders', 'preparing_at', "TEXT")
+    add_column(cur, pg, 'orders', 'ready_at', "TEXT")
+    add_column(cur, pg, 'orders', 'canceled_at', "TEXT")
+    add_column(cur, pg, 'orders', 'delivered_at', "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_history_order_status ON order_status_history(order_id, status, changed_at)")
+    cur.execute(
+        "UPDATE orders SET last_status_at = (SELECT MAX(h.changed_at) FROM order_status_history h WHERE h.order_id = orders.id) "
+        "WHERE last_status_at IS NULL"
+    )
+    for column, status, agg in (
+        ('preparing_at', 'preparacion', 'MIN'),
+        ('ready_at', 'listo', 'MIN'),
+        ('delivered_at', 'entregado', 'MAX'),
+        ('canceled_at', 'cancelado', 'MAX'),
+    ):
+        cur.execute(
+            f"UPDATE orders SET {column} = (SELECT {agg}(h.changed_at) FROM order_status_history h WHERE h.order_id = orders.id AND h.status = ?) "
+            f"WHERE {column} IS NULL",
+            (status,),
+        )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_tenant_delivered ON orders(tenant_slug, delivered_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_tenant_canceled ON orders(tenant_slug, canceled_at)")
+
+
+def _m008_delivery_assign_columns(cur, pg):
+    # delivery_returned used to be three MAX(created_at) subqueries on order_events per row
+    add_column(cur, pg, 'orders', 'last_assign_at', "TEXT")
+    add_column(cur, pg, 'orders', 'last_unassign_at', "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_events_order_type ON order_events(order_id, event_type, created_at)")
+    for column, event in (('last_assign_at', 'delivery_assign'), ('last_unassign_at', 'delivery_unassign')):
+        cur.execute(
+            f"UPDATE orders SET {column} = (SELECT MAX(e.created_at) FROM order_events e WHERE e.order_id = orders.id AND e.event_type = ?) "
+            f"WHERE {column} IS NULL AND lower(trim(COALESCE(order_type,''))) = 'direccion'",
+            (event,),
+        )
+    # The delivery board filters order_type = 'direccion' directly so the index applies
+    cur.execute("UPDATE orders SET order_type = lower(trim(order_type)) WHERE order_type != lower(trim(order_type))")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_tenant_type ON orders(tenant_slug, order_type, id)")
+
+
+def _m009_prep_time_stats(cur, pg):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS prep_time_stats (
+            tenant_slug TEXT NOT NULL,
+            order_type TEXT NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            ewma REAL,
+            p50 REAL,
+            p90 REAL,
+            state_json TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (tenant_slug, order_type)
+        )
+        """
+    )
+    estimator.backfill(cur)
+
+
+def _m010_task_leases(cur, pg):
+    # Leader election for background tasks across processes (tasks.acquire_lease)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL DEFAULT '',
+            expires_at TEXT NOT NULL
+        )
+        """
+    )
+    # Set-based archiver: WHERE status = ? AND <finished_at> <= cutoff
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_delivered ON orders(status, delivered_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_canceled ON orders(status, canceled_at)")
+
+
+def _m011_cold_archive(cur, pg):
+    # orders_archive & co.; filled by the background task (tasks._move_cold_once)
+    cold_archive.create_cold_tables(cur, pg)
+
+
+def _m012_order_rollups(cur, pg):
+    # Kept current by rollups.apply_order; the metrics endpoints read it instead of scanning orders
+    add_column(cur, pg, 'orders', 'rollup_state', "TEXT")
+    rollups.create_rollup_table(cur, pg)
+    rollups.rebuild(cur, suffixes=('', cold_archive.COLD_SUFFIX))
+
+
+def _m013_cash_session_totals(cur, pg):
+    # Running totals kept by cash_totals; the open-session widget reads them instead of aggregating
+    for column in cash_totals.TOTAL_COLUMNS:
+        add_column(cur, pg, 'cash_sessions', column, "INTEGER NOT NULL DEFAULT 0")
+    add_column(cur, pg, 'orders', 'cash_session_id', "INTEGER")
+    add_column(cur, pg, 'orders', 'cash_state', "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_cash_session ON orders(cash_session_id)")
+    cash_totals.reconcile(cur)
+
+
+def _m014_report_jobs(cur, pg):
+    # Queue of exports/reports generated by the reports worker pool
+    reports.create_report_table(cur, pg)
+
+
+def _m015_config_version(cur, pg):
+    # Bumped by tenant_config.save_tenant_config; config caches compare it instead of expiring
+    add_column(cur, pg, 'tenant_config', 'config_version', "INTEGER NOT NULL DEFAULT 1")
+
+
+def _m016_catalog_version(cur, pg):
+    # Bumped by catalog.bump on every product/stock write; /api/products serves snapshots keyed by it
+    add_column(cur, pg, 'products', 'catalog_version', "INTEGER NOT NULL DEFAULT 0")
+    catalog.create_catalog_tables(cur, pg)
+
+
+def _m017_delivered_at_rule(cur, pg):
+    # Migration 7 left delivered_at alone where a driver's delivery update had set
+    # it; every order with an entregado change now keys on the latest one
+    for sfx in ('', cold_archive.COLD_SUFFIX):
+        cur.execute(
+            f"UPDATE orders{sfx} SET delivered_at = (SELECT MAX(h.changed_at) FROM order_status_history{sfx} h "
+            f"WHERE h.order_id = orders{sfx}.id AND h.status = 'entregado') "
+            f"WHERE EXISTS (SELECT 1 FROM order_status_history{sfx} h WHERE h.order_id = orders{sfx}.id AND h.status = 'entregado')"
+        )
+    # Rollup buckets and cash sessions are keyed on delivered_at
+    rollups.rebuild(cur, suffixes=('', cold_archive.COLD_SUFFIX))
+    cash_totals.reconcile(cur)
+
+
+MIGRATIONS = [
+    (1, 'baseline', _m001_baseline),
+    (2, 'rbac_and_plan_columns', _m002_rbac_and_plan_columns),
+    (3, 'config_seed_state', _m003_config_seed_state),
+    (4, 'keyset_indexes', _m004_keyset_indexes),
+    (5, 'order_search', _m005_order_search),
+    (6, 'order_change_feed', _m006_order_change_feed),
+    (7, 'status_timestamps', _m007_status_timestamps),
+    (8, 'delivery_assign_columns', _m008_delivery_assign_columns),
+    (9, 'prep_time_stats', _m009_prep_time_stats),
+    (10, 'task_leases', _m010_task_leases),
+    (11, 'cold_archive', _m011_cold_archive),
+    (12, 'order_rollups', _m012_order_rollups),
+    (13, 'cash_session_totals', _m013_cash_session_totals),
+    (14, 'report_jobs', _m014_report_jobs),
+    (15, 'config_version', _m015_config_version),
+    (16, 'catalog_version', _m016_catalog_version),
+    (17, 'delivered_at_rule', _m017_delivered_at_rule),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def current_version(cur):
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    row = cur.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def apply_migrations(db=None):
+    """Apply pending migrations in order and return the resulting version."""
+    db = db or get_db()
+    cur = db.cursor()
+    pg = is_postgres()
+    locked = False
+    version = 0
+    try:
+        if pg:
+            cur.execute("SELECT pg_advisory_lock(?)", (MIGRATION_LOCK_KEY,))
+            locked = True
+        _ensure_version_table(cur)
+        db.commit()
+        version = current_version(cur)
+        current_app.config['SCHEMA_VERSION'] = version
+        for num, name, fn in MIGRATIONS:
+            if num <= version:
+                continue
+            try:
+                fn(cur, pg)
+                cur.execute(
+                    "INSERT OR IGNORE INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                    (num, name, datetime.utcnow().isoformat()),
+                )
+                db.commit()
+                version = num
+                # Later migrations may call feature code gated on the ones already applied
+                current_app.config['SCHEMA_VERSION'] = version
+                print(f"Schema migration {num} ({name}) applied.")
+            except Exception as e:
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+                print(f"WARNING: Schema migration {num} ({name}) failed: {e}")
+                break
+    finally:
+        if locked:
+            try:
+                cur.execute("SELECT pg_advisory_unlock(?)", (MIGRATION_LOCK_KEY,))
+                db.commit()
+            except Exception:
+                pass
+    current_app.config['SCHEMA_VERSION'] = version
+    if version >= 5:
+        search.detect_search_backend(cur, pg)
+    return version
+
+
+def schema_is_current():
+    """True once this app has applied every migration; ensure_* helpers become no-ops."""
+    try:
+        return int(current_app.config.get('SCHEMA_VERSION') or 0) >= LATEST_VERSION
+    except Exception:
+        return False
@@ -0,0 +1,311 @@
+"""Report jobs: heavy exports and reports generated off the request threads.
+
+An endpoint that supports jobs answers a POST with the same filters as its GET
+by queueing a report_jobs row and returning its id (202). A small thread pool
+(REPORT_WORKERS) claims queued jobs, writes the file under
+instance/reports/ and marks the job done; the client polls
+/api/reports/<id> and downloads the file from /api/reports/<id>/download.
+
+An identical job (same kind, tenant, requester and filters) that is still
+queued or running is returned instead of queueing another one. Finished jobs
+and their files are removed REPORT_TTL_SECONDS after they finish, and jobs
+left running by a dead process are queued again, by sweep() in the
+background task.
+"""
+import os
+import json
+import hashlib
+import secrets
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, request, session, jsonify
+from app.database import get_db
+from app.writer import run_write
+from app.utils import stream_csv
+
+# Migration that created report_jobs
+REPORT_SCHEMA_VERSION = 14
+
+# Each worker thread keeps a pooled SQLite connection; database.SQLITE_POOL_SIZE counts them
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '2') or '2')
+REPORT_TTL_SECONDS = int(os.environ.get('REPORT_TTL_SECONDS', '86400') or '86400')
+# A job still running after this long belonged to a dead worker and is queued again
+REPORT_STALE_SECONDS = int(os.environ.get('REPORT_STALE_SECONDS', '3600') or '3600')
+
+JOB_COLUMNS = "id, tenant_slug, kind, status, created_by, created_at, started_at, finished_at, expires_at, file_name, size_bytes, error"
+
+# kind -> (format, builder); see report_kind
+REPORT_KINDS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def report_kind(kind, fmt='csv'):
+    """Register builder(filters) as the generator of kind.
+
+    csv builders return (file_name, header, rows) with rows lazy, the same
+    triple the synchronous endpoints pass to utils.csv_download; json builders
+    return (file_name, payload).
+    """
+    def register(fn):
+        REPORT_KINDS[kind] = (fmt, fn)
+        return fn
+    return register
+
+
+def reports_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= REPORT_SCHEMA_VERSION
+
+
+def reports_dir():
+    path = os.path.join(current_app.instance_path, 'reports')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def create_report_table(cur, pg):
+    pk = "SERIAL PRIMARY KEY" if pg else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id {pk},
+            tenant_slug TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            job_key TEXT NOT NULL,
+            filters_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            created_by TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            expires_at TEXT,
+            claim TEXT,
+            file_name TEXT,
+            file_path TEXT,
+            size_bytes INTEGER,
+            error TEXT
+        )
+        """
+    )
+    # At most one in-flight job per key; enqueue relies on it to de-duplicate
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_report_jobs_in_flight ON report_jobs(job_key) "
+        "WHERE status IN ('queued', 'running')"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs(status, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_expires ON report_jobs(expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_owner ON report_jobs(tenant_slug, created_by, id)")
+
+
+def job_key(kind, tenant_slug, actor, filters):
+    raw = json.dumps([kind, tenant_slug, str(actor or '').lower(), filters], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def enqueue(kind, tenant_slug, filters, actor=''):
+    """Queue a report, or return the identical job already in flight; returns the job dict."""
+    if kind not in REPORT_KINDS:
+        raise ValueError(f"unknown report kind: {kind}")
+    filters = {k: v for k, v in (filters or {}).items() if v not in (None, '')}
+    key = job_key(kind, tenant_slug, actor, filters)
+
+    def put(cur):
+        cur.execute(
+            "INSERT OR IGNORE INTO report_jobs (tenant_slug, kind, job_key, filters_json, status, created_by, created_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (tenant_slug, kind, key, json.dumps(filters, sort_keys=True), actor or '', datetime.utcnow().isoformat()),
+        )
+        created = cur.rowcount == 1
+        cur.execute(
+            f"SELECT {JOB_COLUMNS} FROM report_jobs WHERE job_key = ? AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1",
+            (key,),
+        )
+        row = cur.fetchone()
+        return (dict(row) if row else None), created
+
+    job, created = run_write(put, immediate=True)
+    if job is None:
+        # The in-flight twin finished between the INSERT and the SELECT
+        return enqueue(kind, tenant_slug, filters, actor)
+    if created:
+        submit(job['id'])
+    return job
+
+
+def request_filters(*names):
+    """Filters of an export request: tenant_slug, the named query args and gzip."""
+    filters = {'tenant_slug': request.args.get('tenant_slug') or request.args.get('slug') or 'gastronomia-local1'}
+    for name in names:
+        value = str(request.args.get(name) or '').strip()
+        if value:
+            filters[name] = value.lower() if name == 'detail' else value
+    if str(request.args.get('gzip') or '').strip().lower() in ('1', 'true', 'yes'):
+        filters['gzip'] = True
+    return filters
+
+
+def job_payload(job):
+    out = {k: job.get(k) for k in ('id', 'kind', 'status', 'created_at', 'started_at', 'finished_at', 'expires_at', 'file_name', 'size_bytes', 'error')}
+    out['url'] = f"/api/reports/{job['id']}"
+    if job.get('status') == 'done':
+        out['download_url'] = f"/api/reports/{job['id']}/download"
+    return out
+
+
+def queue_report(kind, filters):
+    """202 response for the POST variant of an export; the caller checked auth and CSRF."""
+    if not reports_ready():
+        return jsonify({'error': 'reportes no disponibles'}), 503
+    job = enqueue(kind, filters['tenant_slug'], filters, actor=str(session.get('admin_user') or '').strip())
+    return jsonify(job_payload(job)), 202
+
+
+def get_job(job_id):
+    cur = get_db().cursor()
+    cur.execute(f"SELECT {JOB_COLUMNS}, file_path FROM report_jobs WHERE id = ?", (int(job_id),))
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(tenant_slug, actor, limit=20):
+    cur = get_db().cursor()
+    cur.execute(
+        f"SELECT {JOB_COLUMNS} FROM report_jobs WHERE tenant_slug = ? AND lower(created_by) = lower(?) ORDER BY id DESC LIMIT ?",
+        (tenant_slug, actor or '', int(limit)),
+    )
+    return [dict(r) for r in (cur.fetchall() or [])]
+
+
+def submit(job_id):
+    """Hand the job to this process's worker pool."""
+    global _executor
+    app = current_app._get_current_object()
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, REPORT_WORKERS), thread_name_prefix='report')
+    _executor.submit(_run, app, int(job_id))
+
+
+def _claim(job_id, claim):
+    def take(cur):
+        cur.execute(
+            "UPDATE report_jobs SET status = 'running', started_at = ?, claim = ? WHERE id = ? AND status = 'queued'",
+            (datetime.utcnow().isoformat(), claim, job_id),
+        )
+        if cur.rowcount != 1:
+            return None
+        cur.execute("SELECT kind, filters_json FROM report_jobs WHERE id = ?", (job_id,))
+        row = cur.fetchone()
+        return (row[0], json.loads(row[1] or '{}')) if row else None
+    return run_write(take, immediate=True)
+
+
+def _finish(job_id, claim, **fields):
+    now = datetime.utcnow()
+    fields['finished_at'] = now.isoformat()
+    fields['expires_at'] = (now + timedelta(seconds=REPORT_TTL_SECONDS)).isoformat()
+    sets = ", ".join(f"{k} = ?" for k in fields)
+
+    def done(cur):
+        # A job re-queued as stale may have been claimed again; only the current claim writes
+        cur.execute(f"UPDATE report_jobs SET {sets} WHERE id = ? AND claim = ?", list(fields.values()) + [job_id, claim])
+        return cur.rowcount == 1
+    return run_write(done)
+
+
+def _write_file(path, fmt, built, compress):
+    tmp = f"{path}.part"
+    size = 0
+    with open(tmp, 'wb') as fh:
+        if fmt == 'json':
+            data = json.dumps(built[1], ensure_ascii=False, default=str).encode('utf-8')
+            fh.write(data)
+            size = len(data)
+        else:
+            _, header, rows = built
+            for chunk in stream_csv(header, rows, compress=compress):
+                data = chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+                fh.write(data)
+                size += len(data)
+    os.replace(tmp, path)
+    return size
+
+
+def _run(app, job_id):
+    with app.app_context():
+        claim = secrets.token_hex(8)
+        try:
+            claimed = _claim(job_id, claim)
+        except Exception as e:
+            print(f"Report job {job_id} not claimed: {e}")
+            return
+        if not claimed:
+            return
+        kind, filters = claimed
+        path = None
+        try:
+            fmt, builder = REPORT_KINDS[kind]
+            built = builder(filters)
+            compress = fmt == 'csv' and bool(filters.get('gzip'))
+            file_name = built[0] + ('.gz' if compress else '')
+            path = os.path.join(reports_dir(), f"{job_id}_{secrets.token_hex(8)}_{os.path.basename(file_name)}")
+            size = _write_file(path, fmt, built, compress)
+            if not _finish(job_id, claim, status='done', file_name=file_name, file_path=os.path.basename(path), size_bytes=size):
+                _remove(path)
+                return
+            print(f"Report job {job_id} ({kind}) done: {size} bytes.")
+        except Exception as e:
+            print(f"Report job {job_id} ({kind}) failed: {e}")
+            if path:
+                _remove(path)
+                _remove(f"{path}.part")
+            try:
+                _finish(job_id, claim, status='failed', error=str(e)[:500])
+            except Exception as e2:
+                print(f"Report job {job_id} failure not recorded: {e2}")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def sweep():
+    """Re-queue stale jobs, pick up queued ones and drop expired jobs; returns {'requeued', 'expired'}."""
+    if not reports_ready():
+        return None
+    now = datetime.utcnow()
+    stale = (now - timedelta(seconds=REPORT_STALE_SECONDS)).isoformat()
+
+    def requeue(cur):
+        cur.execute(
+            "UPDATE report_jobs SET status = 'queued', claim = NULL WHERE status = 'running' AND started_at <= ?",
+            (stale,),
+        )
+        n = max(0, cur.rowcount or 0)
+        cur.execute("SELECT id FROM report_jobs WHERE status = 'queued' ORDER BY id")
+        return n, [int(r[0]) for r in (cur.fetchall() or [])]
+
+    def expire(cur):
+        cur.execute("SELECT id, file_path FROM report_jobs WHERE expires_at <= ? ORDER BY id", (now.isoformat(),))
+        rows = [(int(r[0]), r[1]) for r in (cur.fetchall() or [])]
+        if rows:
+            ids = [r[0] for r in rows]
+            cur.execute(f"DELETE FROM report_jobs WHERE id IN ({', '.join(['?'] * len(ids))})", ids)
+        return rows
+
+    requeued, queued = run_write(requeue, immediate=True)
+    # Jobs queued by a process that died before running them; claiming makes a double submit harmless
+    for job_id in queued:
+        submit(job_id)
+    expired = run_write(expire)
+    for _, file_path in expired:
+        if file_path:
+            _remove(os.path.join(reports_dir(), os.path.basename(file_path)))
+    if requeued or expired:
+        print(f"Report jobs: {requeued} re-queued, {len(expired)} expired.")
+    return {'requeued': requeued, 'expired': len(expired)}
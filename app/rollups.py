@@ -0,0 +1,305 @@
+"""Hourly and daily per-tenant order rollups for the owner metrics.
+
+order_rollups holds, per (tenant, grain, bucket, order_type), the delivered
+and canceled counts and amounts, tips, shipping, the summed minutes from
+creation to preparacion/listo/entregado and a histogram of the minutes to
+entregado. A delivered order counts in the buckets of its delivered_at, a
+canceled one in those of its canceled_at.
+
+Each order remembers what it currently contributes in orders.rollup_state, so
+apply_order can be called after any write that may change it (status change,
+payment, content edit): it subtracts the old contribution and adds the new
+one. rebuild() recomputes everything from the orders tables.
+
+totals() answers [from, to] with day rows for whole days, hour rows for
+whole hours and an exact query on orders only for partial hours at the edges.
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from app.database import is_postgres
+
+# Migration that created order_rollups
+ROLLUP_SCHEMA_VERSION = 12
+
+# grain -> length of the timestamp prefix that names its bucket
+GRAINS = (('hour', 13), ('day', 10))
+# Minutes-to-entregado histogram: upper bounds, plus an overflow bucket
+DURATION_BUCKETS = (10, 20, 30, 45, 60, 90)
+HISTOGRAM_COLUMNS = tuple(f"dur_le_{b}" for b in DURATION_BUCKETS) + (f"dur_gt_{DURATION_BUCKETS[-1]}",)
+
+COUNTER_COLUMNS = (
+    'delivered_count', 'delivered_total', 'tip_total', 'shipping_total',
+    'canceled_count', 'canceled_total',
+    'prep_count', 'prep_minutes', 'ready_count', 'ready_minutes', 'deliver_count', 'deliver_minutes',
+) + HISTOGRAM_COLUMNS
+
+ORDER_COLUMNS = "id, tenant_slug, order_type, status, total, tip_amount, shipping_cost, created_at, preparing_at, ready_at, delivered_at, canceled_at"
+
+
+def rollups_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= ROLLUP_SCHEMA_VERSION
+
+
+def create_rollup_table(cur, pg):
+    counters = ",\n            ".join(f"{c} INTEGER NOT NULL DEFAULT 0" for c in COUNTER_COLUMNS)
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS order_rollups (
+            tenant_slug TEXT NOT NULL,
+            grain TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            order_type TEXT NOT NULL,
+            {counters},
+            PRIMARY KEY (tenant_slug, grain, bucket, order_type)
+        )
+        """
+    )
+
+
+def _parse(ts):
+    if not ts:
+        return None
+    try:
+        s = str(ts).strip()
+        if s.endswith('Z'):
+            s = s[:-1] + '+00:00'
+        dt = datetime.fromisoformat(s)
+    except Exception:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _minutes(start, end):
+    # Same rounding as the old per-request averages: whole minutes, never negative
+    a, b = _parse(start), _parse(end)
+    if not a or not b:
+        return None
+    return max(0, int((b - a).total_seconds() // 60))
+
+
+def contribution(row):
+    """[kind, timestamp, order_type, {column: delta}] the order adds to the rollups, or None."""
+    status = str(row[3] or '').strip().lower()
+    order_type = str(row[2] or '').strip().lower()
+    if status == 'entregado' and row[10]:
+        c = {
+            'delivered_count': 1,
+            'delivered_total': int(row[4] or 0),
+            'tip_total': int(row[5] or 0),
+            'shipping_total': int(row[6] or 0),
+        }
+        for count_col, sum_col, ts in (('prep_count', 'prep_minutes', row[8]), ('ready_count', 'ready_minutes', row[9]), ('deliver_count', 'deliver_minutes', row[10])):
+            m = _minutes(row[7], ts)
+            if m is not None:
+                c[count_col] = 1
+                c[sum_col] = m
+        m = c.get('deliver_minutes')
+        if 'deliver_count' in c:
+            col = next((f"dur_le_{b}" for b in DURATION_BUCKETS if m <= b), HISTOGRAM_COLUMNS[-1])
+            c[col] = 1
+        return ['entregado', str(row[10]), order_type, c]
+    if status == 'cancelado' and row[11]:
+        return ['cancelado', str(row[11]), order_type, {'canceled_count': 1, 'canceled_total': int(row[4] or 0)}]
+    return None
+
+
+def _add(cur, tenant_slug, contrib, sign):
+    _, ts, order_type, counters = contrib
+    cols = [c for c in COUNTER_COLUMNS if counters.get(c)]
+    if not cols:
+        return
+    for grain, n in GRAINS:
+        bucket = ts[:n]
+        cur.execute(
+            "INSERT OR IGNORE INTO order_rollups (tenant_slug, grain, bucket, order_type) VALUES (?, ?, ?, ?)",
+            (tenant_slug, grain, bucket, order_type),
+        )
+        cur.execute(
+            f"UPDATE order_rollups SET {', '.join(f'{c} = {c} + ?' for c in cols)} "
+            "WHERE tenant_slug = ? AND grain = ? AND bucket = ? AND order_type = ?",
+            [sign * int(counters[c]) for c in cols] + [tenant_slug, grain, bucket, order_type],
+        )
+
+
+def apply_order(cur, order_id):
+    """Bring order_rollups in line with the order's current state. The caller commits."""
+    if not rollups_ready():
+        return
+    # Hold the row so a concurrent rebuild() can't re-point rollup_state between this read and the update
+    lock = " FOR UPDATE" if is_postgres() else ""
+    cur.execute(f"SELECT {ORDER_COLUMNS}, rollup_state FROM orders WHERE id = ?{lock}", (order_id,))
+    row = cur.fetchone()
+    if not row:
+        return
+    new = contribution(row)
+    new_state = json.dumps(new, sort_keys=True) if new else None
+    old_state = row[12] or None
+    if new_state == old_state:
+        return
+    tenant_slug = str(row[1] or '')
+    if old_state:
+        try:
+            _add(cur, tenant_slug, json.loads(old_state), -1)
+        except Exception as e:
+            print(f"Rollup state of order {order_id} ignored: {e}")
+    if new:
+        _add(cur, tenant_slug, new, 1)
+    cur.execute("UPDATE orders SET rollup_state = ? WHERE id = ?", (new_state, order_id))
+
+
+def rebuild(cur, tenant_slug=None, suffixes=None, batch=1000):
+    """Recompute order_rollups (and orders.rollup_state) from the orders tables; returns orders counted.
+
+    suffixes defaults to every tier the running schema has (see cold_archive.tiers).
+    On SQLite the caller's write transaction already excludes order writes; on
+    PostgreSQL the table lock below waits for transactions that already touched
+    order_rollups and makes apply_order wait until this one commits, so no
+    increment lands on deleted rows or is counted twice. An order write caught
+    between its orders UPDATE and apply_order deadlocks with the rollup_state
+    update here instead; PostgreSQL rolls one of them back.
+    """
+    from app.cold_archive import tiers
+    if is_postgres():
+        cur.execute("LOCK TABLE order_rollups IN EXCLUSIVE MODE")
+    tenant_sql = " AND tenant_slug = ?" if tenant_slug else ""
+    tenant_params = [tenant_slug] if tenant_slug else []
+    cur.execute(f"DELETE FROM order_rollups WHERE 1 = 1{tenant_sql}", tenant_params)
+    totals = {}
+    counted = 0
+    for sfx in suffixes or tiers():
+        last_id = 0
+        while True:
+            cur.execute(
+                f"SELECT {ORDER_COLUMNS} FROM orders{sfx} WHERE id > ? AND status IN ('entregado', 'cancelado'){tenant_sql} ORDER BY id LIMIT ?",
+                [last_id] + tenant_params + [batch],
+            )
+            rows = cur.fetchall() or []
+            if not rows:
+                break
+            states = []
+            for row in rows:
+                contrib = contribution(row)
+                states.append((json.dumps(contrib, sort_keys=True) if contrib else None, row[0]))
+                if not contrib:
+                    continue
+                counted += 1
+                _, ts, order_type, counters = contrib
+                for grain, n in GRAINS:
+                    acc = totals.setdefault((str(row[1] or ''), grain, ts[:n], order_type), {})
+                    for c, v in counters.items():
+                        acc[c] = acc.get(c, 0) + int(v)
+            if not sfx:
+                cur.executemany("UPDATE orders SET rollup_state = ? WHERE id = ?", states)
+            last_id = rows[-1][0]
+    cur.execute(
+        f"UPDATE orders SET rollup_state = NULL WHERE rollup_state IS NOT NULL AND status NOT IN ('entregado', 'cancelado'){tenant_sql}",
+        tenant_params,
+    )
+    placeholders = ", ".join(['?'] * (4 + len(COUNTER_COLUMNS)))
+    cur.executemany(
+        f"INSERT INTO order_rollups (tenant_slug, grain, bucket, order_type, {', '.join(COUNTER_COLUMNS)}) VALUES ({placeholders})",
+        [list(key) + [acc.get(c, 0) for c in COUNTER_COLUMNS] for key, acc in totals.items()],
+    )
+    return counted
+
+
+def _floor(dt, grain):
+    if grain == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil(dt, grain):
+    f = _floor(dt, grain)
+    return f if f == dt else f + (timedelta(days=1) if grain == 'day' else timedelta(hours=1))
+
+
+def _plan(from_ts, to_ts):
+    """Split [from_ts, to_ts] into ('raw', lo, hi) edges and ('hour'|'day', first, end) bucket ranges.
+
+    raw ranges keep the caller's bounds (lo inclusive, hi inclusive when it is
+    to_ts, exclusive otherwise); bucket ranges are [first, end) on bucket names.
+    """
+    lo = _parse(from_ts) if from_ts else None
+    hi = _parse(to_ts) if to_ts else None
+    if (from_ts and lo is None) or (to_ts and hi is None):
+        return [('raw', from_ts, to_ts)]
+    # Exclusive end: an hour only counts as whole when to_ts reaches its last microsecond
+    end = hi + timedelta(microseconds=1) if hi else None
+    h_start = _ceil(lo, 'hour') if lo else None
+    h_end = _floor(end, 'hour') if end else None
+    if h_start and h_end and h_start >= h_end:
+        return [('raw', from_ts, to_ts)]
+    plan = []
+    if lo and h_start != lo:
+        plan.append(('raw', from_ts, h_start.isoformat()))
+    d_start = _ceil(h_start, 'day') if h_start else None
+    d_end = _floor(h_end, 'day') if h_end else None
+    if d_start is None or d_end is None or d_start < d_end:
+        if h_start and h_start != d_start:
+            plan.append(('hour', h_start, d_start))
+        plan.append(('day', d_start, d_end))
+        if h_end and h_end != d_end:
+            plan.append(('hour', d_end, h_end))
+    else:
+        plan.append(('hour', h_start, h_end))
+    if hi and h_end != end:
+        plan.append(('raw', h_end.isoformat(), to_ts))
+    return plan
+
+
+def _bucket_name(dt, grain):
+    return dt.isoformat()[:dict(GRAINS)[grain]] if dt else None
+
+
+def _raw_totals(cur, tenant_slug, lo, hi, inclusive_hi):
+    """Exact contribution of orders delivered/canceled in a partial-hour edge."""
+    from app.cold_archive import tiers
+    acc = {}
+    op = '<=' if inclusive_hi else '<'
+    for sfx in tiers(lo):
+        for col, status in (('delivered_at', 'entregado'), ('canceled_at', 'cancelado')):
+            sql = f"SELECT {ORDER_COLUMNS} FROM orders{sfx} WHERE tenant_slug = ? AND status = ? AND {col} IS NOT NULL"
+            params = [tenant_slug, status]
+            if lo:
+                sql += f" AND {col} >= ?"
+                params.append(lo)
+            if hi:
+                sql += f" AND {col} {op} ?"
+                params.append(hi)
+            cur.execute(sql, params)
+            for row in cur.fetchall() or []:
+                contrib = contribution(row)
+                if contrib:
+                    for c, v in contrib[3].items():
+                        acc[c] = acc.get(c, 0) + int(v)
+    return acc
+
+
+def totals(cur, tenant_slug, from_ts=None, to_ts=None):
+    """{counter column: total} for orders delivered/canceled in [from_ts, to_ts]."""
+    acc = {c: 0 for c in COUNTER_COLUMNS}
+    sums = ", ".join(f"COALESCE(SUM({c}), 0)" for c in COUNTER_COLUMNS)
+    # Before migration 12 the whole range is read from orders
+    plan = _plan(from_ts, to_ts) if rollups_ready() else [('raw', from_ts, to_ts)]
+    for kind, a, b in plan:
+        if kind == 'raw':
+            part = _raw_totals(cur, tenant_slug, a, b, inclusive_hi=(b == to_ts))
+        else:
+            sql = f"SELECT {sums} FROM order_rollups WHERE tenant_slug = ? AND grain = ?"
+            params = [tenant_slug, kind]
+            if a:
+                sql += " AND bucket >= ?"
+                params.append(_bucket_name(a, kind))
+            if b:
+                sql += " AND bucket < ?"
+                params.append(_bucket_name(b, kind))
+            cur.execute(sql, params)
+            row = cur.fetchone() or [0] * len(COUNTER_COLUMNS)
+            part = {c: int(row[i] or 0) for i, c in enumerate(COUNTER_COLUMNS)}
+        for c, v in part.items():
+            acc[c] += v
+    return acc
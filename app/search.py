@@ -0,0 +1,157 @@
+"""Order search over customer name, phone, table number and address.
+
+Text is accent-folded and lower-cased into orders.search_text when an order is
+written. SQLite indexes it with an FTS5 trigram table (orders_search, kept in
+sync by triggers); Postgres with a pg_trgm GIN index. When neither is
+available the same column is scanned with LIKE.
+"""
+import json
+import unicodedata
+from flask import current_app
+
+# FTS5 trigram only matches needles of at least 3 characters
+FTS_MIN_CHARS = 3
+
+
+def normalize(s):
+    s = str(s or '').lower()
+    s = ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
+    return ' '.join(s.split())
+
+
+def _address_text(address_json):
+    if isinstance(address_json, str):
+        try:
+            address_json = json.loads(address_json) if address_json.strip() else {}
+        except Exception:
+            return address_json
+    if isinstance(address_json, dict):
+        return ' '.join(str(v) for v in address_json.values() if isinstance(v, (str, int, float)) and str(v).strip())
+    return str(address_json or '')
+
+
+def order_search_text(customer_name, customer_phone, table_number, address_json):
+    return normalize(' '.join([
+        str(customer_name or ''),
+        str(customer_phone or ''),
+        str(table_number or ''),
+        _address_text(address_json),
+    ]))
+
+
+def create_search_index(cur, pg):
+    """DDL for the search index; failures leave the plain LIKE fallback in place."""
+    if pg:
+        try:
+            cur.execute("SAVEPOINT search_trgm")
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_search_trgm ON orders USING gin (search_text gin_trgm_ops)")
+            cur.execute("RELEASE SAVEPOINT search_trgm")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT search_trgm")
+            print(f"pg_trgm not available, order search uses LIKE: {e}")
+        return
+    try:
+        cur.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS orders_search USING fts5("
+            "search_text, content='orders', content_rowid='id', tokenize='trigram')"
+        )
+    except Exception as e:
+        print(f"FTS5 trigram not available, order search uses LIKE: {e}")
+        return
+    # Index every existing row first: the update trigger's 'delete' requires the row to be indexed
+    cur.execute("INSERT INTO orders_search(orders_search) VALUES ('rebuild')")
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_search_ai AFTER INSERT ON orders BEGIN
+            INSERT INTO orders_search(rowid, search_text) VALUES (new.id, COALESCE(new.search_text, ''));
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_search_ad AFTER DELETE ON orders BEGIN
+            INSERT INTO orders_search(orders_search, rowid, search_text) VALUES ('delete', old.id, COALESCE(old.search_text, ''));
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_search_au AFTER UPDATE OF search_text ON orders BEGIN
+            INSERT INTO orders_search(orders_search, rowid, search_text) VALUES ('delete', old.id, COALESCE(old.search_text, ''));
+            INSERT INTO orders_search(rowid, search_text) VALUES (new.id, COALESCE(new.search_text, ''));
+        END
+        """
+    )
+
+
+def backfill_search_text(cur, batch=500):
+    # On SQLite the orders_search_au trigger indexes each row as search_text is filled
+    last_id = 0
+    while True:
+        cur.execute(
+            "SELECT id, customer_name, customer_phone, table_number, address_json FROM orders WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch),
+        )
+        rows = cur.fetchall() or []
+        if not rows:
+            break
+        cur.executemany(
+            "UPDATE orders SET search_text = ? WHERE id = ?",
+            [(order_search_text(r[1], r[2], r[3], r[4]), r[0]) for r in rows],
+        )
+        last_id = rows[-1][0]
+
+
+def detect_search_backend(cur, pg):
+    backend = 'like'
+    try:
+        if pg:
+            cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_orders_search_trgm'")
+            if cur.fetchone():
+                backend = 'trgm'
+        else:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders_search'")
+            if cur.fetchone():
+                backend = 'fts5'
+    except Exception:
+        pass
+    current_app.config['SEARCH_BACKEND'] = backend
+    return backend
+
+
+def search_filter(q, alias='', cold=False):
+    """SQL fragment (starting with ' AND') and params matching orders against q.
+
+    cold: the alias is an orders_archive row, which the FTS5 table does not index.
+    """
+    col = f"{alias}." if alias else ''
+    nq = normalize(q)
+    backend = current_app.config.get('SEARCH_BACKEND')
+    if backend is None:
+        # Schema not migrated: raw columns, as before search_text existed
+        like = f"%{q}%"
+        return (
+            f" AND (COALESCE({col}address_json,'') LIKE ? OR COALESCE({col}customer_name,'') LIKE ? "
+            f"OR COALESCE({col}customer_phone,'') LIKE ? OR COALESCE({col}table_number,'') LIKE ?)",
+            [like, like, like, like],
+        )
+    if backend == 'fts5' and len(nq) >= FTS_MIN_CHARS and not cold:
+        return f" AND {col}id IN (SELECT rowid FROM orders_search WHERE orders_search MATCH ?)", [_fts_phrase(nq)]
+    return f" AND COALESCE({col}search_text,'') LIKE ?", [f"%{nq}%"]
+
+
+def relevance_order(q, alias='', cold=False):
+    """ORDER BY expression ranking matches best-first, or None when the backend cannot rank."""
+    col = f"{alias}." if alias else ''
+    nq = normalize(q)
+    backend = current_app.config.get('SEARCH_BACKEND')
+    if backend == 'fts5' and len(nq) >= FTS_MIN_CHARS and not cold:
+        return f"(SELECT rank FROM orders_search WHERE orders_search MATCH ? AND rowid = {col}id) ASC, {col}id DESC", [_fts_phrase(nq)]
+    if backend == 'trgm':
+        return f"similarity(COALESCE({col}search_text,''), ?) DESC, {col}id DESC", [nq]
+    return None, []
+
+
+def _fts_phrase(nq):
+    return '"' + nq.replace('"', '""') + '"'
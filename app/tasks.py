@@ -1,78 +1,148 @@
+import os
+import socket
 import threading
 import time
 from datetime import datetime, timedelta
 from flask import current_app
+from app.database import is_postgres
+from app.changes import record_order_change, prune_order_changes
+from app.writer import run_write
+from app.cold_archive import ARCHIVE_COLD_AFTER_DAYS, ARCHIVE_COLD_BATCH, cold_ready, hot_horizon, sync_cold_columns, move_batch
+from app import reports
 
-def _auto_archive_once_logic(conn):
-    try:
-        cur = conn.cursor()
-        cutoff_dt = datetime.utcnow() - timedelta(hours=24)
-        cutoff = cutoff_dt.isoformat()
-        
-        # 1. Archive delivered orders
+# Migration that created task_leases
+LEASE_SCHEMA_VERSION = 10
+
+AUTO_ARCHIVE_INTERVAL = int(os.environ.get('AUTO_ARCHIVE_INTERVAL_SECONDS', '300') or '300')
+# Short-lived processes (CLI scripts) exit before the first run and never take the lease
+BACKGROUND_TASKS_DELAY = int(os.environ.get('BACKGROUND_TASKS_DELAY_SECONDS', '30') or '30')
+# The leader renews every interval; a dead leader is replaced after the lease runs out
+LEASE_SECONDS = AUTO_ARCHIVE_INTERVAL * 2 + 60
+# Arbitrary constant; serializes archiver runs across Postgres workers
+ARCHIVE_LOCK_KEY = 7265040102
+
+TASK_HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+# archive type -> (order status, timestamp column, extra condition)
+ARCHIVE_RULES = (
+    ('delivered', 'entregado', 'delivered_at', " AND o.payment_status = 'paid'"),
+    ('canceled', 'cancelado', 'canceled_at', ""),
+)
+
+
+def acquire_lease(name, holder=TASK_HOLDER, seconds=LEASE_SECONDS):
+    """Take or renew the task_leases row for name; True when holder is the leader."""
+    if int(current_app.config.get('SCHEMA_VERSION') or 0) < LEASE_SCHEMA_VERSION:
+        return True
+    now = datetime.utcnow()
+
+    def take(cur):
         cur.execute(
-            """
-            SELECT o.id, o.tenant_slug
-            FROM orders o
-            JOIN (
-              SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'entregado' GROUP BY order_id
-            ) h ON h.order_id = o.id
-            LEFT JOIN archived_orders a ON a.order_id = o.id AND a.type = 'delivered'
-            WHERE a.order_id IS NULL AND h.last_change <= ? AND o.payment_status = 'paid'
-            """,
-            (cutoff,)
+            "INSERT OR IGNORE INTO task_leases (name, holder, expires_at) VALUES (?, ?, ?)",
+            (name, '', now.isoformat()),
         )
-        rows_del = cur.fetchall()
-        for r in rows_del:
-            oid = r[0]
-            slug = r[1]
-            cur.execute(
-                "INSERT OR IGNORE INTO archived_orders (order_id, tenant_slug, type, archived_at) VALUES (?, ?, 'delivered', ?)",
-                (oid, slug, cutoff)
-            )
-            
-        # 2. Archive canceled orders
         cur.execute(
-            """
-            SELECT o.id, o.tenant_slug
-            FROM orders o
-            JOIN (
-              SELECT order_id, MAX(changed_at) AS last_change FROM order_status_history WHERE status = 'cancelado' GROUP BY order_id
-            ) h ON h.order_id = o.id
-            LEFT JOIN archived_orders a ON a.order_id = o.id AND a.type = 'canceled'
-            WHERE a.order_id IS NULL AND h.last_change <= ?
-            """,
-            (cutoff,)
+            "UPDATE task_leases SET holder = ?, expires_at = ? WHERE name = ? AND (holder = ? OR expires_at <= ?)",
+            (holder, (now + timedelta(seconds=seconds)).isoformat(), name, holder, now.isoformat()),
         )
-        rows_can = cur.fetchall()
-        for r in rows_can:
-            oid = r[0]
-            slug = r[1]
+        return cur.rowcount == 1
+
+    try:
+        return bool(run_write(take))
+    except Exception as e:
+        print(f"Task lease {name} not acquired: {e}")
+        return False
+
+
+def _auto_archive_once_logic(conn=None):
+    """Archive orders finished more than 24h ago; returns {'delivered', 'canceled', 'ms'} or None."""
+    started = time.time()
+    cutoff = (datetime.utcnow() - timedelta(hours=24)).isoformat()
+
+    def archive(cur):
+        if is_postgres():
+            cur.execute("SELECT pg_try_advisory_xact_lock(?)", (ARCHIVE_LOCK_KEY,))
+            row = cur.fetchone()
+            if not row or not row[0]:
+                return None
+        counts = {}
+        tenants = set()
+        for kind, status, column, extra in ARCHIVE_RULES:
+            where = (
+                f"WHERE o.status = ? AND o.{column} <= ?{extra} "
+                f"AND NOT EXISTS (SELECT 1 FROM archived_orders a WHERE a.order_id = o.id AND a.type = ?)"
+            )
+            # Tenants touched, for the change feed; same rows the INSERT below picks up
+            cur.execute(f"SELECT DISTINCT o.tenant_slug FROM orders o {where}", (status, cutoff, kind))
+            tenants.update(str(r[0] or '') for r in (cur.fetchall() or []))
             cur.execute(
-                "INSERT OR IGNORE INTO archived_orders (order_id, tenant_slug, type, archived_at) VALUES (?, ?, 'canceled', ?)",
-                (oid, slug, cutoff)
+                f"INSERT OR IGNORE INTO archived_orders (order_id, tenant_slug, type, archived_at) "
+                f"SELECT o.id, o.tenant_slug, ?, ? FROM orders o {where}",
+                (kind, cutoff, status, cutoff, kind),
             )
-            
-        conn.commit()
-    except Exception:
-        pass
+            counts[kind] = max(0, cur.rowcount or 0)
+        for slug in sorted(tenants):
+            record_order_change(cur, slug, None, 'archived')
+        return counts
+
+    try:
+        counts = run_write(archive, immediate=True)
+    except Exception as e:
+        print(f"Auto-archive failed: {e}")
+        return None
+    if counts is None:
+        return None
+    counts['ms'] = int((time.time() - started) * 1000)
+    print(f"Auto-archive: {counts['delivered']} delivered, {counts['canceled']} canceled archived in {counts['ms']} ms.")
+    return counts
+
+
+def _move_cold_once():
+    """Move orders archived before the hot horizon into the cold tier; returns {'moved', 'ms'} or None."""
+    if ARCHIVE_COLD_AFTER_DAYS <= 0 or not cold_ready():
+        return None
+    started = time.time()
+    cutoff = hot_horizon()
+    moved = 0
+    try:
+        run_write(lambda cur: sync_cold_columns(cur, is_postgres()))
+        while True:
+            # One short write transaction per batch so order writes are not held up
+            n = run_write(lambda cur: move_batch(cur, cutoff))
+            moved += n
+            if n < ARCHIVE_COLD_BATCH:
+                break
+    except Exception as e:
+        print(f"Cold archive move failed after {moved} orders: {e}")
+        return None
+    result = {'moved': moved, 'ms': int((time.time() - started) * 1000)}
+    if moved:
+        print(f"Cold archive: {moved} orders moved in {result['ms']} ms.")
+    return result
+
 
 def start_background_tasks(app):
     if getattr(app, '_bg_started', False):
         return
+    if not app.config.get('BACKGROUND_TASKS', True):
+        return
     app._bg_started = True
-    
+
     def loop():
+        time.sleep(BACKGROUND_TASKS_DELAY)
         while True:
             try:
                 # We need application context to access database config via get_db
                 with app.app_context():
                     from app.database import get_db
-                    conn = get_db()
-                    _auto_archive_once_logic(conn)
-            except Exception:
-                pass
-            time.sleep(300)
-            
+                    if acquire_lease('auto_archive'):
+                        _auto_archive_once_logic()
+                        _move_cold_once()
+                        prune_order_changes(get_db())
+                        reports.sweep()
+            except Exception as e:
+                print(f"Background tasks error: {e}")
+            time.sleep(AUTO_ARCHIVE_INTERVAL)
+
     t = threading.Thread(target=loop, daemon=True)
     t.start()
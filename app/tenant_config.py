@@ -0,0 +1,239 @@
+"""Per-process cache of tenant_config rows, kept in step across processes.
+
+Every write goes through save_tenant_config, which bumps
+tenant_config.config_version in the same statement. Readers keep
+(config_version, config) per tenant in a bounded LRU and, once an entry is
+older than TENANT_CONFIG_CHECK_SECONDS, re-read only the version; the JSON is
+reloaded when it moved. A write in another worker or node is therefore seen
+within a few seconds instead of after the old 5 minute TTL.
+
+On PostgreSQL, TENANT_CONFIG_LISTEN=1 also starts a LISTEN thread: writers
+NOTIFY tenant_config with the slug and every process drops that entry at once,
+so while the listener is connected the version checks back off to
+TENANT_CONFIG_TTL.
+
+A miss or a due check is done by one thread per tenant; concurrent readers get
+the entry being revalidated, or wait for the first load, instead of all going
+to the database together.
+
+compiled_payload keeps public JSON derived from a tenant's config (storefront
+header, checkout) as ready-to-send bytes with their ETag, rebuilt only when
+the cached config itself is replaced or the tenant is invalidated.
+"""
+import os
+import json
+import time
+import hashlib
+import select
+import threading
+from collections import OrderedDict
+from flask import current_app
+from app.database import get_db, is_postgres, HAS_PSYCOPG2
+
+# Migration that added tenant_config.config_version
+CONFIG_VERSION_SCHEMA_VERSION = 15
+
+TENANT_CONFIG_CACHE_MAX = int(os.environ.get('TENANT_CONFIG_CACHE_MAX', '1024') or '1024')
+TENANT_CONFIG_CHECK_SECONDS = float(os.environ.get('TENANT_CONFIG_CHECK_SECONDS', '3') or '3')
+# Upper bound on staleness when the version can't be checked (schema not migrated) or the listener is up
+TENANT_CONFIG_TTL = float(os.environ.get('TENANT_CONFIG_TTL', '300') or '300')
+# How long readers wait on another thread's first load before loading themselves
+TENANT_CONFIG_LOAD_WAIT = float(os.environ.get('TENANT_CONFIG_LOAD_WAIT', '5') or '5')
+TENANT_CONFIG_LISTEN = str(os.environ.get('TENANT_CONFIG_LISTEN') or '').strip().lower() in ('1', 'true', 'yes')
+NOTIFY_CHANNEL = 'tenant_config'
+
+# slug -> (config_version, config, checked_at), least recently used first
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# slug -> Event set when the thread refreshing that tenant is done
+_refreshing = {}
+# Bumped by every invalidation; a load that overlapped one is stored as already due for a check
+_generation = [0]
+_listening = threading.Event()
+# slug -> {kind: (config it was built from, body, etag)}
+_compiled = OrderedDict()
+
+
+def versions_ready():
+    return int(current_app.config.get('SCHEMA_VERSION') or 0) >= CONFIG_VERSION_SCHEMA_VERSION
+
+
+def save_tenant_config(cur, slug, cfg):
+    """Upsert the tenant's config and bump its config_version. The caller commits."""
+    raw = json.dumps(cfg, ensure_ascii=False)
+    if versions_ready():
+        cur.execute(
+            "INSERT INTO tenant_config (tenant_slug, config_json, config_version) VALUES (?, ?, 1) "
+            "ON CONFLICT (tenant_slug) DO UPDATE SET config_json = excluded.config_json, "
+            "config_version = tenant_config.config_version + 1",
+            (slug, raw),
+        )
+    else:
+        cur.execute("INSERT OR REPLACE INTO tenant_config (tenant_slug, config_json) VALUES (?, ?)", (slug, raw))
+    notify_config_change(cur, slug)
+
+
+def notify_config_change(cur, slug):
+    """Tell listening processes to drop slug; Postgres delivers it on commit."""
+    if is_postgres():
+        cur.execute("SELECT pg_notify(?, ?)", (NOTIFY_CHANNEL, slug))
+
+
+def touch_tenant_config(cur, slug):
+    """Bump config_version for a change outside config_json that the payloads read (e.g. tenants.name).
+
+    A tenant without a config row gets an empty one: a missing row reads as
+    version 0 everywhere, so only a real row can move other processes off it.
+    """
+    if versions_ready():
+        cur.execute(
+            "INSERT INTO tenant_config (tenant_slug, config_json, config_version) VALUES (?, '{}', 1) "
+            "ON CONFLICT (tenant_slug) DO UPDATE SET config_version = tenant_config.config_version + 1",
+            (slug,),
+        )
+    notify_config_change(cur, slug)
+
+
+def invalidate_tenant_config(slug):
+    with _cache_lock:
+        _cache.pop(slug, None)
+        _compiled.pop(slug, None)
+        _generation[0] += 1
+
+
+def cached_tenant_config(slug):
+    """(config_version, config) for slug; config is shared, copy before changing it."""
+    now = time.time()
+    interval = TENANT_CONFIG_TTL if _listening.is_set() or not versions_ready() else TENANT_CONFIG_CHECK_SECONDS
+    with _cache_lock:
+        entry = _cache.get(slug)
+        if entry is not None:
+            _cache.move_to_end(slug)
+            # Fresh, or another thread is revalidating it right now
+            if now - entry[2] < interval or slug in _refreshing:
+                return entry[0], entry[1]
+        done = _refreshing.get(slug)
+        if done is None:
+            done = _refreshing[slug] = threading.Event()
+            leader = True
+        else:
+            leader = False
+    if not leader:
+        done.wait(TENANT_CONFIG_LOAD_WAIT)
+        with _cache_lock:
+            entry = _cache.get(slug)
+        if entry is not None:
+            return entry[0], entry[1]
+        return _load(slug, None)
+    try:
+        return _load(slug, entry)
+    finally:
+        with _cache_lock:
+            _refreshing.pop(slug, None)
+        done.set()
+
+
+def get_cached_tenant_config(slug):
+    return cached_tenant_config(slug)[1]
+
+
+def compiled_payload(kind, slug, build):
+    """(body, etag) of build(cfg) serialised like jsonify, cached until slug's config changes."""
+    _, cfg = cached_tenant_config(slug)
+    with _cache_lock:
+        built = _compiled.get(slug, {}).get(kind)
+    # The cache hands out the same dict until the config is reloaded, so identity is the version
+    if built is not None and built[0] is cfg:
+        return built[1], built[2]
+    body = current_app.json.response(build(cfg)).get_data()
+    etag = hashlib.sha1(body).hexdigest()
+    with _cache_lock:
+        _compiled.setdefault(slug, {})[kind] = (cfg, body, etag)
+        _compiled.move_to_end(slug)
+        while len(_compiled) > TENANT_CONFIG_CACHE_MAX:
+            _compiled.popitem(last=False)
+    return body, etag
+
+
+def _store(slug, version, cfg, generation):
+    with _cache_lock:
+        _cache[slug] = (version, cfg, time.time() if generation == _generation[0] else 0)
+        _cache.move_to_end(slug)
+        while len(_cache) > TENANT_CONFIG_CACHE_MAX:
+            _cache.popitem(last=False)
+
+
+def _load(slug, entry):
+    """Revalidate entry (or load slug) from the database and cache the result."""
+    generation = _generation[0]
+    try:
+        cur = get_db().cursor()
+        ready = versions_ready()
+        if entry is not None and ready:
+            cur.execute("SELECT config_version FROM tenant_config WHERE tenant_slug = ?", (slug,))
+            row = cur.fetchone()
+            if int((row[0] if row else 0) or 0) == entry[0]:
+                _store(slug, entry[0], entry[1], generation)
+                return entry[0], entry[1]
+        if ready:
+            cur.execute("SELECT config_json, config_version FROM tenant_config WHERE tenant_slug = ?", (slug,))
+        else:
+            cur.execute("SELECT config_json, 0 FROM tenant_config WHERE tenant_slug = ?", (slug,))
+        row = cur.fetchone()
+    except Exception as e:
+        print(f"Error fetching config for {slug}: {e}")
+        return (entry[0], entry[1]) if entry is not None else (0, {})
+    # Unknown tenants are cached too (version 0) so they don't hit the database on every request
+    version, cfg = 0, {}
+    if row:
+        version = int(row[1] or 0)
+        try:
+            cfg = json.loads(row[0]) if row[0] else {}
+        except Exception:
+            cfg = {}
+        if not isinstance(cfg, dict):
+            cfg = {}
+    _store(slug, version, cfg, generation)
+    return version, cfg
+
+
+def start_config_listener(app):
+    """LISTEN for config changes from other processes (PostgreSQL, TENANT_CONFIG_LISTEN=1)."""
+    if not TENANT_CONFIG_LISTEN or not HAS_PSYCOPG2 or getattr(app, '_config_listener', False):
+        return
+    database_url = app.config.get('DATABASE_URL') or os.environ.get('DATABASE_URL') or ''
+    if not database_url.startswith(('postgres://', 'postgresql://')):
+        return
+    app._config_listener = True
+
+    def loop():
+        import psycopg2
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(database_url)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # Changes made while we were not listening are unknown: start from scratch
+                with _cache_lock:
+                    _cache.clear()
+                _listening.set()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        invalidate_tenant_config(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Tenant config listener disconnected: {e}")
+            finally:
+                _listening.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(5)
+
+    t = threading.Thread(target=loop, daemon=True)
+    t.start()
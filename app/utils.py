@@ -1,41 +1,14 @@
+import os
+import io
+import csv
+import zlib
 import secrets
-import time
 import json
-from flask import session, request
-from app.database import get_db
-
-# Simple in-memory cache: {slug: (config_dict, timestamp)}
-_config_cache = {}
-CACHE_TTL = 300  # 5 minutes
-
-def get_cached_tenant_config(slug):
-    now = time.time()
-    if slug in _config_cache:
-        data, ts = _config_cache[slug]
-        if now - ts < CACHE_TTL:
-            return data
-            
-    # Fetch from DB
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT config_json FROM tenant_config WHERE tenant_slug = ?", (slug,))
-        row = cur.fetchone()
-        if row and row[0]:
-            try:
-                cfg = json.loads(row[0])
-                _config_cache[slug] = (cfg, now)
-                return cfg
-            except:
-                pass
-    except Exception as e:
-        print(f"Error fetching config for {slug}: {e}")
-        
-    return {}
-
-def invalidate_tenant_config(slug):
-    if slug in _config_cache:
-        del _config_cache[slug]
+import base64
+from flask import session, request, Response, stream_with_context
+
+# Bytes of CSV buffered before a chunk is sent to the client
+CSV_CHUNK_BYTES = int(os.environ.get('CSV_CHUNK_BYTES') or 65536)
 
 def is_authed():
     return bool(session.get('admin_auth'))
@@ -51,3 +24,66 @@ def get_csrf_token():
 def check_csrf():
     token = request.headers.get('X-CSRF-Token') or request.headers.get('X-CSRFToken')
     return token and token == session.get('csrf_token')
+
+def encode_cursor(*values):
+    """Opaque keyset pagination token for the sort key of the last row of a page."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token, *types):
+    """Inverse of encode_cursor, one type per value (e.g. int, str).
+
+    Returns the list of values converted to those types, or None if the token
+    is malformed or a value doesn't convert.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(str(token) + '=' * (-len(str(token)) % 4))
+        values = json.loads(raw.decode('utf-8'))
+        if isinstance(values, list) and len(values) == len(types):
+            return [t(v) for t, v in zip(types, values)]
+    except Exception:
+        pass
+    return None
+
+def stream_csv(header, rows, compress=False):
+    """Yield a CSV in chunks of about CSV_CHUNK_BYTES; gzip members when compress."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def flush():
+        data = output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+        if gz is None:
+            return data
+        return gz.compress(data.encode('utf-8'))
+
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if output.tell() >= CSV_CHUNK_BYTES:
+            chunk = flush()
+            if chunk:
+                yield chunk
+    chunk = flush()
+    if gz is not None:
+        chunk += gz.flush()
+    if chunk:
+        yield chunk
+
+def csv_download(filename, header, rows):
+    """Streamed CSV attachment; ?gzip=1 sends it compressed as filename.gz.
+
+    rows should be lazy (e.g. database.iter_rows) so nothing is read before
+    the client starts receiving the file.
+    """
+    compress = str(request.args.get('gzip') or '').strip().lower() in ('1', 'true', 'yes')
+    if compress:
+        filename += '.gz'
+    body = stream_with_context(stream_csv(header, rows, compress=compress))
+    return Response(
+        body,
+        mimetype='application/gzip' if compress else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
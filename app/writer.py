@@ -0,0 +1,284 @@
+"""Optional single-writer queue with group commit for SQLite deployments.
+
+SQLite allows one writer at a time, so with several Waitress threads the order
+writes (create, status, pay, last_seen) queue up on the database lock and can
+fail with "database is locked". With SQLITE_WRITE_COORDINATOR=1 those writes
+are submitted as units of work (fn(cur) callables) to one writer thread, which
+runs every unit waiting in the queue inside a single BEGIN IMMEDIATE ...
+COMMIT, each under its own SAVEPOINT so a failing unit only undoes itself.
+The request thread blocks until its batch commits and gets fn's return value
+or exception back. A unit still queued after SQLITE_WRITE_TIMEOUT is cancelled
+and never runs, so a caller that got the timeout can safely retry.
+
+Without the flag, and always on Postgres, run_write runs the unit on the
+request connection and commits it, exactly as the handlers did before.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from flask import current_app
+from app.database import get_db, is_postgres, _open_sqlite
+
+WRITE_COORDINATOR = str(os.environ.get('SQLITE_WRITE_COORDINATOR') or '').strip().lower() in ('1', 'true', 'yes')
+WRITE_BATCH_MAX = int(os.environ.get('SQLITE_WRITE_BATCH_MAX') or 32)
+# How long the writer lingers for more units once it has one (group commit window)
+WRITE_BATCH_WAIT_MS = float(os.environ.get('SQLITE_WRITE_BATCH_WAIT_MS') or 2)
+WRITE_QUEUE_MAX = int(os.environ.get('SQLITE_WRITE_QUEUE_MAX') or 256)
+WRITE_TIMEOUT = float(os.environ.get('SQLITE_WRITE_TIMEOUT') or 30)
+
+# Upper bounds of the batch-size histogram buckets
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+_local = threading.local()
+
+
+class WriteAborted(Exception):
+    """Raised by a unit to roll back its own writes and hand result to the caller."""
+
+    def __init__(self, result=None):
+        super().__init__('write aborted')
+        self.result = result
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class _Unit:
+    __slots__ = ('fn', 'future', 'queued_at')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+        self.queued_at = time.time()
+
+
+class WriteCoordinator:
+    def __init__(self, app, db_path):
+        self.app = app
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_MAX)
+        self.conn = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'units': 0,
+            'aborted': 0,
+            'failed': 0,
+            'batches': 0,
+            'batch_failures': 0,
+            'rejected': 0,
+            'cancelled': 0,
+            'max_batch_size': 0,
+            'max_queue_depth': 0,
+            'wait_ms_total': 0.0,
+            'commit_ms_total': 0.0,
+            'batch_sizes': {str(b): 0 for b in BATCH_BUCKETS},
+        }
+        self.thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, fn):
+        unit = _Unit(fn)
+        try:
+            self.queue.put(unit, timeout=WRITE_TIMEOUT)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            raise WriteQueueFull('cola de escritura llena')
+        depth = self.queue.qsize()
+        with self._stats_lock:
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        try:
+            return unit.future.result(timeout=WRITE_TIMEOUT)
+        except FutureTimeout:
+            # Still queued: cancelled, so the writer skips it and it never commits
+            if unit.future.cancel():
+                raise TimeoutError('tiempo de espera de escritura agotado')
+            # Its batch is already running; the caller must learn whether it committed
+            return unit.future.result()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + WRITE_BATCH_WAIT_MS / 1000.0
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = _open_sqlite(self.db_path)
+        return self.conn
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self._next_batch()
+                try:
+                    self._run_batch(batch)
+                except Exception as e:
+                    print(f"SQLite writer batch failed: {e}")
+
+    def _run_batch(self, batch):
+        # Units whose caller timed out were cancelled and must not run
+        live = [u for u in batch if u.future.set_running_or_notify_cancel()]
+        if len(live) < len(batch):
+            with self._stats_lock:
+                self._stats['cancelled'] += len(batch) - len(live)
+        batch = live
+        if not batch:
+            return
+        started = time.time()
+        results = []
+        try:
+            conn = self._connect()
+            if conn.in_transaction:
+                conn.rollback()
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            _local.cur = cur
+            try:
+                for unit in batch:
+                    cur.execute("SAVEPOINT write_unit")
+                    try:
+                        results.append((unit, 'ok', unit.fn(cur)))
+                        cur.execute("RELEASE SAVEPOINT write_unit")
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT write_unit")
+                        cur.execute("RELEASE SAVEPOINT write_unit")
+                        if isinstance(e, WriteAborted):
+                            results.append((unit, 'aborted', e.result))
+                        else:
+                            results.append((unit, 'failed', e))
+            finally:
+                _local.cur = None
+            conn.commit()
+        except Exception as e:
+            # Nothing in the batch was committed: every unit gets the error
+            try:
+                if self.conn is not None:
+                    self.conn.rollback()
+            except Exception:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+            with self._stats_lock:
+                self._stats['batch_failures'] += 1
+                self._stats['failed'] += len(batch)
+            for unit in batch:
+                unit.future.set_exception(e)
+            return
+        done = time.time()
+        self._record(batch, results, started, done)
+        for unit, outcome, value in results:
+            if outcome == 'failed':
+                unit.future.set_exception(value)
+            else:
+                unit.future.set_result(value)
+        # Committed order changes: wake the feed waiters (no request here for after_this_request)
+        from app.changes import notify
+        notify()
+
+    def _record(self, batch, results, started, done):
+        size = len(batch)
+        bucket = next((b for b in BATCH_BUCKETS if size <= b), BATCH_BUCKETS[-1])
+        with self._stats_lock:
+            s = self._stats
+            s['batches'] += 1
+            s['units'] += size
+            s['aborted'] += sum(1 for r in results if r[1] == 'aborted')
+            s['failed'] += sum(1 for r in results if r[1] == 'failed')
+            s['max_batch_size'] = max(s['max_batch_size'], size)
+            s['wait_ms_total'] += sum((started - u.queued_at) * 1000.0 for u in batch)
+            s['commit_ms_total'] += (done - started) * 1000.0
+            s['batch_sizes'][str(bucket)] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+            s['batch_sizes'] = dict(self._stats['batch_sizes'])
+        batches = s['batches'] or 1
+        units = s['units'] or 1
+        s['queue_depth'] = self.queue.qsize()
+        s['avg_batch_size'] = round(s['units'] / batches, 2) if s['batches'] else 0
+        s['avg_wait_ms'] = round(s.pop('wait_ms_total') / units, 3) if s['units'] else 0
+        s['avg_batch_ms'] = round(s.pop('commit_ms_total') / batches, 3) if s['batches'] else 0
+        return s
+
+
+_coordinators_lock = threading.Lock()
+
+
+def _coordinator(db_path):
+    app = current_app._get_current_object()
+    with _coordinators_lock:
+        coords = app.extensions.setdefault('write_coordinators', {})
+        coord = coords.get(db_path)
+        if coord is None:
+            coord = coords[db_path] = WriteCoordinator(app, db_path)
+            print(f"SQLite write coordinator started for {db_path}.")
+        return coord
+
+
+def run_write(fn, immediate=False):
+    """Run fn(cur) as one committed unit of work and return its result.
+
+    fn raises WriteAborted(result) to discard its writes and still return
+    result. With the coordinator it runs on the writer thread, outside the
+    request context: it must only use the cursor and values it closes over.
+    immediate takes the SQLite write lock before fn reads (direct mode only;
+    coordinator batches always start with BEGIN IMMEDIATE).
+    """
+    nested = getattr(_local, 'cur', None)
+    if nested is not None:
+        # Already inside a unit on the writer thread: join its transaction
+        return fn(nested)
+    conn = get_db()
+    if WRITE_COORDINATOR and not is_postgres():
+        return _coordinator(current_app.config['DATABASE']).submit(fn)
+    cur = conn.cursor()
+    try:
+        if immediate and not is_postgres():
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+            except Exception:
+                pass
+        result = fn(cur)
+        conn.commit()
+        return result
+    except WriteAborted as e:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return e.result
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+
+
+def write_stats():
+    """Coordinator metrics per database file ({} when the coordinator is off)."""
+    try:
+        coords = current_app.extensions.get('write_coordinators') or {}
+    except Exception:
+        coords = {}
+    return {path: coord.stats() for path, coord in coords.items()}
@@ -7,6 +7,8 @@ let statusActionInterval = null;
 let isPaymentMode = false;
 let celebrationShown = false;
 let currentConfig = {};
+// Último version del feed de cambios visto por cada chequeo ({orderId, version})
+const feedCursors = {};
 
 /**
  * Inicializa el sistema de estado de pedidos
@@ -132,6 +134,8 @@ async function updateStatusSilently() {
     if (!orderId || !statusBody) return;
 
     try {
+        // Sólo pedir el detalle completo si el pedido cambió
+        if (!(await orderChanged(orderId, 'modal'))) return;
         // Reutilizamos getOrderData existente
         const data = await getOrderData(orderId);
         
@@ -219,6 +223,30 @@ async function getOrderData(orderId) {
     return await resp.json();
 }
 
+/**
+ * Consulta barata al feed de cambios: true si el pedido pudo cambiar desde el
+ * último chequeo con la misma clave (o si el feed no está disponible).
+ */
+async function orderChanged(orderId, key) {
+    const origin = window.location.origin || '';
+    const base = /^file:/i.test(origin) ? 'http://127.0.0.1:8000' : origin;
+    const cursor = feedCursors[key];
+    const known = cursor && cursor.orderId === String(orderId);
+    let url = `${base}/api/orders/changes?order_id=${encodeURIComponent(orderId)}`;
+    if (known) url += `&since=${cursor.version}`;
+
+    try {
+        const resp = await fetch(url);
+        if (!resp.ok) return true;
+        const data = await resp.json();
+        feedCursors[key] = { orderId: String(orderId), version: data.version };
+        if (!known) return true;
+        return !!(data.reset || (data.changes && data.changes.length));
+    } catch (_) {
+        return true;
+    }
+}
+
 function showNotificationBadge() {
     const statusBtn = document.getElementById('order-status-float');
     if (!statusBtn) return;
@@ -250,6 +278,7 @@ async function checkBackgroundStatus() {
     if (!orderId) return;
 
     try {
+        if (!(await orderChanged(orderId, 'background'))) return;
         const data = await getOrderData(orderId);
         if (data && data.order) {
             const currentStatus = data.order.status;
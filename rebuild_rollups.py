@@ -0,0 +1,34 @@
+import os
+import sys
+import argparse
+
+# Only the rebuild below should write; no auto-archiver thread for this process
+os.environ.setdefault('BACKGROUND_TASKS', '0')
+
+from app import create_app
+from app.writer import run_write
+from app.rollups import rebuild, rollups_ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recalcula order_rollups desde el historial de pedidos.')
+    parser.add_argument('--tenant', help='Solo este tenant (por defecto, todos)')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if not rollups_ready():
+            print("Error: the schema has no order_rollups yet; start the app once to migrate.")
+            sys.exit(1)
+        try:
+            # One write transaction: order writes wait for it (SQLite write lock, PostgreSQL table lock in rebuild)
+            counted = run_write(lambda cur: rebuild(cur, tenant_slug=args.tenant), immediate=True)
+        except Exception as e:
+            # Including a PostgreSQL deadlock with a concurrent order write; nothing was changed, run it again
+            print(f"Error rebuilding rollups: {e}")
+            sys.exit(1)
+        print(f"Rollups rebuilt from {counted} orders{' for ' + args.tenant if args.tenant else ''}.")
+
+
+if __name__ == '__main__':
+    main()
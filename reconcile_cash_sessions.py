@@ -0,0 +1,43 @@
+import os
+import sys
+import argparse
+
+# Only the reconciliation below should write; no auto-archiver thread for this process
+os.environ.setdefault('BACKGROUND_TASKS', '0')
+
+from app import create_app
+from app.writer import run_write
+from app.cash_totals import reconcile, cash_totals_ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recalcula los totales de las sesiones de caja desde pedidos, pagos y movimientos.')
+    parser.add_argument('--tenant', help='Solo este tenant (por defecto, todos)')
+    parser.add_argument('--session', type=int, help='Solo esta sesión')
+    parser.add_argument('--dry-run', action='store_true', help='Mostrar diferencias sin corregirlas')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if not cash_totals_ready():
+            print("Error: the schema has no cash session totals yet; start the app once to migrate.")
+            sys.exit(1)
+        try:
+            # One write transaction: payments and movements wait for it (SQLite write lock, PostgreSQL row locks in reconcile)
+            drifted = run_write(
+                lambda cur: reconcile(cur, session_id=args.session, tenant_slug=args.tenant, dry_run=args.dry_run),
+                immediate=True,
+            )
+        except Exception as e:
+            # Including a PostgreSQL deadlock with a concurrent order write; nothing was changed, run it again
+            print(f"Error reconciling cash sessions: {e}")
+            sys.exit(1)
+        for sid, diff in drifted:
+            changes = ", ".join(f"{col} {have} -> {want}" for col, (have, want) in sorted(diff.items()))
+            print(f"Session {sid}: {changes}")
+        verb = 'found' if args.dry_run else 'fixed'
+        print(f"{len(drifted)} cash sessions with drifted totals {verb}.")
+
+
+if __name__ == '__main__':
+    main()